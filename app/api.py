@@ -1,23 +1,249 @@
+import asyncio
+import json
 import logging
-from fastapi import APIRouter, HTTPException
+import time
+import uuid
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime
 import pandas as pd
 from pydantic import BaseModel
 
-from app.models import text_preproc, get_representative_texts, get_summary_vllm, kw_counter, load_stop_words, split_reviews, get_attr_vllm
+from app.models import get_representative_texts, get_summary_vllm_async, kw_counter, load_stop_words, split_reviews, iter_review_lines, get_attr_vllm_async, stream_summary_vllm, stream_attr_vllm, process_attr, build_summary_request, build_attr_request, attr_cache_extra, llm_enabled
 from app.tasks import run_model_in_queue
-from app.database import log_request, get_task_status 
+from app.database import create_task, get_task, update_task_status, TASK_FINAL_STATUSES
+from app.log_sink import log_request
+from app.executor import pipeline_executor, PipelineOverloaded
+from app.result_cache import result_cache, result_key, request_fingerprint
+from app.singleflight import singleflight
+from app.registry import registry, parse_names
+from app.config import (
+    WARMUP_MODELS, TASK_LONG_POLL_MAX, TASK_POLL_INTERVAL, CLAIM_CHECK_MIN_BYTES,
+    REPRESENTATIVE_MODE, SELECTION_TOKEN_BUDGET, ATTR_MODE, INGEST_WRITE_BATCH, TOPIC_STATE_ENABLED,
+)
+from app.blob_store import get_blob_store
+from app.dedup import dedup_reviews, collapse_exact
+from app.ingest import UploadParser, UniqueReviewLimit, InvalidUpload, TooManyReviews, upload_format
+from app.observability import fallback, current_traceparent, PIPELINE_REVIEWS
+from app.topic_state import product_representatives
 
 router = APIRouter()
+blob_store = get_blob_store()
 
 class TextRequest(BaseModel):
     text: str
+    product_id: Optional[str] = None
+
+
+ANALYZE_OUTPUTS = ("summary", "attributes", "keywords")
+
+
+class AnalyzeRequest(BaseModel):
+    text: str
+    outputs: List[str] = list(ANALYZE_OUTPUTS)
+    product_id: Optional[str] = None
+
+
+def overloaded_exception(err: PipelineOverloaded) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(err), headers={"Retry-After": str(err.retry_after)})
+
+
+def lookup_pipeline_result(kind: str, text: str, req_data: dict, mode: str = REPRESENTATIVE_MODE,
+                           attr_mode: str = ATTR_MODE, product_id: str = None):
+    """
+    ключ и закэшированный результат всего конвейера (отбор отзывов + LLM) для входного текста.
+    выполняется в пуле потоков: нормализация большого текста и поход в Postgres
+    """
+    return lookup_reviews_result(
+        kind, split_reviews(text), req_data, mode=mode, attr_mode=attr_mode, product_id=product_id
+    )
+
+
+def lookup_reviews_result(kind: str, reviews, req_data: dict, mode: str = REPRESENTATIVE_MODE,
+                          attr_mode: str = ATTR_MODE, weights=None, product_id: str = None):
+    """
+    то же для уже разбитых отзывов; weights - число повторов каждого отзыва (ключ тот же, что у текста с повторами)
+    """
+    extra = {"selection_mode": mode}
+    if mode == 'budget':
+        extra["token_budget"] = SELECTION_TOKEN_BUDGET
+    if use_topic_state(product_id):
+        # отбор по состоянию тем товара отличается от отбора с нуля - результаты не смешиваются
+        extra["incremental"] = True
+    if kind == "attributes":
+        extra.update(attr_cache_extra(attr_mode))
+    key = result_key(kind, reviews, request_fingerprint(req_data), weights=weights, **extra)
+    return key, result_cache.get(key, kind=kind)
+
+
+async def store_pipeline_result(key: str, value):
+    # заглушки без vLLM и пустой ответ при ошибке разбора атрибутов не кэшируем
+    if llm_enabled() and value:
+        await result_cache.aput(key, value)
+
+
+def select_representatives(reviews, lemmas, mode: str = REPRESENTATIVE_MODE, weights=None):
+    """
+    выбор репрезентативных отзывов; если выделить темы не удалось, берутся первые 5 отзывов
+    """
+    # пытаемся выделить репрезентативные отзывы (при небольшом числе отзывов функция вернёт исходный список)
+    try:
+        rep_reviews = get_representative_texts(lemmas, reviews, mode=mode, weights=weights)
+        logging.info(f"All texts: {len(reviews)}")
+        logging.info(f"Repr texts: {len(rep_reviews)}")
+    except Exception as err:
+        logging.info("Couldn't get topics!!!")
+        logging.info(err)
+        # если не удалось получить репрезентативные отзывы — берём первые 5 отзывов
+        fallback("representatives_first5")
+        rep_reviews = reviews[:5]
+    PIPELINE_REVIEWS.labels(phase="representatives").observe(len(rep_reviews))
+    return rep_reviews
+
+
+def use_topic_state(product_id: str = None) -> bool:
+    return product_id is not None and TOPIC_STATE_ENABLED
+
+
+def select_product_representatives(product_id: str, reviews, stop_words, mode: str = REPRESENTATIVE_MODE,
+                                   weights=None):
+    """
+    выбор репрезентативных отзывов по сохранённому состоянию тем товара (app.topic_state);
+    None - если не получилось, тогда отзывы отбираются с нуля (select_representatives)
+    """
+    try:
+        rep_reviews = product_representatives(product_id, reviews, stop_words, mode=mode, weights=weights)
+    except Exception as err:
+        logging.warning(f"Topic state of {product_id} failed: {err}")
+        fallback("topic_state_failed")
+        return None
+    PIPELINE_REVIEWS.labels(phase="representatives").observe(len(rep_reviews))
+    return rep_reviews
+
+
+def representative_reviews(text: str, mode: str = REPRESENTATIVE_MODE, product_id: str = None):
+    """
+    CPU-часть /summarize и /attributes (выполняется в pipeline_executor):
+    разбиение на отзывы, лемматизация и выбор репрезентативных отзывов.
+    с product_id - по состоянию тем товара: лемматизируются и кодируются только новые отзывы
+    """
+    reviews = split_reviews(text)
+    stop_words = load_stop_words()
+
+    if use_topic_state(product_id):
+        rep_reviews = select_product_representatives(product_id, reviews, stop_words, mode=mode)
+        if rep_reviews is not None:
+            return rep_reviews
+
+    # схлопываем дубликаты и получаем лемматизированную версию каждого оставшегося отзыва
+    reviews, lemmas, weights = dedup_reviews(reviews, stop_words)
+    return select_representatives(reviews, lemmas, mode=mode, weights=weights)
+
+
+def analyze_reviews(text: str, with_representatives: bool, with_keywords: bool, product_id: str = None):
+    """
+    CPU-часть /analyze (выполняется в pipeline_executor): разбиение, стоп-слова и лемматизация
+    делаются один раз, по ним считаются и ключевые слова, и репрезентативные отзывы
+    """
+    return analyze_review_list(split_reviews(text), with_representatives, with_keywords, product_id=product_id)
+
+
+def analyze_review_list(reviews, with_representatives: bool, with_keywords: bool, weights=None,
+                        product_id: str = None):
+    """
+    то же для уже разбитых отзывов (/upload/analyze); weights - число повторов каждого отзыва
+    """
+    stop_words = load_stop_words()
+    result = {}
+    if with_representatives and use_topic_state(product_id):
+        rep_reviews = select_product_representatives(product_id, reviews, stop_words, weights=weights)
+        if rep_reviews is not None:
+            result["rep_reviews"] = rep_reviews
+            with_representatives = False
+    if not (with_representatives or with_keywords):
+        return result
+
+    reviews, lemmas, weights = dedup_reviews(reviews, stop_words, weights=weights)
+    if with_keywords:
+        result["keywords"] = kw_counter(lemmas, weights=weights)
+    if with_representatives:
+        result["rep_reviews"] = select_representatives(reviews, lemmas, weights=weights)
+    return result
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def single_chunk(text: str):
+    yield text
+
+
+async def sse_relay(deltas, endpoint: str, result_field: str, finalize=None, cache_key: str = None):
+    """
+    пересылает куски ответа vLLM клиенту как Server-Sent Events:
+      - data: {"delta": "..."} на каждый кусок
+      - event: result, data: {result_field: ...} с итоговым текстом (после finalize, если задан)
+      - event: error, data: {"detail": ...} при ошибке
+    """
+    chunks = []
+    try:
+        async for delta in deltas:
+            chunks.append(delta)
+            yield sse_event({"delta": delta})
+        result = ''.join(chunks)
+        if finalize is not None:
+            result = finalize(result)
+        yield sse_event({result_field: result}, event="result")
+        if cache_key is not None:
+            await store_pipeline_result(cache_key, result)
+        log_request(endpoint=endpoint, status="completed")
+    except Exception as e:
+        logging.exception(e)
+        log_request(endpoint=endpoint, status="error")
+        yield sse_event({"detail": str(e)}, event="error")
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def review_keywords(text: str):
+    """
+    CPU-часть /keywords (выполняется в pipeline_executor)
+    """
+    reviews = split_reviews(text)
+    stop_words = load_stop_words()
+
+    # дубликаты лемматизируются один раз, частоты слов считаются с их весами
+    reviews, lemmas, weights = dedup_reviews(reviews, stop_words)
+    return kw_counter(lemmas, weights=weights)
 
 @router.get("/ping")
 async def ping():
     log_request(endpoint="ping", status="completed")
     return {"ping": "Привет! Я микросервис и я живой."}
 
+@router.get("/healthz")
+async def healthz():
+    """
+    liveness: процесс жив и отвечает, без обращений к БД и моделям
+    """
+    return {"status": "ok"}
+
+@router.get("/readyz")
+async def readyz():
+    """
+    readiness: модели из WARMUP_MODELS загружены, под можно включать в балансировку
+    """
+    required = parse_names(WARMUP_MODELS)
+    if not registry.ready(required):
+        missing = [name for name in required if name not in registry.loaded()]
+        raise HTTPException(status_code=503, detail={"status": "loading", "missing": missing})
+    return {"status": "ready", "loaded": registry.loaded()}
+
 @router.post("/summarize")
 async def summarize_endpoint(request: TextRequest):
     """
@@ -29,41 +255,43 @@ async def summarize_endpoint(request: TextRequest):
     Логика:
       1. Разбивает входной текст на список отзывов.
       2. Загружает стоп-слова.
-      3. Для каждого отзыва получает лемматизированный вариант с помощью text_preproc.
+      3. Для каждого отзыва получает лемматизированный вариант с помощью text_preproc_batch.
       4. Пытается вычислить репрезентативные отзывы с помощью get_representative_texts.
          Если возникает ошибка, берутся первые 5 отзывов.
-      5. Вызывается функция get_summary_vllm для получения саммари.
+         Шаги 1-4 выполняются в pipeline_executor; если его очередь заполнена - 503 + Retry-After.
+      5. Вызывается функция get_summary_vllm_async для получения саммари.
+         Готовый результат берётся из result_cache; одинаковые одновременные запросы
+         (в т.ч. из других воркеров) ждут одно вычисление через singleflight.
       6. Логируется успешный вызов или ошибка в БД.
     """
     if not request.text:
         raise HTTPException(status_code=400, detail="Параметр 'text' не может быть пустым.")
 
     try:
-        reviews = split_reviews(request.text)
-        stop_words = load_stop_words()
-
-        # получаем лемматизированную версию каждого отзыва
-        lemmas = [text_preproc(review, stop_words=stop_words) for review in reviews]
-
-        # пытаемся выделить репрезентативные отзывы (при небольшом числе отзывов функция вернёт исходный список)
-        try:
-            rep_reviews = get_representative_texts(lemmas, reviews, mode='expanded')
-            logging.info(f"All texts: {len(reviews)}")
-            logging.info(f"Repr texts: {len(rep_reviews)}")
-
-        except Exception as err:
-            logging.info("Couldn't get topics!!!")
-            logging.info(err)
-            # если не удалось получить репрезентативные отзывы — берём первые 5 отзывов
-            rep_reviews = reviews[:5]
-
-        summary = get_summary_vllm(rep_reviews)
+        key, summary = await run_in_threadpool(
+            lookup_pipeline_result, "summary", request.text, build_summary_request(""), product_id=request.product_id
+        )
+        if summary is not None:
+            log_request(endpoint="summarize", status="completed")
+            return {"summary": summary}
+
+        async def compute():
+            rep_reviews = await pipeline_executor.run(representative_reviews, request.text, product_id=request.product_id)
+            summary = await get_summary_vllm_async(rep_reviews)
+            await store_pipeline_result(key, summary)
+            return summary
+
+        # одинаковые одновременные запросы ждут одно вычисление
+        summary = await singleflight.do(key, compute)
         logging.info(summary)
 
         # логируем успешный вызов в БД
         log_request(endpoint="summarize", status="completed")
         return {"summary": summary}
 
+    except PipelineOverloaded as e:
+        log_request(endpoint="summarize", status="rejected")
+        raise overloaded_exception(e)
     except Exception as e:
         log_request(endpoint="summarize", status="error")
         raise HTTPException(status_code=500, detail=str(e))
@@ -80,43 +308,112 @@ async def attributes_endpoint(request: TextRequest):
     Логика:
       1. Разбивает входной текст на список отзывов.
       2. Загружает стоп-слова.
-      3. Для каждого отзыва получает лемматизированный вариант с помощью text_preproc.
+      3. Для каждого отзыва получает лемматизированный вариант с помощью text_preproc_batch.
       4. Пытается вычислить репрезентативные отзывы с помощью get_representative_texts.
          Если возникает ошибка, берутся первые 5 отзывов.
-      5. Вызывается функция get_attr_vllm для получения атрибутов и их характеристик.
+         Шаги 1-4 выполняются в pipeline_executor; если его очередь заполнена - 503 + Retry-After.
+      5. Вызывается функция get_attr_vllm_async для получения атрибутов и их характеристик.
+         Готовый результат берётся из result_cache; одинаковые одновременные запросы
+         (в т.ч. из других воркеров) ждут одно вычисление через singleflight.
       6. Логируется успешный вызов или ошибка в БД.
     """
     if not request.text:
         raise HTTPException(status_code=400, detail="Параметр 'text' не может быть пустым.")
 
     try:
-        reviews = split_reviews(request.text)
-        stop_words = load_stop_words()
-
-        # получаем лемматизированную версию каждого отзыва
-        lemmas = [text_preproc(review, stop_words=stop_words) for review in reviews]
-
-        # пытаемся выделить репрезентативные отзывы (при небольшом числе отзывов функция вернёт исходный список)
-        try:
-            rep_reviews = get_representative_texts(lemmas, reviews, mode='expanded')
-            logging.info(f"All texts: {len(reviews)}")
-            logging.info(f"Repr texts: {len(rep_reviews)}")
-        except Exception as err:
-            logging.info("Couldn't get topics!!!")
-            logging.info(err)
-            # если не удалось получить репрезентативные отзывы — берём первые 5 отзывов
-            rep_reviews = reviews[:5]
-
-        attr = get_attr_vllm(rep_reviews)
+        key, attr = await run_in_threadpool(
+            lookup_pipeline_result, "attributes", request.text, build_attr_request(""), product_id=request.product_id
+        )
+        if attr is not None:
+            log_request(endpoint="attributes", status="completed")
+            return {"attributes": attr}
+
+        async def compute():
+            rep_reviews = await pipeline_executor.run(representative_reviews, request.text, product_id=request.product_id)
+            attr = await get_attr_vllm_async(rep_reviews)
+            await store_pipeline_result(key, attr)
+            return attr
+
+        # одинаковые одновременные запросы ждут одно вычисление
+        attr = await singleflight.do(key, compute)
         logging.info(attr)
         # логируем успешный вызов в БД
         log_request(endpoint="attributes", status="completed")
         return {"attributes": attr}
 
+    except PipelineOverloaded as e:
+        log_request(endpoint="attributes", status="rejected")
+        raise overloaded_exception(e)
     except Exception as e:
         log_request(endpoint="attributes", status="error")
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/summarize/stream")
+async def summarize_stream_endpoint(request: TextRequest):
+    """
+    Потоковый вариант /summarize: саммари приходит по мере генерации как Server-Sent Events
+    (text/event-stream). Подготовка отзывов та же, что в /summarize; ошибки до начала генерации
+    отдаются обычными HTTP-кодами (400/500/503), после - событием error.
+    """
+    if not request.text:
+        raise HTTPException(status_code=400, detail="Параметр 'text' не может быть пустым.")
+
+    try:
+        key, summary = await run_in_threadpool(
+            lookup_pipeline_result, "summary", request.text, build_summary_request(""), product_id=request.product_id
+        )
+        if summary is not None:
+            return StreamingResponse(
+                sse_relay(single_chunk(summary), "summarize_stream", "summary"),
+                media_type="text/event-stream", headers=SSE_HEADERS,
+            )
+        rep_reviews = await pipeline_executor.run(representative_reviews, request.text, product_id=request.product_id)
+    except PipelineOverloaded as e:
+        log_request(endpoint="summarize_stream", status="rejected")
+        raise overloaded_exception(e)
+    except Exception as e:
+        log_request(endpoint="summarize_stream", status="error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return StreamingResponse(
+        sse_relay(stream_summary_vllm(rep_reviews), "summarize_stream", "summary", cache_key=key),
+        media_type="text/event-stream", headers=SSE_HEADERS,
+    )
+
+
+@router.post("/attributes/stream")
+async def attributes_stream_endpoint(request: TextRequest):
+    """
+    Потоковый вариант /attributes: сырые куски ответа модели приходят как Server-Sent Events,
+    в финальном событии result - атрибуты после process_attr (как в /attributes).
+    """
+    if not request.text:
+        raise HTTPException(status_code=400, detail="Параметр 'text' не может быть пустым.")
+
+    try:
+        # поток - всегда один ответ модели, поэтому и ключ кэша как у ATTR_MODE=single
+        key, attr = await run_in_threadpool(
+            lookup_pipeline_result, "attributes", request.text, build_attr_request(""), attr_mode='single',
+            product_id=request.product_id,
+        )
+        if attr is not None:
+            return StreamingResponse(
+                sse_relay(single_chunk(attr), "attributes_stream", "attributes"),
+                media_type="text/event-stream", headers=SSE_HEADERS,
+            )
+        rep_reviews = await pipeline_executor.run(representative_reviews, request.text, product_id=request.product_id)
+    except PipelineOverloaded as e:
+        log_request(endpoint="attributes_stream", status="rejected")
+        raise overloaded_exception(e)
+    except Exception as e:
+        log_request(endpoint="attributes_stream", status="error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return StreamingResponse(
+        sse_relay(stream_attr_vllm(rep_reviews), "attributes_stream", "attributes", finalize=process_attr, cache_key=key),
+        media_type="text/event-stream", headers=SSE_HEADERS,
+    )
+
 @router.post("/keywords")
 async def keywords_endpoint(request: TextRequest):
     """
@@ -130,44 +427,324 @@ async def keywords_endpoint(request: TextRequest):
       2. Загружает стоп-слова.
       3. Для каждого отзыва получает лемматизированный вариант.
       4. Вызывает функцию kw_counter для подсчёта самых частотных слов.
+         Шаги 1-4 выполняются в pipeline_executor; если его очередь заполнена - 503 + Retry-After.
       5. Логируется успешный вызов или ошибка в БД.
     """
     if not request.text:
         raise HTTPException(status_code=400, detail="Параметр 'text' не может быть пустым.")
 
     try:
-        reviews = split_reviews(request.text)
-        stop_words = load_stop_words()
-
-        # получаем лемматизированную версию каждого отзыва
-        lemmas = [text_preproc(review, stop_words=stop_words) for review in reviews]
-
-        keywords = kw_counter(lemmas)
+        keywords = await pipeline_executor.run(review_keywords, request.text)
         logging.info(keywords)
         # логируем успешный вызов в БД
         log_request(endpoint="keywords", status="completed")
         return {"keywords": keywords}
 
+    except PipelineOverloaded as e:
+        log_request(endpoint="keywords", status="rejected")
+        raise overloaded_exception(e)
     except Exception as e:
         log_request(endpoint="keywords", status="error")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def check_outputs(outputs) -> set:
+    outputs = set(outputs)
+    if not outputs or not outputs <= set(ANALYZE_OUTPUTS):
+        raise HTTPException(status_code=400, detail=f"Параметр 'outputs' должен быть подмножеством {list(ANALYZE_OUTPUTS)}.")
+    return outputs
+
+
+async def analyze_outputs(outputs, lookup, prepare):
+    """
+    общая часть /analyze и /upload/analyze
+
+    args:
+        outputs (set of str): нужные результаты из ANALYZE_OUTPUTS
+        lookup (callable): lookup(kind, req_data) -> (ключ, закэшированный результат или None), в пуле потоков
+        prepare (callable): prepare(with_representatives, with_keywords) -> dict с rep_reviews и keywords,
+            в pipeline_executor
+    returns:
+        dict: результаты по видам
+    """
+    llm_outputs = {
+        "summary": (build_summary_request(""), get_summary_vllm_async),
+        "attributes": (build_attr_request(""), get_attr_vllm_async),
+    }
+    response, keys = {}, {}
+    for kind, (req_data, _) in llm_outputs.items():
+        if kind in outputs:
+            keys[kind], cached = await run_in_threadpool(lookup, kind, req_data)
+            if cached is not None:
+                response[kind] = cached
+
+    pending = [kind for kind in keys if kind not in response]
+    if pending or "keywords" in outputs:
+        prepared = await pipeline_executor.run(prepare, bool(pending), "keywords" in outputs)
+        if "keywords" in outputs:
+            response["keywords"] = prepared["keywords"]
+
+        def make_compute(kind):
+            async def compute():
+                value = await llm_outputs[kind][1](prepared["rep_reviews"])
+                await store_pipeline_result(keys[kind], value)
+                return value
+            return compute
+
+        values = await asyncio.gather(*(singleflight.do(keys[kind], make_compute(kind)) for kind in pending))
+        response.update(zip(pending, values))
+    return response
+
+
+@router.post("/analyze")
+async def analyze_endpoint(request: AnalyzeRequest):
+    """
+    Эндпоинт, объединяющий /summarize, /attributes и /keywords для одного набора отзывов.
+
+    Входные данные:
+      - text: строка, содержащая отзывы (каждый отзыв — с новой строки)
+      - outputs: какие результаты нужны - подмножество ["summary", "attributes", "keywords"] (по умолчанию все)
+
+    Логика:
+      1. Готовые саммари/атрибуты берутся из result_cache (те же ключи, что у /summarize и /attributes).
+      2. В pipeline_executor один раз: разбиение на отзывы, стоп-слова, лемматизация,
+         ключевые слова и (если нужен хоть один LLM-результат) репрезентативные отзывы.
+      3. Запросы саммари к vllm и атрибутов к vllm_lora выполняются одновременно.
+      4. Логируется успешный вызов или ошибка в БД.
+    """
+    if not request.text:
+        raise HTTPException(status_code=400, detail="Параметр 'text' не может быть пустым.")
+    outputs = check_outputs(request.outputs)
+
+    try:
+        response = await analyze_outputs(
+            outputs,
+            lambda kind, req_data: lookup_pipeline_result(kind, request.text, req_data, product_id=request.product_id),
+            lambda with_representatives, with_keywords: analyze_reviews(
+                request.text, with_representatives, with_keywords, product_id=request.product_id
+            ),
+        )
+        log_request(endpoint="analyze", status="completed")
+        return response
+
+    except PipelineOverloaded as e:
+        log_request(endpoint="analyze", status="rejected")
+        raise overloaded_exception(e)
+    except Exception as e:
+        log_request(endpoint="analyze", status="error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def submit_huge_summary(text: str = None, blob_ref: str = None, task_id: str = None) -> str:
+    """
+    создаёт запись задачи и отправляет run_model_in_queue в очередь: текст в сообщении или ссылкой blob_ref
+    на хранилище payload'ов (записанный под тем же task_id). если отправить не удалось, payload по ссылке удаляется,
+    а задача помечается ошибкой - иначе /status ждал бы задачу, которую никто не выполнит
+    """
+    created = False
+    try:
+        # запись задачи создаётся до отправки в очередь: воркер обновляет её статус по task_id
+        task_id = task_id or str(uuid.uuid4())
+        await run_in_threadpool(create_task, task_id)
+        created = True
+        # трасса запроса продолжается в воркере; enqueued_at - для времени ожидания в очереди
+        headers = {"traceparent": current_traceparent(), "enqueued_at": time.time()}
+        if blob_ref is None:
+            task = run_model_in_queue.apply_async(
+                args=[text], queue='huge_summarize_queue', task_id=task_id, headers=headers
+            )
+        else:
+            task = run_model_in_queue.apply_async(
+                kwargs={"blob_ref": blob_ref}, queue='huge_summarize_queue', task_id=task_id, headers=headers
+            )
+    except Exception as err:
+        if created:
+            try:
+                await run_in_threadpool(update_task_status, task_id, "error", error=f"enqueue failed: {err}")
+            except Exception as update_err:
+                logging.warning(f"Could not mark task {task_id} as failed: {update_err}")
+        if blob_ref is not None:
+            await run_in_threadpool(blob_store.delete, blob_ref)
+        raise
+    return task.id
+
+
 @router.post("/huge_summarize")
 async def huge_summarize(request: TextRequest):
     """
     Отправляет задачу в очередь RabbitMQ.
     """
-    task = run_model_in_queue.apply_async(args=[request.text], queue='huge_summarize_queue')
-    log_request(endpoint="huge_summarize", status="submitted", task_id=task.id)
-    return {"task_id": task.id, "status": "submitted"}
+    if len(request.text.encode("utf-8")) < CLAIM_CHECK_MIN_BYTES:
+        task_id = await submit_huge_summary(text=request.text)
+    else:
+        # claim-check: большой текст не гоняем через RabbitMQ, в сообщении только ссылка на него
+        # payload под именем задачи: очистка хранилища не удалит его, пока задача не завершится
+        task_id = str(uuid.uuid4())
+        blob_ref = await run_in_threadpool(blob_store.put_text, request.text, task_id)
+        await submit_huge_summary(blob_ref=blob_ref, task_id=task_id)
+    log_request(endpoint="huge_summarize", status="submitted", task_id=task_id)
+    return {"task_id": task_id, "status": "submitted"}
+
+
+async def read_upload(request: Request, parser: UploadParser, sink, batch_size: int = INGEST_WRITE_BATCH):
+    """
+    читает тело запроса потоком и передаёт тексты принятых отзывов пачками в sink (async, список строк);
+    в памяти только текущий кусок тела и одна пачка
+    """
+    batch = []
+    async for chunk in request.stream():
+        for record in parser.feed(chunk):
+            batch.append(record.text)
+            if len(batch) >= batch_size:
+                await sink(batch)
+                batch = []
+    batch.extend(record.text for record in parser.close())
+    if batch:
+        await sink(batch)
+
+
+def read_upload_reviews(blob_ref: str):
+    """
+    уникальные отзывы загрузки с числом повторов из payload'а - потоком, без полного списка строк
+    """
+    return collapse_exact(iter_review_lines(blob_store.iter_lines(blob_ref)))
+
+
+def upload_parser(request: Request, fmt: Optional[str], product_id: Optional[str]) -> UploadParser:
+    try:
+        return UploadParser(upload_format(fmt, request.headers.get("content-type")), product_id=product_id)
+    except InvalidUpload as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.post("/upload/huge_summarize")
+async def upload_huge_summarize(request: Request, fmt: Optional[str] = Query(None, alias="format"),
+                                product_id: Optional[str] = None):
+    """
+    /huge_summarize для выгрузок отзывов файлом: NDJSON или CSV (можно сжатый gzip) в теле запроса.
+
+    Входные данные:
+      - тело: записи с полем text (или review/comment) и необязательными product_id, rating, review_id (id)
+      - format: ndjson или csv (по умолчанию по Content-Type: text/csv - csv, иначе ndjson)
+      - product_id: брать отзывы только этого товара (обязателен, если в файле несколько товаров)
+
+    Логика:
+      1. Тело читается потоком: распаковка, разбор и проверка записей по мере поступления,
+         повторы review_id отбрасываются. Весь файл в памяти не собирается.
+      2. Принятые отзывы пачками пишутся в хранилище payload'ов (claim-check), как большие тексты /huge_summarize.
+      3. Задача уходит в очередь со ссылкой на payload; в ответе task_id и статистика разбора.
+      Некорректный файл (битый gzip, не UTF-8, нет колонки с текстом, нет ни одного отзыва) - 400.
+    """
+    parser = upload_parser(request, fmt, product_id)
+    task_id = str(uuid.uuid4())
+    writer = await run_in_threadpool(blob_store.open_writer, task_id)
+
+    async def sink(batch):
+        await run_in_threadpool(writer.write_lines, batch)
+
+    try:
+        await read_upload(request, parser, sink)
+        blob_ref = await run_in_threadpool(writer.commit)
+    except InvalidUpload as e:
+        await run_in_threadpool(writer.abort)
+        log_request(endpoint="upload_huge_summarize", status="rejected")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        await run_in_threadpool(writer.abort)
+        log_request(endpoint="upload_huge_summarize", status="error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    await submit_huge_summary(blob_ref=blob_ref, task_id=task_id)
+    log_request(endpoint="upload_huge_summarize", status="submitted", task_id=task_id)
+    return {"task_id": task_id, "status": "submitted", "stats": parser.stats()}
+
+
+@router.post("/upload/analyze")
+async def upload_analyze(request: Request, outputs: str = ",".join(ANALYZE_OUTPUTS),
+                         fmt: Optional[str] = Query(None, alias="format"), product_id: Optional[str] = None):
+    """
+    /analyze для выгрузок отзывов файлом (формат и параметры те же, что у /upload/huge_summarize;
+    outputs - через запятую).
+
+    Принятые отзывы пачками пишутся во временный payload в хранилище (как у /upload/huge_summarize),
+    пока идёт загрузка, в памяти только хэши уникальных отзывов для лимита: больше INGEST_MAX_REVIEWS - 413,
+    такие выгрузки идут через /upload/huge_summarize. После загрузки payload читается потоком и схлопывается:
+    повторяющийся текст хранится один раз с числом повторов, которое дальше учитывается как вес дубликата.
+    Результаты кэшируются с теми же ключами, что у /analyze для того же набора отзывов;
+    в ответе дополнительно статистика разбора.
+    """
+    outputs = check_outputs(name.strip() for name in outputs.split(",") if name.strip())
+    parser = upload_parser(request, fmt, product_id)
+    limit = UniqueReviewLimit()
+    writer = await run_in_threadpool(blob_store.open_writer)
+
+    async def sink(batch):
+        for text in batch:
+            limit.add(text)
+        await run_in_threadpool(writer.write_lines, batch)
+
+    try:
+        await read_upload(request, parser, sink)
+        blob_ref = await run_in_threadpool(writer.commit)
+    except TooManyReviews as e:
+        await run_in_threadpool(writer.abort)
+        log_request(endpoint="upload_analyze", status="rejected")
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidUpload as e:
+        await run_in_threadpool(writer.abort)
+        log_request(endpoint="upload_analyze", status="rejected")
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        await run_in_threadpool(writer.abort)
+        log_request(endpoint="upload_analyze", status="error")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    try:
+        reviews, weights = await run_in_threadpool(read_upload_reviews, blob_ref)
+    except Exception as e:
+        log_request(endpoint="upload_analyze", status="error")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await run_in_threadpool(blob_store.delete, blob_ref)
+    try:
+        response = await analyze_outputs(
+            outputs,
+            lambda kind, req_data: lookup_reviews_result(
+                kind, reviews, req_data, weights=weights, product_id=product_id
+            ),
+            lambda with_representatives, with_keywords: analyze_review_list(
+                reviews, with_representatives, with_keywords, weights=weights, product_id=product_id
+            ),
+        )
+        response["stats"] = parser.stats()
+        log_request(endpoint="upload_analyze", status="completed")
+        return response
+
+    except PipelineOverloaded as e:
+        log_request(endpoint="upload_analyze", status="rejected")
+        raise overloaded_exception(e)
+    except Exception as e:
+        log_request(endpoint="upload_analyze", status="error")
+        raise HTTPException(status_code=500, detail=str(e))
 
 @router.get("/task_status/{task_id}")
-async def get_task_status_endpoint(task_id: str):
+async def get_task_status_endpoint(task_id: str, wait: float = 0):
     """
-    Получение статуса задачи по task_id.
+    Получение статуса задачи по task_id: прогресс map-reduce саммари, время стадий и результат завершённой задачи.
+    wait > 0 - long-poll: ответ придёт, как только статус или прогресс изменится
+    (или через wait секунд, не больше TASK_LONG_POLL_MAX), вместо частого опроса клиентом.
     """
-    status = get_task_status(task_id)
-    if status is None:
+    task = await run_in_threadpool(get_task, task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="Task not found")
-    return {"task_id": task_id, "status": status}
\ No newline at end of file
+    deadline = time.monotonic() + min(max(wait, 0), TASK_LONG_POLL_MAX)
+    seen = (task["status"], task["progress"])
+    while task["status"] not in TASK_FINAL_STATUSES and time.monotonic() < deadline:
+        await asyncio.sleep(min(TASK_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
+        task = await run_in_threadpool(get_task, task_id)
+        # строку могли удалить или она истекла, пока ждали
+        if task is None:
+            raise HTTPException(status_code=404, detail="Task not found")
+        if (task["status"], task["progress"]) != seen:
+            break
+    return {"task_id": task_id, **task}
@@ -0,0 +1,249 @@
+import codecs
+import gzip
+import logging
+import os
+import time
+import uuid
+import zlib
+
+from app.config import BLOB_STORE, BLOB_STORE_DIR, BLOB_TTL
+
+CHUNK_SIZE = 1 << 20
+
+
+def _line_complete(line: str) -> bool:
+    # \r в конце куска может оказаться началом \r\n
+    return line.splitlines()[0] != line and not line.endswith("\r")
+
+
+def iter_split_lines(texts):
+    """
+    строки из потока кусков текста по тем же границам, что str.splitlines() в split_reviews
+    (\n, \r, \r\n, \x0b, \x0c, \x1c-\x1e, \x85, \u2028, \u2029): текст, прочитанный из хранилища,
+    делится на те же отзывы, что и переданный в сообщении
+    """
+    tail = ""
+    for text in texts:
+        lines = (tail + text).splitlines(keepends=True)
+        tail = lines.pop() if lines and not _line_complete(lines[-1]) else ""
+        for line in lines:
+            yield line.splitlines()[0]
+    if tail:
+        yield tail.splitlines()[0]
+
+
+def iter_text_lines(chunks):
+    """
+    строки текста из потока сжатых zlib байт - без сборки всего текста в памяти
+    """
+    decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def texts():
+        for chunk in chunks:
+            yield decoder.decode(decompressor.decompress(chunk))
+        yield decoder.decode(decompressor.flush(), final=True)
+
+    return iter_split_lines(texts())
+
+
+class FileBlobStore:
+    """
+    сжатые gzip файлы в общем каталоге (PVC, смонтированный и в API, и в воркер Celery).
+    ссылка - 'fs:<task_id>.gz'. при записи новых удаляются файлы старше ttl, оставшиеся от упавших задач, -
+    только если задача уже завершена или её записи нет: payload задачи, долго ждущей в очереди, не теряется
+    """
+    name = "fs"
+
+    def __init__(self, path: str = BLOB_STORE_DIR, ttl: int = BLOB_TTL):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, ref: str) -> str:
+        name = ref.split(":", 1)[1]
+        if os.path.basename(name) != name:
+            raise ValueError(f"Некорректная ссылка на payload '{ref}'")
+        return os.path.join(self.path, name)
+
+    def put_text(self, text: str, task_id: str = None) -> str:
+        self.sweep()
+        name = f"{task_id or uuid.uuid4().hex}.gz"
+        tmp = os.path.join(self.path, f".{name}.tmp")
+        with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(text)
+        os.replace(tmp, os.path.join(self.path, name))
+        return f"fs:{name}"
+
+    def open_writer(self, task_id: str = None):
+        """
+        запись payload'а построчно по мере поступления (загрузки /upload/*); commit() возвращает ссылку
+        """
+        self.sweep()
+        return FileBlobWriter(self, task_id)
+
+    def iter_lines(self, ref: str):
+        with gzip.open(self._file(ref), "rt", encoding="utf-8", newline="") as f:
+            yield from iter_split_lines(iter(lambda: f.read(CHUNK_SIZE), ""))
+
+    def delete(self, ref: str):
+        try:
+            os.remove(self._file(ref))
+        except FileNotFoundError:
+            pass
+
+    def _abandoned(self, name: str) -> bool:
+        # недописанные файлы (.tmp) обновляются, пока идёт загрузка - старые брошены
+        if name.startswith("."):
+            return True
+        from app.database import get_task, TASK_FINAL_STATUSES
+        task = get_task(name[:-len(".gz")], with_result=False)
+        return task is None or task["status"] in TASK_FINAL_STATUSES
+
+    def sweep(self):
+        cutoff = time.time() - self.ttl
+        for entry in os.scandir(self.path):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff and self._abandoned(entry.name):
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            except Exception as err:
+                logging.warning(f"Couldn't check payload {entry.name}: {err}")
+
+
+class FileBlobWriter:
+    def __init__(self, store: FileBlobStore, task_id: str = None):
+        self.name = f"{task_id or uuid.uuid4().hex}.gz"
+        self.path = os.path.join(store.path, self.name)
+        self.tmp = os.path.join(store.path, f".{self.name}.tmp")
+        self.file = gzip.open(self.tmp, "wt", encoding="utf-8", compresslevel=6)
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.file.write(line)
+            self.file.write("\n")
+
+    def commit(self) -> str:
+        self.file.close()
+        os.replace(self.tmp, self.path)
+        return f"fs:{self.name}"
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
+
+
+class PostgresBlobStore:
+    """
+    large object в Postgres (сжатый zlib), доступен всем подам без общего тома.
+    ссылка - 'pg:<oid>'; осиротевшие объекты можно убрать утилитой vacuumlo
+    """
+    name = "postgres"
+
+    def _connection(self):
+        from app.database import engine
+        return engine.raw_connection()
+
+    def put_text(self, text: str, task_id: str = None) -> str:
+        payload = zlib.compress(text.encode("utf-8"), 6)
+        conn = self._connection()
+        try:
+            lobject = conn.lobject(0, "wb")
+            for i in range(0, len(payload), CHUNK_SIZE):
+                lobject.write(payload[i:i + CHUNK_SIZE])
+            oid = lobject.oid
+            lobject.close()
+            conn.commit()
+        finally:
+            conn.close()
+        return f"pg:{oid}"
+
+    def open_writer(self, task_id: str = None):
+        return PostgresBlobWriter(self._connection())
+
+    def iter_lines(self, ref: str):
+        conn = self._connection()
+        try:
+            lobject = conn.lobject(int(ref.split(":", 1)[1]), "rb")
+
+            def chunks():
+                while True:
+                    chunk = lobject.read(CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+
+            yield from iter_text_lines(chunks())
+            lobject.close()
+        finally:
+            conn.close()
+
+    def delete(self, ref: str):
+        conn = self._connection()
+        try:
+            conn.lobject(int(ref.split(":", 1)[1]), "n").unlink()
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class PostgresBlobWriter:
+    """
+    large object создаётся в транзакции соединения: abort() откатывает её вместе с уже записанными данными
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lobject = conn.lobject(0, "wb")
+        self.compressor = zlib.compressobj(6)
+
+    def write_lines(self, lines):
+        payload = self.compressor.compress(''.join(f"{line}\n" for line in lines).encode("utf-8"))
+        if payload:
+            self.lobject.write(payload)
+
+    def commit(self) -> str:
+        try:
+            self.lobject.write(self.compressor.flush())
+            oid = self.lobject.oid
+            self.lobject.close()
+            self.conn.commit()
+        finally:
+            self.conn.close()
+        return f"pg:{oid}"
+
+    def abort(self):
+        try:
+            self.conn.rollback()
+        finally:
+            self.conn.close()
+
+
+BLOB_STORES = {
+    "fs": FileBlobStore,
+    "postgres": PostgresBlobStore,
+}
+
+
+def get_blob_store(name: str = BLOB_STORE):
+    """
+    возвращает хранилище payload'ов по имени из конфига (BLOB_STORE)
+    """
+    try:
+        store = BLOB_STORES[name]()
+    except KeyError:
+        raise ValueError(f"BLOB_STORE должен быть одним из {sorted(BLOB_STORES)}, а не '{name}'")
+    logging.info(f"Blob store: {store.name}")
+    return store
+
+
+def store_for(ref: str):
+    """
+    хранилище по префиксу ссылки - воркер читает payload тем же хранилищем, каким его записал API
+    """
+    prefix = ref.split(":", 1)[0]
+    return get_blob_store({"fs": "fs", "pg": "postgres"}.get(prefix, prefix))
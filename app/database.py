@@ -1,10 +1,22 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy import create_engine, insert, Column, Integer, String, DateTime, Text, LargeBinary, Boolean
 from sqlalchemy.orm import declarative_base, sessionmaker
 import datetime
+import json
+import zlib
 
-from app.config import DATABASE_URL
+from app.observability import stage
+from app.config import (
+    DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, TASK_RESULT_COMPRESS_MIN_BYTES,
+)
 
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+)
 SessionLocal = sessionmaker(bind=engine)
 
 Base = declarative_base()
@@ -17,29 +29,161 @@ class RequestLog(Base):
     task_id = Column(String, nullable=True)
     timestamp = Column(DateTime, default=datetime.datetime.utcnow)
 
-def log_request(endpoint: str, status: str, task_id: str = None):
+class TaskRecord(Base):
+    """
+    задача /huge_summarize: статус, прогресс, результат и время прохождения стадий.
+    отдельно от request_logs, чтобы опрос статуса шёл по уникальному индексу, а не сканом лога
+    """
+    __tablename__ = "tasks"
+    id = Column(Integer, primary_key=True)
+    task_id = Column(String, unique=True, index=True, nullable=False)
+    status = Column(String, nullable=False)
+    progress = Column(String, nullable=True)
+    # JSON результата; большие саммари сжимаются zlib (result_compressed=True)
+    result = Column(LargeBinary, nullable=True)
+    result_compressed = Column(Boolean, default=False)
+    error = Column(Text, nullable=True)
+    queued_at = Column(DateTime, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class ResultCacheEntry(Base):
+    """
+    L2-уровень кэша результатов (см. app/result_cache.py)
+    """
+    __tablename__ = "result_cache"
+    key = Column(String(64), primary_key=True)
+    value = Column(Text)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+    expires_at = Column(DateTime, index=True)
+
+class InflightLease(Base):
+    """
+    аренда на вычисление результата по ключу (см. app/singleflight.py): пока она есть,
+    другие процессы ждут результат в кэше, а не считают его сами.
+    no_result - лидер закончил, но результат в кэш не попал: ждать нечего
+    """
+    __tablename__ = "inflight_leases"
+    key = Column(String(64), primary_key=True)
+    owner = Column(String)
+    expires_at = Column(DateTime, index=True)
+    no_result = Column(Boolean, default=False, nullable=False)
+
+class TopicStateRecord(Base):
+    """
+    состояние тем товара для инкрементального отбора репрезентативных отзывов (см. app/topic_state.py)
+    """
+    __tablename__ = "topic_states"
+    product_id = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    # JSON: счётчики дрейфа и тексты отзывов-кандидатов
+    meta = Column(Text)
+    # npz: хэши, веса и темы отзывов, центроиды тем, эмбеддинги кандидатов
+    arrays = Column(LargeBinary)
+    fitted_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+def write_request_logs(rows):
+    """
+    вставка пачки записей одним multi-row INSERT
+    """
+    if not rows:
+        return
+    session = SessionLocal()
+    try:
+        session.execute(insert(RequestLog), rows)
+        session.commit()
+    finally:
+        session.close()
+
+TASK_FINAL_STATUSES = ("completed", "error")
+
+def create_task(task_id: str):
+    """
+    создаёт запись задачи со статусом submitted (до отправки в очередь)
+    """
     session = SessionLocal()
-    log = RequestLog(endpoint=endpoint, status=status, task_id=task_id)
-    session.add(log)
-    session.commit()
-    session.close()
+    try:
+        session.add(TaskRecord(task_id=task_id, status="submitted", queued_at=datetime.datetime.utcnow()))
+        session.commit()
+    finally:
+        session.close()
+
+def encode_task_result(result):
+    payload = json.dumps(result, ensure_ascii=False).encode("utf-8")
+    if len(payload) >= TASK_RESULT_COMPRESS_MIN_BYTES:
+        return zlib.compress(payload), True
+    return payload, False
+
+def decode_task_result(payload: bytes, compressed: bool):
+    if payload is None:
+        return None
+    if compressed:
+        payload = zlib.decompress(payload)
+    return json.loads(payload.decode("utf-8"))
 
-def update_task_status(task_id: str, status: str):
+@stage("db_task_update")
+def update_task_status(task_id: str, status: str, result=None, error: str = None):
+    """
+    обновляет статус задачи и время стадии: started -> started_at, completed/error -> finished_at.
+    с результатом (completed) или текстом ошибки (error) сохраняет и их
+    """
+    session = SessionLocal()
+    try:
+        task = session.query(TaskRecord).filter_by(task_id=task_id).first()
+        if task is None:
+            # задача отправлена в обход /huge_summarize - заводим запись на месте
+            task = TaskRecord(task_id=task_id, queued_at=datetime.datetime.utcnow())
+            session.add(task)
+        now = datetime.datetime.utcnow()
+        task.status = status
+        if status == "started":
+            task.started_at = now
+        elif status in TASK_FINAL_STATUSES:
+            task.finished_at = now
+        if result is not None:
+            task.result, task.result_compressed = encode_task_result(result)
+        if error is not None:
+            task.error = error
+        session.commit()
+    finally:
+        session.close()
+
+@stage("db_task_update")
+def update_task_progress(task_id: str, progress: str):
+    """
+    записывает прогресс задачи (например "map 3/12") в запись задачи
+    """
     session = SessionLocal()
-    log = session.query(RequestLog).filter_by(task_id=task_id).first()
-    if log:
-        log.status = status
+    try:
+        session.query(TaskRecord).filter_by(task_id=task_id).update({"progress": progress}, synchronize_session=False)
         session.commit()
-    session.close()
+    finally:
+        session.close()
 
-def get_task_status(task_id: str):
+@stage("db_task_read")
+def get_task(task_id: str, with_result: bool = True):
     """
-    Получает статус задачи по task_id из базы данных.
+    Получает задачу по task_id: статус, прогресс, время стадий и (для завершённой) результат.
+    returns:
+        dict или None, если задачи нет
     """
     session = SessionLocal()
-    log = session.query(RequestLog).filter_by(task_id=task_id).first()
-    session.close()
-    
-    if log:
-        return log.status
-    return None  
+    try:
+        task = session.query(TaskRecord).filter_by(task_id=task_id).first()
+        if task is None:
+            return None
+        info = {
+            "status": task.status,
+            "progress": task.progress,
+            "queued_at": task.queued_at.isoformat() if task.queued_at else None,
+            "started_at": task.started_at.isoformat() if task.started_at else None,
+            "finished_at": task.finished_at.isoformat() if task.finished_at else None,
+        }
+        if task.status == "error":
+            info["error"] = task.error
+        if with_result and task.status == "completed":
+            info["result"] = decode_task_result(task.result, task.result_compressed)
+        return info
+    finally:
+        session.close()
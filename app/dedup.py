@@ -0,0 +1,149 @@
+import itertools
+import logging
+import zlib
+
+import numpy as np
+from prometheus_client import Counter
+
+from app.config import DEDUP_ENABLED, DEDUP_THRESHOLD, DEDUP_NUM_PERM, DEDUP_BANDS, DEDUP_SHINGLE_SIZE
+from app.models import text_preproc_batch
+from app.result_cache import normalize_review
+from app.observability import stage, PIPELINE_REVIEWS
+
+DEDUP_COLLAPSED = Counter(
+    "dedup_collapsed_reviews_total", "Reviews collapsed into an earlier duplicate", ["kind"]
+)
+
+def collapse_exact(reviews, weights=None):
+    """
+    схлопывает точные дубликаты (с точностью до пробелов и регистра), оставляя первое вхождение.
+    weights - сколько раз каждый отзыв уже встретился (если дубликаты схлопнуты раньше, например при загрузке).
+    reviews может быть итератором: он читается один раз, в памяти остаются только уникальные отзывы
+
+    returns:
+        (list of str, list of int): уникальные отзывы и сколько раз каждый встретился
+    """
+    if weights is None:
+        weights = itertools.repeat(1)
+    first = {}
+    unique, counts = [], []
+    for review, weight in zip(reviews, weights):
+        key = normalize_review(review)
+        if key in first:
+            counts[first[key]] += weight
+            continue
+        first[key] = len(unique)
+        unique.append(review)
+        counts.append(weight)
+    return unique, counts
+
+
+def _shingles(lemma: str, size: int):
+    words = lemma.split()
+    if len(words) < size:
+        grams = [' '.join(words)] if words else []
+    else:
+        grams = [' '.join(words[i:i + size]) for i in range(len(words) - size + 1)]
+    return {zlib.crc32(gram.encode("utf-8")) for gram in grams}
+
+
+def minhash_signatures(lemmas, num_perm: int = DEDUP_NUM_PERM, shingle_size: int = DEDUP_SHINGLE_SIZE, seed: int = 1):
+    """
+    MinHash-подписи по шинглам из shingle_size лемм (для коротких текстов - весь текст одним шинглом)
+
+    returns:
+        (np.ndarray, np.ndarray): подписи (n, num_perm) uint64 и маска текстов, у которых есть хотя бы один шингл
+    """
+    rng = np.random.RandomState(seed)
+    # multiply-add-shift: (a*x + b) mod 2^64 (переполнение uint64), старшие 32 бита; a нечётное.
+    # при a*x + b меньше модуля хэш монотонен по x - все "перестановки" выбирали бы один и тот же шингл
+    a = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+    b = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+    signatures = np.full((len(lemmas), num_perm), np.iinfo(np.uint64).max, dtype=np.uint64)
+    has_shingles = np.zeros(len(lemmas), dtype=bool)
+    for i, lemma in enumerate(lemmas):
+        shingles = _shingles(lemma, shingle_size)
+        if not shingles:
+            continue
+        x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        signatures[i] = ((np.outer(x, a) + b) >> np.uint64(32)).min(axis=0)
+        has_shingles[i] = True
+    return signatures, has_shingles
+
+
+def collapse_near(lemmas, weights=None, threshold: float = DEDUP_THRESHOLD, num_perm: int = DEDUP_NUM_PERM,
+                  bands: int = DEDUP_BANDS, shingle_size: int = DEDUP_SHINGLE_SIZE, return_groups: bool = False):
+    """
+    схлопывает почти-дубликаты: кандидаты ищутся LSH по полосам MinHash-подписей,
+    пара объединяется, если оценка Жаккара по подписям не ниже threshold.
+    в группе остаётся первый текст, его вес - сумма весов группы
+
+    returns:
+        (list of int, list of int): индексы оставшихся текстов (по возрастанию) и их веса;
+        с return_groups=True третьим - индекс оставшегося текста группы для каждого текста
+    """
+    n = len(lemmas)
+    weights = list(weights) if weights is not None else [1] * n
+    if n < 2:
+        return (list(range(n)), weights, list(range(n))) if return_groups else (list(range(n)), weights)
+    signatures, has_shingles = minhash_signatures(lemmas, num_perm, shingle_size)
+    rows = num_perm // bands
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    indices = np.flatnonzero(has_shingles)
+    for band in range(bands):
+        chunk = np.ascontiguousarray(signatures[indices, band * rows:(band + 1) * rows])
+        keys = chunk.view(np.dtype((np.void, chunk.dtype.itemsize * rows))).ravel()
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        # кандидат сравнивается с первым текстом своей корзины, а не со всеми парами
+        leaders = indices[first[inverse.ravel()]]
+        candidates = np.flatnonzero(leaders != indices)
+        if not len(candidates):
+            continue
+        similarity = (signatures[leaders[candidates]] == signatures[indices[candidates]]).mean(axis=1)
+        for leader, i in zip(leaders[candidates][similarity >= threshold], indices[candidates][similarity >= threshold]):
+            root_leader, root = find(int(leader)), find(int(i))
+            if root_leader != root:
+                parent[max(root_leader, root)] = min(root_leader, root)
+
+    group_weight = {}
+    groups = [find(i) for i in range(n)]
+    for i, root in enumerate(groups):
+        group_weight[root] = group_weight.get(root, 0) + weights[i]
+    keep = sorted(group_weight)
+    if return_groups:
+        return keep, [group_weight[i] for i in keep], groups
+    return keep, [group_weight[i] for i in keep]
+
+
+@stage("dedup")
+def dedup_reviews(reviews, stop_words, enabled: bool = DEDUP_ENABLED, weights=None):
+    """
+    лемматизация со схлопыванием дубликатов: сначала точные дубликаты (до лемматизации),
+    потом почти-дубликаты по леммам. все следующие стадии работают с меньшим набором,
+    а веса (сколько исходных отзывов стоит за каждым оставшимся) сохраняют размеры тем и частоты слов
+
+    weights (list of int, optional): начальные веса отзывов (например, от collapse_exact при чтении загрузки файлом)
+
+    returns:
+        (list of str, list of str, list of int): отзывы, их леммы и веса
+    """
+    total = len(reviews) if weights is None else sum(weights)
+    PIPELINE_REVIEWS.labels(phase="input").observe(total)
+    if not enabled:
+        weights = [1] * len(reviews) if weights is None else list(weights)
+        return reviews, text_preproc_batch(reviews, stop_words=stop_words), weights
+    unique, weights = collapse_exact(reviews, weights)
+    lemmas = text_preproc_batch(unique, stop_words=stop_words)
+    keep, weights = collapse_near(lemmas, weights)
+    PIPELINE_REVIEWS.labels(phase="deduped").observe(len(keep))
+    DEDUP_COLLAPSED.labels(kind="exact").inc(total - len(unique))
+    DEDUP_COLLAPSED.labels(kind="near").inc(len(unique) - len(keep))
+    logging.info(f"Dedup: {total} reviews -> {len(unique)} unique -> {len(keep)} after near-duplicates")
+    return [unique[i] for i in keep], [lemmas[i] for i in keep], weights
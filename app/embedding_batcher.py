@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+from prometheus_client import Gauge, Histogram
+
+from app.config import EMBED_MAX_BATCH, EMBED_MAX_WAIT_MS, EMBED_FORWARD_BATCH
+
+EMBED_BATCH_SIZE = Histogram(
+    "embedding_batch_size", "Texts encoded in one micro-batch (across concurrent requests)",
+    buckets=(1, 8, 16, 32, 64, 128, 256, 512, 1024),
+)
+EMBED_BATCH_REQUESTS = Histogram(
+    "embedding_batch_requests", "Caller requests merged into one micro-batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+EMBED_QUEUE_WAIT = Histogram(
+    "embedding_queue_wait_seconds", "Time an encode request waited before its micro-batch started",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+EMBED_QUEUE_DEPTH = Gauge(
+    "embedding_queue_depth", "Texts waiting to be encoded"
+)
+
+
+def _token_lengths(model, texts):
+    """
+    число токенов каждого текста токенизатором модели (HF-токенизатор SentenceTransformer
+    или tokenizers.Tokenizer у OnnxEmbedder); без токенизатора - длина в символах
+    """
+    tokenizer = getattr(model, "tokenizer", None)
+    if tokenizer is None:
+        return [len(text) for text in texts]
+    if hasattr(tokenizer, "encode_batch"):
+        return [len(encoding.ids) for encoding in tokenizer.encode_batch(texts)]
+    max_length = getattr(model, "max_seq_length", None)
+    ids = tokenizer(texts, add_special_tokens=False, truncation=max_length is not None, max_length=max_length)
+    return [len(row) for row in ids["input_ids"]]
+
+
+class _Job:
+    __slots__ = ("texts", "future", "enqueued")
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.future = Future()
+        self.enqueued = time.monotonic()
+
+
+class EmbeddingBatcher:
+    """
+    общий на процесс кодировщик: encode() из разных потоков (запросы API в pipeline_executor,
+    map-reduce, задачи Celery) складываются в одну очередь и кодируются общими пачками
+
+    - пачка собирается до max_batch текстов или max_wait_ms от самого старого запроса
+    - запрос больше max_batch режется на части, чтобы не задерживать мелкие запросы за ним
+    - тексты пачки сортируются по числу токенов (токенизатором самой модели) и отдаются модели
+      кусками по forward_batch: в куске тексты близкой длины, паддинг минимален. SentenceTransformer.encode
+      сам пересортировывает вход по символам, поэтому куски и передаются ему по отдельности
+    - каждому вызывающему возвращается его срез
+    - интерфейс как у SentenceTransformer.encode, поэтому подставляется в encode_with_store вместо модели
+    """
+
+    def __init__(self, model_loader, max_batch: int = EMBED_MAX_BATCH, max_wait_ms: int = EMBED_MAX_WAIT_MS,
+                 forward_batch: int = EMBED_FORWARD_BATCH):
+        self.model_loader = model_loader
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.forward_batch = forward_batch
+        self._queue = deque()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def _ensure_thread(self):
+        # поток не переживает fork - в каждом процессе запускаем свой
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue.clear()
+            self._pending = 0
+            threading.Thread(target=self._run, name="embedding-batcher", daemon=True).start()
+
+    def get_sentence_embedding_dimension(self):
+        return self.model_loader().get_sentence_embedding_dimension()
+
+    def encode(self, texts, batch_size: int = None, show_progress_bar: bool = False):
+        """
+        кодирует тексты в общей пачке с другими вызовами; batch_size и show_progress_bar
+        принимаются для совместимости с SentenceTransformer и игнорируются
+
+        returns:
+            np.ndarray: матрица (len(texts), dim) в порядке texts
+        """
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        jobs = [_Job(texts[i:i + self.max_batch]) for i in range(0, len(texts), self.max_batch)]
+        with self._cond:
+            self._ensure_thread()
+            self._queue.extend(jobs)
+            self._pending += len(texts)
+            EMBED_QUEUE_DEPTH.set(self._pending)
+            self._cond.notify()
+        return np.concatenate([job.future.result() for job in jobs])
+
+    def _collect(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            deadline = self._queue[0].enqueued + self.max_wait
+            while self._pending < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            jobs, size = [], 0
+            while self._queue and (not jobs or size + len(self._queue[0].texts) <= self.max_batch):
+                job = self._queue.popleft()
+                jobs.append(job)
+                size += len(job.texts)
+            self._pending -= size
+            EMBED_QUEUE_DEPTH.set(self._pending)
+            return jobs
+
+    def _encode_jobs(self, jobs):
+        started = time.monotonic()
+        for job in jobs:
+            EMBED_QUEUE_WAIT.observe(started - job.enqueued)
+        texts = [text for job in jobs for text in job.texts]
+        model = self.model_loader()
+        lengths = _token_lengths(model, texts)
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        vectors = np.concatenate([
+            np.asarray(model.encode(
+                [texts[i] for i in order[start:start + self.forward_batch]],
+                batch_size=self.forward_batch, show_progress_bar=False,
+            ))
+            for start in range(0, len(order), self.forward_batch)
+        ])
+        EMBED_BATCH_SIZE.observe(len(texts))
+        EMBED_BATCH_REQUESTS.observe(len(jobs))
+        result = np.empty_like(vectors)
+        result[order] = vectors
+        offset = 0
+        for job in jobs:
+            job.future.set_result(result[offset:offset + len(job.texts)])
+            offset += len(job.texts)
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            try:
+                self._encode_jobs(jobs)
+            except Exception as err:
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(err)
@@ -0,0 +1,269 @@
+import os
+import time
+import uuid
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from app.config import EMBEDDING_STORE_SEGMENT_ROWS, EMBEDDING_STORE_MAX_OPEN_SEGMENTS
+from app.observability import stage, EMBEDDING_STORE_LOOKUPS
+
+# как часто сверять открытые memmap'ы с индексом (сегменты вытесняют и другие процессы)
+PRUNE_INTERVAL = 60
+
+
+class EmbeddingStore:
+    """
+    контентно-адресуемое хранилище эмбеддингов отзывов на локальном диске
+
+    - ключ: blake2b(имя модели + лемматизированный текст), не зависит от процесса и перезапусков
+    - векторы лежат в сегментах float16 и читаются через np.memmap, поэтому страницы делят все процессы ноды
+      (воркеры gunicorn и Celery). небольшие пачки дописываются в открытый сегмент процесса,
+      пока в нём меньше segment_rows строк; пачка не меньше segment_rows - отдельный сегмент
+    - индекс key -> (сегмент, строка) в SQLite рядом с сегментами
+    - вытеснение по бюджету байт: удаляются сегменты, к которым дольше всего не обращались
+    - открыто не больше max_open_segments memmap'ов (LRU); memmap'ы сегментов, пропавших из индекса
+      (вытеснены в другом процессе), закрываются - не держим дескрипторы и адреса удалённых файлов
+    """
+
+    def __init__(self, path: str, model_name: str, max_bytes: int, segment_rows: int = EMBEDDING_STORE_SEGMENT_ROWS,
+                 max_open_segments: int = EMBEDDING_STORE_MAX_OPEN_SEGMENTS):
+        self.path = path
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.segment_rows = segment_rows
+        self.max_open_segments = max_open_segments
+        self._local = threading.local()
+        self._mmaps = OrderedDict()
+        self._mmaps_lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+        # открытый для дописывания сегмент процесса: (pid, имя, строк, dim)
+        self._open_segment = None
+        self._write_lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "name TEXT PRIMARY KEY, rows INTEGER, dim INTEGER, bytes INTEGER, last_access REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, segment TEXT, row INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_segment ON entries (segment)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def key(self, text: str) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model_name.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _segment(self, name: str, rows: int, dim: int):
+        with self._mmaps_lock:
+            mm = self._mmaps.get(name)
+            # в открытый сегмент дописывают - memmap старой длины не видит новых строк
+            if mm is None or mm.shape[0] < rows:
+                mm = np.memmap(os.path.join(self.path, name), dtype=np.float16, mode="r", shape=(rows, dim))
+                self._mmaps[name] = mm
+            self._mmaps.move_to_end(name)
+            while len(self._mmaps) > self.max_open_segments:
+                self._mmaps.popitem(last=False)
+            return mm
+
+    def _drop_segments(self, names):
+        with self._mmaps_lock:
+            for name in names:
+                self._mmaps.pop(name, None)
+
+    def _prune_segments(self, conn):
+        """
+        закрывает memmap'ы сегментов, которых больше нет в индексе
+        """
+        if time.monotonic() - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = time.monotonic()
+        alive = {row[0] for row in conn.execute("SELECT name FROM segments")}
+        with self._mmaps_lock:
+            gone = [name for name in self._mmaps if name not in alive]
+        self._drop_segments(gone)
+
+    def get_many(self, texts):
+        """
+        возвращает словарь {индекс текста: вектор float16} для найденных в хранилище текстов
+        """
+        keys = [self.key(t) for t in texts]
+        positions = {}
+        for i, k in enumerate(keys):
+            positions.setdefault(k, []).append(i)
+
+        conn = self._connect()
+        self._prune_segments(conn)
+        found = {}
+        uniq = list(positions)
+        for i in range(0, len(uniq), 500):
+            chunk = uniq[i:i + 500]
+            rows = conn.execute(
+                "SELECT e.key, e.segment, e.row, s.rows, s.dim FROM entries e "
+                "JOIN segments s ON s.name = e.segment "
+                f"WHERE e.key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            found.update({r[0]: r[1:] for r in rows})
+
+        result = {}
+        touched = set()
+        for k, (segment, row, seg_rows, dim) in found.items():
+            try:
+                vector = self._segment(segment, seg_rows, dim)[row]
+            except (OSError, ValueError):
+                # сегмент успели вытеснить в другом процессе
+                self._drop_segments([segment])
+                continue
+            touched.add(segment)
+            for i in positions[k]:
+                result[i] = vector
+
+        if touched:
+            with conn:
+                conn.executemany(
+                    "UPDATE segments SET last_access = ? WHERE name = ?",
+                    [(time.time(), name) for name in touched],
+                )
+        return result
+
+    def _new_segment(self, conn, texts, vectors):
+        rows, dim = vectors.shape
+        name = f"seg-{uuid.uuid4().hex}.f16"
+        tmp_path = os.path.join(self.path, name + ".tmp")
+        vectors.tofile(tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, name))
+        with conn:
+            conn.execute(
+                "INSERT INTO segments (name, rows, dim, bytes, last_access) VALUES (?, ?, ?, ?, ?)",
+                (name, rows, dim, vectors.nbytes, time.time()),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, segment, row) VALUES (?, ?, ?)",
+                [(self.key(t), name, i) for i, t in enumerate(texts)],
+            )
+        return name
+
+    def _append(self, conn, texts, vectors) -> bool:
+        """
+        дописывает векторы в открытый сегмент процесса; False - если его нет, он заполнен или вытеснен
+        """
+        if self._open_segment is None:
+            return False
+        pid, name, rows, dim = self._open_segment
+        if pid != os.getpid() or dim != vectors.shape[1] or rows + len(vectors) > self.segment_rows:
+            return False
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            return False
+        with open(path, "ab") as f:
+            vectors.tofile(f)
+        with conn:
+            # строки становятся видны другим процессам только вместе с новой длиной сегмента
+            updated = conn.execute(
+                "UPDATE segments SET rows = ?, bytes = ?, last_access = ? WHERE name = ? AND rows = ?",
+                (rows + len(vectors), (rows + len(vectors)) * dim * 2, time.time(), name, rows),
+            ).rowcount
+            if updated:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO entries (key, segment, row) VALUES (?, ?, ?)",
+                    [(self.key(t), name, rows + i) for i, t in enumerate(texts)],
+                )
+        if not updated:
+            # сегмент вытеснили в другом процессе, пока писали - файл уже никому не нужен
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return False
+        self._open_segment = (pid, name, rows + len(vectors), dim)
+        return True
+
+    def put_many(self, texts, vectors):
+        """
+        сохраняет векторы (небольшие пачки - в открытый сегмент процесса) и при необходимости
+        вытесняет старые сегменты
+        """
+        if len(texts) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float16)
+        rows, dim = vectors.shape
+        conn = self._connect()
+        if rows >= self.segment_rows:
+            self._new_segment(conn, texts, vectors)
+        else:
+            with self._write_lock:
+                if not self._append(conn, texts, vectors):
+                    name = self._new_segment(conn, texts, vectors)
+                    self._open_segment = (os.getpid(), name, rows, dim)
+        self._evict()
+
+    def _evict(self):
+        conn = self._connect()
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM segments").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        victims = []
+        for name, size in conn.execute("SELECT name, bytes FROM segments ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            victims.append(name)
+            total -= size
+        with conn:
+            conn.executemany("DELETE FROM entries WHERE segment = ?", [(n,) for n in victims])
+            conn.executemany("DELETE FROM segments WHERE name = ?", [(n,) for n in victims])
+        self._drop_segments(victims)
+        for name in victims:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+        logging.info(f"Embedding store evicted {len(victims)} segments")
+
+
+def encode_with_store(model, texts, store: EmbeddingStore, batch_size: int = 64):
+    """
+    кодирует тексты, переиспользуя сохранённые векторы: модель считает только новые уникальные тексты
+
+    returns:
+        np.ndarray: матрица float32 (n_texts, dim); все векторы прошли через float16,
+        поэтому результат не зависит от того, были они в хранилище или нет
+    """
+    texts = list(texts)
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    found = store.get_many(texts)
+    missing = list(dict.fromkeys(t for i, t in enumerate(texts) if i not in found))
+    logging.info(f"Embedding store: {len(found)} hits, {len(missing)} to encode")
+    EMBEDDING_STORE_LOOKUPS.labels(result="hit").inc(len(found))
+    EMBEDDING_STORE_LOOKUPS.labels(result="miss").inc(len(missing))
+
+    fresh = {}
+    if missing:
+        with stage("encode"):
+            vectors = model.encode(missing, show_progress_bar=False, batch_size=batch_size)
+        vectors = np.asarray(vectors, dtype=np.float16)
+        store.put_many(missing, vectors)
+        fresh = dict(zip(missing, vectors))
+
+    return np.stack([
+        found[i] if i in found else fresh[t] for i, t in enumerate(texts)
+    ]).astype(np.float32)
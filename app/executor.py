@@ -0,0 +1,127 @@
+import asyncio
+import contextvars
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from app.config import PIPELINE_WORKERS, PIPELINE_QUEUE_SIZE
+
+PIPELINE_QUEUE_DEPTH = Gauge(
+    "pipeline_queue_depth", "Pipeline jobs waiting for a free executor thread"
+)
+PIPELINE_IN_FLIGHT = Gauge(
+    "pipeline_in_flight", "Pipeline jobs admitted (queued + running)"
+)
+PIPELINE_QUEUE_WAIT = Histogram(
+    "pipeline_queue_wait_seconds", "Time a pipeline job waited before it started running",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+PIPELINE_REJECTED = Counter(
+    "pipeline_rejected_total", "Pipeline jobs rejected because the queue was full"
+)
+
+
+class PipelineOverloaded(Exception):
+    """
+    очередь CPU-задач заполнена; retry_after - через сколько секунд имеет смысл повторить
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Сервис перегружен, повторите через {retry_after} с")
+        self.retry_after = retry_after
+
+
+class PipelineExecutor:
+    """
+    пул потоков для CPU-тяжёлых стадий (лемматизация, эмбеддинги, BERTopic, когерентность),
+    чтобы они не блокировали event loop FastAPI
+
+    перед пулом ограниченная очередь: одновременно принимается не больше workers + queue_size задач,
+    остальные сразу получают PipelineOverloaded (хэндлер отвечает 503 + Retry-After).
+    потоки, а не процессы: модели (Mystem, SentenceTransformer) загружены один раз на процесс
+    """
+
+    def __init__(self, workers: int = PIPELINE_WORKERS, queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self._pool = None
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self._queued = 0
+        self._avg_duration = 5.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pipeline")
+            return self._pool
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_duration * self._admitted / self.workers))
+
+    def _admit(self):
+        with self._lock:
+            if self._admitted >= self.capacity:
+                PIPELINE_REJECTED.inc()
+                raise PipelineOverloaded(self._retry_after())
+            self._admitted += 1
+            self._queued += 1
+            PIPELINE_IN_FLIGHT.set(self._admitted)
+            PIPELINE_QUEUE_DEPTH.set(self._queued)
+
+    def _release(self, future):
+        # колбэк срабатывает, когда задача реально завершилась (или была отменена до старта),
+        # а не когда клиент перестал ждать ответ
+        with self._lock:
+            self._admitted -= 1
+            if future.cancelled():
+                self._queued -= 1
+                PIPELINE_QUEUE_DEPTH.set(self._queued)
+            PIPELINE_IN_FLIGHT.set(self._admitted)
+
+    def _wrap(self, fn, args, kwargs, submitted_at: float):
+        started_at = time.monotonic()
+        with self._lock:
+            self._queued -= 1
+            PIPELINE_QUEUE_DEPTH.set(self._queued)
+        PIPELINE_QUEUE_WAIT.observe(started_at - submitted_at)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            duration = time.monotonic() - started_at
+            with self._lock:
+                self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        выполняет fn(*args, **kwargs) в пуле и ждёт результата, не блокируя event loop
+
+        raises:
+            PipelineOverloaded: если очередь заполнена
+        """
+        self._admit()
+        try:
+            # контекст (trace_id) переносится в поток пула
+            context = contextvars.copy_context()
+            future = self._get_pool().submit(context.run, self._wrap, fn, args, kwargs, time.monotonic())
+        except Exception:
+            with self._lock:
+                self._admitted -= 1
+                self._queued -= 1
+            raise
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                logging.info("Shutting down pipeline executor")
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+
+pipeline_executor = PipelineExecutor()
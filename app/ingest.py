@@ -0,0 +1,299 @@
+import codecs
+import csv
+import hashlib
+import json
+import logging
+import zlib
+from collections import Counter, namedtuple
+
+from prometheus_client import Counter as MetricCounter
+
+from app.config import (
+    INGEST_MAX_BYTES, INGEST_MAX_LINE_BYTES, INGEST_MAX_REVIEW_CHARS, INGEST_MAX_REVIEWS, INGEST_MAX_SEEN_IDS
+)
+from app.result_cache import normalize_review
+
+INGEST_RECORDS = MetricCounter(
+    "ingest_records_total", "Uploaded review records by outcome", ["outcome"]
+)
+
+INGEST_FORMATS = ("ndjson", "csv")
+TEXT_FIELDS = ("text", "review", "comment")
+ID_FIELDS = ("review_id", "id")
+DECOMPRESS_CHUNK = 1 << 20
+
+ReviewRecord = namedtuple("ReviewRecord", ["text", "product_id", "rating"])
+
+
+class InvalidUpload(ValueError):
+    """
+    загрузку нельзя принять целиком: битый gzip/UTF-8, нет колонки с текстом, превышен размер и т.п.
+    """
+
+
+class TooManyReviews(InvalidUpload):
+    """
+    уникальных отзывов больше, чем синхронный путь держит в памяти
+    """
+
+
+def upload_format(fmt: str = None, content_type: str = "") -> str:
+    """
+    формат загрузки: явный параметр, иначе по Content-Type (text/csv - csv, остальное - ndjson)
+    """
+    fmt = fmt or ("csv" if "csv" in (content_type or "") else "ndjson")
+    if fmt not in INGEST_FORMATS:
+        raise InvalidUpload(f"format должен быть одним из {list(INGEST_FORMATS)}, а не '{fmt}'")
+    return fmt
+
+
+def _longer_than(parts, limit: int) -> bool:
+    """
+    длиннее ли limit байт в UTF-8 строки parts вместе: символ занимает от 1 до 4 байт,
+    поэтому кодировать приходится только в пограничном случае
+    """
+    chars = sum(len(part) for part in parts)
+    if chars > limit:
+        return True
+    if chars * 4 <= limit:
+        return False
+    return sum(len(part.encode("utf-8")) for part in parts) > limit
+
+
+def _first(record: dict, fields):
+    for field in fields:
+        value = record.get(field)
+        if value not in (None, ""):
+            return value
+    return None
+
+
+def validate_record(record):
+    """
+    проверяет запись загрузки
+
+    returns:
+        (ReviewRecord или None, str): запись (текст с нормализованными пробелами, без переводов строк)
+        или None и причина отказа
+    """
+    if not isinstance(record, dict):
+        return None, "not_object"
+    text = _first(record, TEXT_FIELDS)
+    if not isinstance(text, str) or not text.strip():
+        return None, "no_text"
+    # отзыв - одна строка: дальше конвейер и хранилище payload'ов построчные
+    text = ' '.join(text.split())
+    if len(text) > INGEST_MAX_REVIEW_CHARS:
+        return None, "too_long"
+    rating = record.get("rating")
+    if rating in (None, ""):
+        rating = None
+    else:
+        try:
+            rating = float(rating)
+        except (TypeError, ValueError):
+            return None, "bad_rating"
+        if not 1 <= rating <= 5:
+            return None, "bad_rating"
+    product_id = record.get("product_id")
+    product_id = None if product_id in (None, "") else str(product_id).strip()
+    return ReviewRecord(text, product_id, rating), None
+
+
+class UploadParser:
+    """
+    инкрементальный разбор загрузки из потока байт: feed(chunk) по мере чтения тела запроса, в конце close()
+
+    - gzip определяется по сигнатуре и распаковывается кусками не больше DECOMPRESS_CHUNK
+      (вместе с лимитом max_bytes - защита от gzip-бомб); несколько gzip-членов подряд тоже читаются
+    - ndjson: объект на строку; csv: первая запись - заголовок, поля в кавычках могут содержать переводы строк
+    - в памяти только незаконченная строка (не длиннее INGEST_MAX_LINE_BYTES в UTF-8)
+    - невалидные записи пропускаются и считаются в invalid по причинам
+    - записи с повторяющимся review_id/id (в пределах product_id) отбрасываются как дубликаты;
+      помнятся хэши первых max_seen_ids id, дальше повторы id доходят до конвейера и схлопываются там по тексту
+    - product_id задан - берутся только записи этого товара (и записи без product_id);
+      не задан - в загрузке не должно быть больше одного товара
+    """
+
+    def __init__(self, fmt: str = "ndjson", product_id: str = None, max_bytes: int = INGEST_MAX_BYTES,
+                 max_seen_ids: int = INGEST_MAX_SEEN_IDS):
+        self.fmt = upload_format(fmt)
+        self.product_id = product_id
+        self.max_bytes = max_bytes
+        self.max_seen_ids = max_seen_ids
+        self.bytes_read = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.other_products = 0
+        self.invalid = Counter()
+        self.ratings = Counter()
+        self._head = b""
+        self._gzip = None
+        self._decompressor = None
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._tail = ""
+        self._pending = []
+        self._columns = None
+        self._seen_ids = set()
+        self._products = set()
+
+    def _decompress(self, chunk: bytes, final: bool = False):
+        if self._gzip is None:
+            self._head += chunk
+            if len(self._head) < 2 and not final:
+                return
+            self._gzip = self._head.startswith(b"\x1f\x8b")
+            chunk, self._head = self._head, b""
+        if not self._gzip:
+            yield chunk
+            return
+        try:
+            while chunk:
+                if self._decompressor is None:
+                    self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                yield self._decompressor.decompress(chunk, DECOMPRESS_CHUNK)
+                chunk = self._decompressor.unconsumed_tail
+                if not chunk and self._decompressor.eof:
+                    # следующий gzip-член (cat a.gz b.gz)
+                    chunk = self._decompressor.unused_data
+                    self._decompressor = None
+            if final and self._decompressor is not None:
+                yield self._decompressor.flush()
+                if not self._decompressor.eof:
+                    raise InvalidUpload("gzip-поток оборван")
+        except zlib.error as err:
+            raise InvalidUpload(f"Некорректный gzip: {err}")
+
+    def _lines(self, data: bytes, final: bool = False):
+        self.bytes_read += len(data)
+        if self.bytes_read > self.max_bytes:
+            raise InvalidUpload(f"Загрузка больше {self.max_bytes} байт после распаковки")
+        try:
+            self._tail += self._decoder.decode(data, final=final)
+        except UnicodeDecodeError as err:
+            raise InvalidUpload(f"Загрузка не в UTF-8: {err}")
+        lines = self._tail.split("\n")
+        self._tail = "" if final else lines.pop()
+        if _longer_than([self._tail], INGEST_MAX_LINE_BYTES):
+            raise InvalidUpload(f"Строка длиннее {INGEST_MAX_LINE_BYTES} байт")
+        for line in lines:
+            yield line.rstrip("\r")
+
+    def _records(self, line: str):
+        if self.fmt == "ndjson":
+            if not line.strip():
+                return
+            try:
+                yield json.loads(line)
+            except ValueError:
+                self.invalid["bad_json"] += 1
+                INGEST_RECORDS.labels(outcome="invalid").inc()
+            return
+        # csv: запись закончена, когда кавычки сбалансированы (внутри полей они удвоены)
+        self._pending.append(line + "\n")
+        if sum(part.count('"') for part in self._pending) % 2:
+            if _longer_than(self._pending, INGEST_MAX_LINE_BYTES):
+                raise InvalidUpload(f"CSV-запись длиннее {INGEST_MAX_LINE_BYTES} байт")
+            return
+        pending, self._pending = self._pending, []
+        row = next(csv.reader(pending), None)
+        if not row or not any(cell.strip() for cell in row):
+            return
+        if self._columns is None:
+            self._columns = [cell.strip().lower() for cell in row]
+            if not set(TEXT_FIELDS) & set(self._columns):
+                raise InvalidUpload(f"В заголовке CSV нет колонки с текстом отзыва ({', '.join(TEXT_FIELDS)})")
+            return
+        yield dict(zip(self._columns, row))
+
+    def _accept(self, raw):
+        record, reason = validate_record(raw)
+        if record is None:
+            self.invalid[reason] += 1
+            INGEST_RECORDS.labels(outcome="invalid").inc()
+            return None
+        if self.product_id is not None:
+            if record.product_id is not None and record.product_id != self.product_id:
+                self.other_products += 1
+                return None
+        elif record.product_id is not None and len(self._products) < 2:
+            self._products.add(record.product_id)
+        review_id = _first(raw, ID_FIELDS)
+        if review_id is not None:
+            key = hash((record.product_id, str(review_id)))
+            if key in self._seen_ids:
+                self.duplicates += 1
+                INGEST_RECORDS.labels(outcome="duplicate").inc()
+                return None
+            if len(self._seen_ids) < self.max_seen_ids:
+                self._seen_ids.add(key)
+                if len(self._seen_ids) == self.max_seen_ids:
+                    logging.warning(f"Upload has more than {self.max_seen_ids} review ids, "
+                                    f"further repeated ids are collapsed by text only")
+        self.accepted += 1
+        if record.rating is not None:
+            self.ratings[record.rating] += 1
+        INGEST_RECORDS.labels(outcome="accepted").inc()
+        return record
+
+    def _parse(self, chunk: bytes, final: bool = False):
+        for data in self._decompress(chunk, final=final):
+            for line in self._lines(data):
+                for raw in self._records(line):
+                    record = self._accept(raw)
+                    if record is not None:
+                        yield record
+
+    def feed(self, chunk: bytes):
+        """
+        генератор принятых записей из очередного куска тела запроса
+        """
+        yield from self._parse(chunk)
+
+    def close(self):
+        """
+        генератор оставшихся записей; проверяет, что загрузка закончилась целой
+        """
+        yield from self._parse(b"", final=True)
+        for line in self._lines(b"", final=True):
+            for raw in self._records(line):
+                record = self._accept(raw)
+                if record is not None:
+                    yield record
+        if self._pending:
+            raise InvalidUpload("CSV оборван внутри поля в кавычках")
+        if len(self._products) > 1:
+            raise InvalidUpload("В загрузке отзывы нескольких товаров - укажите параметр product_id")
+        if not self.accepted:
+            raise InvalidUpload("В загрузке нет ни одного корректного отзыва")
+
+    def stats(self) -> dict:
+        return {
+            "accepted": self.accepted,
+            "invalid": dict(self.invalid),
+            "duplicates": self.duplicates,
+            "other_products": self.other_products,
+            "ratings": {f"{rating:g}": count for rating, count in sorted(self.ratings.items())},
+            "bytes": self.bytes_read,
+        }
+
+
+class UniqueReviewLimit:
+    """
+    считает уникальные отзывы загрузки по мере поступления (с той же нормализацией, что collapse_exact);
+    больше max_reviews - TooManyReviews. тексты не хранятся - только 16-байтные хэши
+    """
+
+    def __init__(self, max_reviews: int = INGEST_MAX_REVIEWS):
+        self.max_reviews = max_reviews
+        self._seen = set()
+
+    def add(self, text: str):
+        key = hashlib.blake2b(normalize_review(text).encode("utf-8"), digest_size=16).digest()
+        if key in self._seen:
+            return
+        if len(self._seen) >= self.max_reviews:
+            raise TooManyReviews(
+                f"Больше {self.max_reviews} уникальных отзывов - используйте /upload/huge_summarize"
+            )
+        self._seen.add(key)
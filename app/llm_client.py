@@ -0,0 +1,253 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+
+import httpx
+
+from app.observability import (
+    LLM_LATENCY, LLM_QUEUE_WAIT, LLM_PROMPT_TOKENS, LLM_RETRIED, current_traceparent,
+)
+from app.config import (
+    VLLM_URL, VLLM_LORA_URL, LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT,
+    LLM_RETRIES, LLM_BACKOFF, LLM_MAX_CONCURRENCY, LLM_POOL_SIZE,
+)
+
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """
+    vLLM не ответил успешно за отведённое число попыток
+    """
+
+
+class LLMClient:
+    """
+    клиент к одному OpenAI-совместимому апстриму (vllm, vllm_lora)
+
+    - общий пул соединений на апстрим (keep-alive вместо нового TCP на каждый запрос)
+    - таймауты на подключение и чтение
+    - ограниченное число повторов с экспоненциальной задержкой и джиттером
+      на сетевых ошибках и 429/5xx
+    - не больше max_concurrency одновременных запросов к апстриму из процесса
+
+    chat() - для async-хэндлеров FastAPI, chat_sync() - фасад для задач Celery.
+    AsyncClient создаётся один раз на event loop приложения (open() при старте FastAPI, aclose() при остановке),
+    синхронный клиент - в каждом процессе воркера Celery (open_sync() после fork, close_sync() при остановке)
+    """
+
+    def __init__(self, name: str, base_url: str, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 connect_timeout: float = LLM_CONNECT_TIMEOUT, read_timeout: float = LLM_READ_TIMEOUT,
+                 retries: int = LLM_RETRIES, backoff: float = LLM_BACKOFF, pool_size: int = LLM_POOL_SIZE):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        # AsyncClient и Semaphore привязаны к event loop, на котором созданы (open())
+        self._async_client = None
+        self._semaphore = None
+        self._sync_client = None
+        self._sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._sync_lock = threading.Lock()
+
+    def _delay(self, attempt: int) -> float:
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def _check(self, response: httpx.Response):
+        if response.status_code in RETRY_STATUSES:
+            raise httpx.HTTPStatusError(
+                f"{self.name} returned {response.status_code}", request=response.request, response=response
+            )
+        if response.status_code != 200:
+            raise LLMError(f"{self.name} returned {response.status_code}: {response.text[:500]}")
+
+    @staticmethod
+    def _headers():
+        # трасса продолжается в vLLM (он принимает W3C traceparent)
+        traceparent = current_traceparent()
+        return {"traceparent": traceparent} if traceparent else None
+
+    def _observe_prompt(self, req_data: dict, body: dict = None):
+        usage = (body or {}).get("usage") or {}
+        tokens = usage.get("prompt_tokens")
+        if tokens is None:
+            # в потоковом ответе usage нет - оценка ~3 символа на токен
+            tokens = sum(len(m.get("content") or "") for m in req_data.get("messages", [])) // 3 + 1
+        LLM_PROMPT_TOKENS.labels(upstream=self.name).observe(tokens)
+
+    async def open(self):
+        """
+        создаёт AsyncClient и семафор на текущем event loop (старт FastAPI)
+        """
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _ensure_async(self):
+        if self._async_client is None:
+            raise RuntimeError(f"{self.name}: async client is not open, call open_llm_clients() on startup")
+        return self._async_client, self._semaphore
+
+    def _ensure_sync(self):
+        with self._sync_lock:
+            if self._sync_client is None:
+                self._sync_client = httpx.Client(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+            return self._sync_client
+
+    def open_sync(self):
+        """
+        новый синхронный клиент в процессе воркера: соединения, унаследованные через fork, не переиспользуются
+        """
+        with self._sync_lock:
+            self._sync_client = httpx.Client(base_url=self.base_url, timeout=self.timeout, limits=self.limits)
+
+    def close_sync(self):
+        with self._sync_lock:
+            if self._sync_client is not None:
+                self._sync_client.close()
+                self._sync_client = None
+
+    async def chat(self, req_data: dict) -> dict:
+        """
+        POST /v1/chat/completions, возвращает распарсенный JSON ответа
+        """
+        client, semaphore = self._ensure_async()
+        for attempt in range(self.retries + 1):
+            outcome = "error"
+            started = time.monotonic()
+            try:
+                async with semaphore:
+                    LLM_QUEUE_WAIT.labels(upstream=self.name).observe(time.monotonic() - started)
+                    started = time.monotonic()
+                    response = await client.post(CHAT_COMPLETIONS_PATH, json=req_data, headers=self._headers())
+                logging.info(f"{self.name} response: {response.status_code}")
+                self._check(response)
+                body = response.json()
+                outcome = "ok"
+                self._observe_prompt(req_data, body)
+                return body
+            except (httpx.TransportError, httpx.HTTPStatusError) as err:
+                if attempt == self.retries:
+                    raise LLMError(f"{self.name} failed after {attempt + 1} attempts: {err}") from err
+                outcome = "retry"
+                LLM_RETRIED.labels(upstream=self.name).inc()
+                logging.warning(f"{self.name} attempt {attempt + 1} failed: {err}")
+                await asyncio.sleep(self._delay(attempt))
+            finally:
+                LLM_LATENCY.labels(upstream=self.name, outcome=outcome).observe(time.monotonic() - started)
+
+    async def chat_stream(self, req_data: dict):
+        """
+        POST /v1/chat/completions со stream=true: асинхронный генератор текстовых дельт.
+        повторы только до получения первого байта ответа - начатый поток не перезапускается
+        """
+        client, semaphore = self._ensure_async()
+        req_data = {**req_data, "stream": True}
+        streaming = False
+        for attempt in range(self.retries + 1):
+            outcome = "error"
+            started = time.monotonic()
+            try:
+                async with semaphore:
+                    LLM_QUEUE_WAIT.labels(upstream=self.name).observe(time.monotonic() - started)
+                    started = time.monotonic()
+                    async with client.stream("POST", CHAT_COMPLETIONS_PATH, json=req_data,
+                                             headers=self._headers()) as response:
+                        logging.info(f"{self.name} stream response: {response.status_code}")
+                        if response.status_code != 200:
+                            await response.aread()
+                        self._check(response)
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            payload = line[len("data:"):].strip()
+                            if payload == "[DONE]":
+                                break
+                            choices = json.loads(payload).get("choices") or [{}]
+                            delta = choices[0].get("delta", {}).get("content")
+                            if delta:
+                                streaming = True
+                                yield delta
+                outcome = "ok"
+                self._observe_prompt(req_data)
+                return
+            except (httpx.TransportError, httpx.HTTPStatusError) as err:
+                if streaming or attempt == self.retries:
+                    raise LLMError(f"{self.name} failed after {attempt + 1} attempts: {err}") from err
+                outcome = "retry"
+                LLM_RETRIED.labels(upstream=self.name).inc()
+                logging.warning(f"{self.name} attempt {attempt + 1} failed: {err}")
+                await asyncio.sleep(self._delay(attempt))
+            finally:
+                LLM_LATENCY.labels(upstream=self.name, outcome=outcome).observe(time.monotonic() - started)
+
+    def chat_sync(self, req_data: dict) -> dict:
+        """
+        синхронный вариант chat() с тем же пулом/таймаутами/повторами
+        """
+        client = self._ensure_sync()
+        for attempt in range(self.retries + 1):
+            outcome = "error"
+            started = time.monotonic()
+            try:
+                with self._sync_semaphore:
+                    LLM_QUEUE_WAIT.labels(upstream=self.name).observe(time.monotonic() - started)
+                    started = time.monotonic()
+                    response = client.post(CHAT_COMPLETIONS_PATH, json=req_data, headers=self._headers())
+                logging.info(f"{self.name} response: {response.status_code}")
+                self._check(response)
+                body = response.json()
+                outcome = "ok"
+                self._observe_prompt(req_data, body)
+                return body
+            except (httpx.TransportError, httpx.HTTPStatusError) as err:
+                if attempt == self.retries:
+                    raise LLMError(f"{self.name} failed after {attempt + 1} attempts: {err}") from err
+                outcome = "retry"
+                LLM_RETRIED.labels(upstream=self.name).inc()
+                logging.warning(f"{self.name} attempt {attempt + 1} failed: {err}")
+                time.sleep(self._delay(attempt))
+            finally:
+                LLM_LATENCY.labels(upstream=self.name, outcome=outcome).observe(time.monotonic() - started)
+
+    async def aclose(self):
+        """
+        закрывает AsyncClient (остановка FastAPI)
+        """
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._semaphore = None
+
+
+llm_clients = {
+    "vllm": LLMClient("vllm", VLLM_URL),
+    "vllm_lora": LLMClient("vllm_lora", VLLM_LORA_URL),
+}
+
+
+async def open_llm_clients():
+    for client in llm_clients.values():
+        await client.open()
+
+
+async def close_llm_clients():
+    for client in llm_clients.values():
+        await client.aclose()
+
+
+def open_sync_llm_clients():
+    for client in llm_clients.values():
+        client.open_sync()
+
+
+def close_sync_llm_clients():
+    for client in llm_clients.values():
+        client.close_sync()
@@ -0,0 +1,147 @@
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from app.config import LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL_MS, LOG_BUFFER_SIZE, LOG_OVERFLOW_POLICY
+from app.database import write_request_logs
+
+REQUEST_LOG_BUFFERED = Gauge(
+    "request_log_buffered", "Request log rows waiting to be written"
+)
+REQUEST_LOG_DROPPED = Counter(
+    "request_log_dropped_total", "Request log rows dropped", ["reason"]
+)
+REQUEST_LOG_FLUSH = Histogram(
+    "request_log_flush_seconds", "Time to write one batch of request log rows",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+OVERFLOW_POLICIES = ("drop_new", "drop_oldest")
+
+
+class RequestLogSink:
+    """
+    буфер логов обращений (request_logs), который пишется в Postgres фоновым потоком
+
+    - log() только кладёт строку в буфер в памяти, латентность запроса не зависит от коммита в БД
+    - поток пишет буфер одним multi-row INSERT каждые flush_interval мс или как только набралось batch_size строк
+    - буфер ограничен buffer_size строками; при переполнении (БД недоступна или не успевает)
+      срабатывает overflow_policy: drop_new или drop_oldest, отброшенное считается в request_log_dropped_total
+    - если запись пачки упала, строки возвращаются в буфер и пишутся в следующий раз
+    - close() дописывает остаток (вызывается на shutdown FastAPI и при выходе из процесса)
+    """
+
+    def __init__(self, batch_size: int = LOG_BATCH_SIZE, flush_interval_ms: int = LOG_FLUSH_INTERVAL_MS,
+                 buffer_size: int = LOG_BUFFER_SIZE, overflow_policy: str = LOG_OVERFLOW_POLICY,
+                 writer=write_request_logs):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения '{overflow_policy}', ожидается одна из {OVERFLOW_POLICIES}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.buffer_size = buffer_size
+        self.overflow_policy = overflow_policy
+        self.writer = writer
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def _ensure_thread(self):
+        # поток не переживает fork (gunicorn --preload, celery) - в каждом процессе запускаем свой
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._buffer.clear()
+            self._thread = threading.Thread(target=self._run, name="request-log-sink", daemon=True)
+            self._thread.start()
+
+    def log(self, endpoint: str, status: str, task_id: str = None):
+        row = {"endpoint": endpoint, "status": status, "task_id": task_id, "timestamp": datetime.datetime.utcnow()}
+        with self._cond:
+            self._ensure_thread()
+            if len(self._buffer) >= self.buffer_size:
+                if self.overflow_policy == "drop_new":
+                    REQUEST_LOG_DROPPED.labels(reason="overflow").inc()
+                    return
+                self._buffer.popleft()
+                REQUEST_LOG_DROPPED.labels(reason="overflow").inc()
+            self._buffer.append(row)
+            REQUEST_LOG_BUFFERED.set(len(self._buffer))
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            rows = list(self._buffer)
+            self._buffer.clear()
+            REQUEST_LOG_BUFFERED.set(0)
+            return rows
+
+    def _put_back(self, rows):
+        with self._cond:
+            free = self.buffer_size - len(self._buffer)
+            if free < len(rows):
+                REQUEST_LOG_DROPPED.labels(reason="write_failed").inc(len(rows) - max(free, 0))
+                rows = rows[len(rows) - max(free, 0):]
+            self._buffer.extendleft(reversed(rows))
+            REQUEST_LOG_BUFFERED.set(len(self._buffer))
+
+    def flush(self) -> bool:
+        """
+        пишет всё, что накопилось в буфере; False - если запись не удалась
+        """
+        with self._flush_lock:
+            rows = self._take()
+            if not rows:
+                return True
+            started = time.monotonic()
+            try:
+                for i in range(0, len(rows), self.batch_size):
+                    self.writer(rows[i:i + self.batch_size])
+            except Exception as err:
+                # записанные пачки не повторяем, в буфер возвращается только остаток
+                logging.warning(f"Request log flush failed, keeping {len(rows) - i} rows: {err}")
+                self._put_back(rows[i:])
+                return False
+            finally:
+                REQUEST_LOG_FLUSH.observe(time.monotonic() - started)
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and len(self._buffer) < self.batch_size:
+                    self._cond.wait(self.flush_interval)
+                closed = self._closed
+            ok = self.flush()
+            if closed:
+                return
+            if not ok:
+                # БД недоступна - не долбим её в цикле
+                time.sleep(self.flush_interval)
+
+    def close(self, timeout: float = 5):
+        """
+        останавливает фоновый поток и дописывает остаток буфера
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self.flush()
+
+
+request_log_sink = RequestLogSink()
+atexit.register(request_log_sink.close)
+
+
+def log_request(endpoint: str, status: str, task_id: str = None):
+    request_log_sink.log(endpoint=endpoint, status=status, task_id=task_id)
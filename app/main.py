@@ -3,12 +3,23 @@ import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import threading
+
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from starlette.concurrency import run_in_threadpool
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from app.api import router as api_router
-from app.config import DEBUG
+from app.config import DEBUG, PRELOAD_MODELS, WARMUP_MODELS
+from app.llm_client import open_llm_clients, close_llm_clients
+from app.executor import pipeline_executor
+from app.registry import registry, parse_names
+from app.log_sink import request_log_sink
+from app.observability import start_trace, current_traceparent
+
+# с gunicorn --preload выполняется один раз в мастере, воркеры получают загруженное через fork
+registry.warm_up(parse_names(PRELOAD_MODELS))
 
 app = FastAPI(debug=DEBUG)
 
@@ -16,5 +27,31 @@ Instrumentator().instrument(app).expose(app)
 
 app.include_router(api_router)
 
+
+@app.middleware("http")
+async def trace_context(request: Request, call_next):
+    # trace_id из входящего traceparent (или новый) - попадает в exemplar'ы стадий, вызовы vLLM и задачи Celery
+    trace_id = start_trace(request.headers.get("traceparent"))
+    response = await call_next(request)
+    response.headers["traceparent"] = current_traceparent()
+    response.headers["X-Trace-Id"] = trace_id
+    return response
+
+
+@app.on_event("startup")
+async def startup():
+    # один AsyncClient на апстрим на event loop приложения
+    await open_llm_clients()
+    # прогрев в фоне: воркер сразу принимает /healthz, а /readyz станет 200 после загрузки моделей
+    threading.Thread(target=registry.warm_up, args=(parse_names(WARMUP_MODELS),), daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_llm_clients()
+    pipeline_executor.shutdown()
+    # дописываем накопленные логи обращений
+    await run_in_threadpool(request_log_sink.close)
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,128 @@
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from app.config import MAP_REDUCE_CHUNK_TOKENS, MAP_REDUCE_CONCURRENCY, MAP_REDUCE_MIN_TOPIC_SIZE
+from app.models import (
+    llm_enabled, llm_clients, build_summary_request, pack_by_tokens, get_summary_vllm, _completion_text, SUMMARY_SYSTEM_PROMPT,
+)
+from app.embedding_store import encode_with_store
+from app.registry import registry
+from app.observability import stage, fallback
+
+REDUCE_SYSTEM_PROMPT = (
+    "You are an assistant that merges partial summaries of Russian customer reviews for a single product. "
+    "You will be given several numbered partial summaries, each covering a different subset of reviews. "
+    "Combine them into one concise, human-readable summary in Russian. "
+    "Use a numbered list with no more than 5 items, keep the points mentioned most often, drop repetitions. "
+    "Ignore delivery, shipping, or service. Do not return JSON or code, just plain text."
+)
+
+
+@stage("topic_labels")
+def topic_labels(lemmas, min_topic_size: int = MAP_REDUCE_MIN_TOPIC_SIZE):
+    """
+    метки кластеров для разбиения отзывов по темам (одно снижение размерности + одна кластеризация,
+    без перебора и BERTopic)
+    """
+    embeddings = encode_with_store(
+        registry.get("embedding_encoder"), lemmas, registry.get("embedding_store")
+    )
+    topic_backend = registry.get("topic_backend")
+    reduced = topic_backend.make_reducer(len(lemmas)).fit_transform(embeddings)
+    return np.asarray(topic_backend.make_clusterer(min_topic_size, len(lemmas)).fit_predict(reduced))
+
+
+def partition_reviews(reviews, labels=None, budget: int = MAP_REDUCE_CHUNK_TOKENS, weights=None):
+    """
+    делит отзывы на части не больше budget токенов; если заданы метки тем,
+    каждая часть содержит отзывы одной темы (выбросы -1 идут отдельной группой).
+    weights - веса отзывов после схлопывания дубликатов, по ним считается размер темы
+    """
+    if labels is None:
+        return pack_by_tokens(reviews, budget)
+    if weights is None:
+        weights = [1] * len(reviews)
+    groups, sizes = {}, {}
+    for review, label, weight in zip(reviews, labels, weights):
+        groups.setdefault(int(label), []).append(review)
+        sizes[int(label)] = sizes.get(int(label), 0) + weight
+    partitions = []
+    # крупные темы первыми, чтобы их частичные саммари шли в начале reduce-промпта
+    for label in sorted(groups, key=lambda l: -sizes[l]):
+        partitions.extend(pack_by_tokens(groups[label], budget))
+    return partitions
+
+
+def _summarize_partition(texts, system_prompt: str) -> str:
+    response = llm_clients["vllm"].chat_sync(build_summary_request('\n\n'.join(texts), system_prompt=system_prompt))
+    return _completion_text(response).strip()
+
+
+@stage("map_reduce")
+def summarize_map_reduce(reviews, lemmas=None, progress=None, budget: int = MAP_REDUCE_CHUNK_TOKENS,
+                         concurrency: int = MAP_REDUCE_CONCURRENCY, weights=None):
+    """
+    иерархическое саммари для больших наборов отзывов
+
+    - map: отзывы делятся на части по темам (если переданы леммы и кластеризация удалась)
+      или просто по бюджету токенов; части суммаризируются параллельно
+    - reduce: частичные саммари рекурсивно сводятся REDUCE_SYSTEM_PROMPT'ом,
+      пока не поместятся в один промпт бюджета budget
+
+    args:
+        reviews (list of str): исходные отзывы
+        lemmas (list of str, optional): лемматизированные отзывы для разбиения по темам
+        progress (callable, optional): progress(stage, done, total) - вызывается после каждой части
+        budget (int): бюджет токенов на один промпт
+        concurrency (int): сколько запросов к vLLM выполнять одновременно
+        weights (list of int, optional): веса отзывов после схлопывания дубликатов
+
+    returns:
+        str: итоговое саммари
+    """
+    if not llm_enabled():
+        return get_summary_vllm(reviews)
+
+    labels = None
+    if lemmas is not None and len(reviews) > MAP_REDUCE_MIN_TOPIC_SIZE * 2:
+        try:
+            labels = topic_labels(lemmas)
+        except Exception as err:
+            fallback("map_reduce_plain_chunks")
+            logging.warning("Couldn't cluster reviews for map-reduce, falling back to plain chunks")
+            logging.exception(err)
+
+    partitions = partition_reviews(reviews, labels, budget, weights=weights)
+    logging.info(f"Map-reduce: {len(reviews)} reviews -> {len(partitions)} partitions")
+
+    def run_stage(stage, parts, system_prompt):
+        done = 0
+        results = [None] * len(parts)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = {
+                pool.submit(contextvars.copy_context().run, _summarize_partition, part, system_prompt): i
+                for i, part in enumerate(parts)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                done += 1
+                if progress:
+                    progress(stage, done, len(parts))
+        return results
+
+    summaries = run_stage("map", partitions, SUMMARY_SYSTEM_PROMPT)
+
+    level = 0
+    while len(summaries) > 1:
+        level += 1
+        numbered = [f"{i + 1}. {s}" for i, s in enumerate(summaries)]
+        groups = pack_by_tokens(numbered, budget)
+        if len(groups) == len(summaries) and len(groups) > 1:
+            # каждое частичное саммари само не влезает в бюджет - сводим попарно
+            groups = [numbered[i:i + 2] for i in range(0, len(numbered), 2)]
+        summaries = run_stage(f"reduce_{level}", groups, REDUCE_SYSTEM_PROMPT)
+
+    return summaries[0] if summaries else ""
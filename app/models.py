@@ -1,111 +1,317 @@
+import asyncio
+import contextvars
 import json
 import re
-import requests
-from collections import Counter
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import logging
-import torch
 import pandas as pd
 import numpy as np
-from pymystem3 import Mystem
-from bertopic import BERTopic
-from sklearn.feature_extraction.text import CountVectorizer
-import gensim.corpora as corpora
-from gensim.models.coherencemodel import CoherenceModel
-from cuml.manifold import UMAP as GPU_UMAP
-from cuml.cluster import HDBSCAN as GPU_HDBSCAN
-from sentence_transformers import SentenceTransformer
-from expiringdict import ExpiringDict
-import nltk
-nltk.download("stopwords")
-
-mystem = Mystem()
-vectorizer_model = CountVectorizer()
-embedding_cache = ExpiringDict(max_age_seconds=604800, max_len=100)
-embedding_model = SentenceTransformer(
-    "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
-    device="cuda"
+
+from app.config import (
+    LEMMA_BATCH_SIZE, LEMMA_CACHE_SIZE, LEMMA_WORKERS, LEMMA_POOL_THRESHOLD,
+    EMBEDDING_MODEL_NAME, EMBEDDING_STORE_DIR, EMBEDDING_STORE_MAX_BYTES, EMBEDDING_DEVICE, EMBEDDING_BACKEND,
+    TOPIC_SWEEP_MODE, VLLM_ENABLED,
+    SELECTION_TOKEN_BUDGET, SELECTION_MMR_LAMBDA, SELECTION_TOKENIZER,
+    ATTR_MODE, ATTR_SHARD_TOKENS, ATTR_CONCURRENCY, ATTR_GUIDED_JSON,
+)
+from app.embedding_store import EmbeddingStore, encode_with_store
+from app.embedding_batcher import EmbeddingBatcher
+from app.onnx_embedder import embedding_backend, embedding_store_model_name
+from app.topic_backends import get_topic_backend, embedding_device
+from app.llm_client import llm_clients
+from app.result_cache import result_cache, result_key, request_fingerprint, normalize_review
+from app.registry import registry
+from app.observability import stage, fallback
+
+# Тяжёлые библиотеки (torch, sentence-transformers, BERTopic, gensim, cuML) и модели
+# загружаются при первом обращении через registry, поэтому импорт модуля дешёвый,
+# а /keywords и /ping не тянут torch вовсе.
+
+
+def _load_mystem():
+    from pymystem3 import Mystem
+    return Mystem()
+
+
+def _load_nltk_stopwords():
+    import nltk
+    try:
+        return nltk.corpus.stopwords.words("russian")
+    except LookupError:
+        nltk.download("stopwords")
+        return nltk.corpus.stopwords.words("russian")
+
+
+def _load_embedding_model():
+    if embedding_backend() == "onnx":
+        from app.onnx_embedder import OnnxEmbedder
+        return OnnxEmbedder()
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        device=embedding_device()
+    )
+
+
+def _load_vectorizer():
+    from sklearn.feature_extraction.text import CountVectorizer
+    return CountVectorizer()
+
+
+def _load_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(SELECTION_TOKENIZER)
+
+
+def _cuda_available():
+    import torch
+    return torch.cuda.is_available()
+
+
+# подпроцесс Mystem и CUDA-контекст не переживают fork - в каждом воркере загружаются свои
+registry.register("mystem", _load_mystem, fork_safe=False)
+registry.register("stopwords", _load_nltk_stopwords)
+# сессия ONNX Runtime, как и CUDA, не переживает fork
+registry.register("embedding_model", _load_embedding_model,
+                  fork_safe=EMBEDDING_DEVICE == "cpu" and EMBEDDING_BACKEND != "onnx")
+# все вызовы кодирования в процессе идут через общий батчер
+registry.register("embedding_encoder", lambda: EmbeddingBatcher(lambda: registry.get("embedding_model")), fork_safe=False)
+registry.register("embedding_store", lambda: EmbeddingStore(EMBEDDING_STORE_DIR, embedding_store_model_name(), EMBEDDING_STORE_MAX_BYTES))
+registry.register("topic_backend", get_topic_backend)
+registry.register("vectorizer", _load_vectorizer)
+registry.register("tokenizer", _load_tokenizer)
+registry.register("cuda_available", _cuda_available, fork_safe=False)
+
+# у Mystem один процесс и одна пара пайпов: одновременные вызовы из потоков пула перемешают ответы
+mystem_lock = threading.Lock()
+
+
+def llm_enabled() -> bool:
+    """
+    vLLM крутится в отдельных подах, поэтому локальный GPU для него не нужен;
+    если VLLM_ENABLED не задан, сохраняется старое поведение (проверка CUDA)
+    """
+    if VLLM_ENABLED is not None:
+        return VLLM_ENABLED
+    return registry.get("cuda_available")
+
+
+SUMMARY_MODEL = "Vikhrmodels/Vikhr-YandexGPT-5-Lite-8B-it"
+SUMMARY_SYSTEM_PROMPT = (
+    "You are an assistant that analyzes Russian customer reviews for a single product. "
+    "You will be given a set of reviews. Summarize the key points in a concise, human-readable format. "
+    "Use a numbered list with no more than 5 items. Focus only on the product’s features and user experience — "
+    "ignore any mentions of delivery, shipping, or service. Do not return JSON or code, just plain text."
 )
 
+ATTR_MODEL = "Vikhr-7B-instruct_0.4_lora_r32_medium_prompt"
+ATTR_SYSTEM_PROMPT = (
+    "Ты помощник, который анализирует отзывы на товары и выделяет атрибуты. "
+    "Ниже представлен список отзывов на мандарины:\n"
+    "Очень вкусные, сладкие! Никакие абхазские не нужны))\n"
+    "Огромные, почти безвкусные\n"
+    "Хорошие мандарины, в меру сладкие, без косточек\n"
+    "сладкие, косточек не попалось, кожура тонкая и легко чистится\n"
+    "из этого списка отзывов выделяем атрибуты:\n"
+    "вкус: сладкий, безвкусный\n"
+    "размер: огромный\n"
+    "структура: без косточек\n"
+    "кожура: тонкая и легко чистится\n\n"
+    "Теперь проанализируй отзывы ниже и выдели атрибуты аналогично."
+)
+# формат ответа LoRA-модели, который разбирает process_attr; передаётся в vLLM как guided_json
+ATTR_JSON_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "attribute": {"type": "string"},
+            "characteristic": {"type": "string"},
+        },
+        "required": ["attribute", "characteristic"],
+    },
+}
+
+
+def build_summary_request(text: str, system_prompt: str = SUMMARY_SYSTEM_PROMPT) -> dict:
+    return {
+        "model": SUMMARY_MODEL,
+        "max_tokens": 256,
+        "temperature": 0.1,
+        "top_p": 0.98,
+        "repetition_penalty": 1.05,
+        "stop": ["</s>"],
+        "messages": [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": text
+            }
+        ]
+    }
+
+
+def build_attr_request(text: str, guided: bool = ATTR_GUIDED_JSON) -> dict:
+    """
+    guided=True - vLLM генерирует только JSON по ATTR_JSON_SCHEMA; стоп по пустой строке
+    тогда не нужен (и мог бы оборвать отформатированный JSON)
+    """
+    req_data = {
+        "model": ATTR_MODEL,
+        "max_tokens": 400,
+        "temperature": 0.1,
+        "top_p": 0.95,
+        "stop": ["</s>", "\n\n"],
+        "messages": [
+            {"role": "system", "content": ATTR_SYSTEM_PROMPT,},
+            {"role": "user", "content": text}
+        ]
+    }
+    if guided:
+        req_data["stop"] = ["</s>"]
+        req_data["guided_json"] = ATTR_JSON_SCHEMA
+    return req_data
+
+
+def attr_cache_extra(mode: str = ATTR_MODE) -> dict:
+    """
+    параметры извлечения атрибутов, от которых зависит результат (часть ключа result_cache)
+    """
+    if mode == 'sharded':
+        return {"attr_mode": mode, "attr_shard_tokens": ATTR_SHARD_TOKENS}
+    return {}
+
+
+def _completion_text(response: dict) -> str:
+    return response['choices'][0]['message']['content']
+
+
 def get_summary_vllm(texts):
+    """
+    саммари отзывов через vLLM (синхронно, для Celery). при < 4 отзывах LLM не вызывается
+    """
     logging.info('get_summary_vllm')
-    if torch.cuda.is_available():
+    if llm_enabled():
         text = '\n\n'.join(texts)
-        SYSTEM_PROMPT = (
-            "You are an assistant that analyzes Russian customer reviews for a single product. "
-            "You will be given a set of reviews. Summarize the key points in a concise, human-readable format. "
-            "Use a numbered list with no more than 5 items. Focus only on the product’s features and user experience — "
-            "ignore any mentions of delivery, shipping, or service. Do not return JSON or code, just plain text."
-        )
+        if len(texts) < 4:
+            output = re.sub('\n[\n\\ ]*', '\n', text)
+        else:
+            req_data = build_summary_request(text)
+            key = result_key("summary_llm", texts, request_fingerprint(req_data))
+            output = result_cache.get(key, kind="summary_llm")
+            if output is None:
+                response = llm_clients["vllm"].chat_sync(req_data)
+                output = _completion_text(response)
+                result_cache.put(key, output)
+        return output
+    else:
+        return "нет GPU - нет и саммари"
 
+
+async def get_summary_vllm_async(texts):
+    """
+    то же, что get_summary_vllm, но не блокирует event loop
+    """
+    logging.info('get_summary_vllm_async')
+    if llm_enabled():
+        text = '\n\n'.join(texts)
         if len(texts) < 4:
-            output = re.sub('\n[\n\ ]*', '\n', text)
+            output = re.sub('\n[\n\\ ]*', '\n', text)
         else:
-            req_data = {
-                "model": "Vikhrmodels/Vikhr-YandexGPT-5-Lite-8B-it",
-                "max_tokens": 256,
-                "temperature": 0.1,
-                "top_p": 0.98,
-                "repetition_penalty": 1.05,
-                "stop": ["</s>"],
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": SYSTEM_PROMPT
-                    },
-                    {
-                        "role": "user",
-                        "content": text
-                    }
-                ]
-            }
-            response = requests.post('http://vllm:8000/v1/chat/completions', json=req_data)
-            logging.info(response)
-            if response.status_code != 200:
-                raise Exception
-            output = json.loads(response.text)['choices'][0]['message']['content']
+            req_data = build_summary_request(text)
+            key = result_key("summary_llm", texts, request_fingerprint(req_data))
+            output = await result_cache.aget(key, kind="summary_llm")
+            if output is None:
+                response = await llm_clients["vllm"].chat(req_data)
+                output = _completion_text(response)
+                await result_cache.aput(key, output)
         return output
     else:
         return "нет GPU - нет и саммари"
 
-def get_attr_vllm(texts):
+
+async def stream_summary_vllm(texts):
+    """
+    потоковый вариант get_summary_vllm_async: асинхронный генератор кусков текста саммари
+    """
+    logging.info('stream_summary_vllm')
+    if not llm_enabled():
+        yield "нет GPU - нет и саммари"
+        return
+    text = '\n\n'.join(texts)
+    if len(texts) < 4:
+        yield re.sub('\n[\n\\ ]*', '\n', text)
+        return
+    async for delta in llm_clients["vllm"].chat_stream(build_summary_request(text)):
+        yield delta
+
+
+async def stream_attr_vllm(texts):
+    """
+    потоковый вариант get_attr_vllm_async: отдаёт сырые куски ответа LoRA-модели;
+    разбор в итоговый список атрибутов (process_attr) делает вызывающий по накопленному тексту
+    """
+    logging.info('stream_attr_vllm')
+    if not llm_enabled():
+        yield "нет GPU - нет и атрибутов"
+        return
+    async for delta in llm_clients["vllm_lora"].chat_stream(build_attr_request('\n\n'.join(texts))):
+        yield delta
+
+
+def get_attr_vllm(texts, mode: str = ATTR_MODE):
+    """
+    атрибуты и их характеристики через LoRA-модель в vLLM (синхронно).
+    mode='sharded' - отзывы обрабатываются частями параллельно (extract_attributes_sharded)
+    """
     logging.info('get_attr_vllm')
-    if torch.cuda.is_available():
+    if llm_enabled():
         text = '\n\n'.join(texts)
+        req_data = build_attr_request(text)
+        key = result_key("attributes_llm", texts, request_fingerprint(req_data), **attr_cache_extra(mode))
+        output = result_cache.get(key, kind="attributes_llm")
+        if output is not None:
+            return output
+        try:
+            if mode == 'sharded':
+                output = extract_attributes_sharded(texts)
+            else:
+                response = llm_clients["vllm_lora"].chat_sync(req_data)
+                output = process_attr(_completion_text(response))
+            result_cache.put(key, output)
+        except Exception as e:
+            logging.error(f"Failed to get attributes: {e}")
+            output = ""
+        return output
+    else:
+        return "нет GPU - нет и атрибутов"
 
-        SYSTEM_PROMPT = (
-            "Ты помощник, который анализирует отзывы на товары и выделяет атрибуты. "
-            "Ниже представлен список отзывов на мандарины:\n"
-            "Очень вкусные, сладкие! Никакие абхазские не нужны))\n"
-            "Огромные, почти безвкусные\n"
-            "Хорошие мандарины, в меру сладкие, без косточек\n"
-            "сладкие, косточек не попалось, кожура тонкая и легко чистится\n"
-            "из этого списка отзывов выделяем атрибуты:\n"
-            "вкус: сладкий, безвкусный\n"
-            "размер: огромный\n"
-            "структура: без косточек\n"
-            "кожура: тонкая и легко чистится\n\n"
-            "Теперь проанализируй отзывы ниже и выдели атрибуты аналогично."
-        )
 
-        req_data = {
-            "model": "Vikhr-7B-instruct_0.4_lora_r32_medium_prompt",
-            "max_tokens": 400,
-            "temperature": 0.1,
-            "top_p": 0.95,
-            "stop": ["</s>", "\n\n"],
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT,},
-                {"role": "user", "content": text}
-            ]
-        }
+async def get_attr_vllm_async(texts, mode: str = ATTR_MODE):
+    """
+    то же, что get_attr_vllm, но не блокирует event loop
+    """
+    logging.info('get_attr_vllm_async')
+    if llm_enabled():
+        text = '\n\n'.join(texts)
+        req_data = build_attr_request(text)
+        key = result_key("attributes_llm", texts, request_fingerprint(req_data), **attr_cache_extra(mode))
+        output = await result_cache.aget(key, kind="attributes_llm")
+        if output is not None:
+            return output
         try:
-            response = requests.post('http://vllm_lora:8000/v1/chat/completions', json=req_data)
-            logging.info(f"Response code: {response.status_code}")
-            if response.status_code != 200:
-                logging.error(f"Error: {response.text}")
-                raise Exception
-            output = json.loads(response.text)['choices'][0]['message']['content']
-            output = process_attr(output)
+            if mode == 'sharded':
+                output = await extract_attributes_sharded_async(texts)
+            else:
+                response = await llm_clients["vllm_lora"].chat(req_data)
+                output = process_attr(_completion_text(response))
+            await result_cache.aput(key, output)
         except Exception as e:
             logging.error(f"Failed to get attributes: {e}")
             output = ""
@@ -113,6 +319,76 @@ def get_attr_vllm(texts):
     else:
         return "нет GPU - нет и атрибутов"
 
+
+def _attr_shard_sync(texts) -> str:
+    response = llm_clients["vllm_lora"].chat_sync(build_attr_request('\n\n'.join(texts)))
+    return _completion_text(response)
+
+
+def _merge_attr_shard(merger, unparsed, text: str):
+    if not merger.add_response(text):
+        fallback("attr_unparsed")
+        logging.warning("Couldn't parse attributes of a shard")
+        unparsed.append(text.strip())
+
+
+def _merged_attr_output(merger, unparsed) -> str:
+    # ни одна часть не разобралась - как process_attr, отдаём сырой ответ модели
+    return merger.to_text() if merger else '\n'.join(unparsed).strip()
+
+
+@stage("attributes_sharded")
+def extract_attributes_sharded(texts, budget: int = ATTR_SHARD_TOKENS, concurrency: int = ATTR_CONCURRENCY) -> str:
+    """
+    атрибуты по частям: отзывы упаковываются в части не больше budget токенов (в порядке отбора,
+    то есть отзывы одной темы идут подряд), части отправляются в vllm_lora параллельно,
+    пары атрибут -> характеристика сливаются по мере готовности ответов (AttributeMerger).
+    ошибка любой части (после повторов LLMClient) - ошибка всего вызова, как в summarize_map_reduce
+
+    args:
+        texts (list of str): отзывы
+        budget (int): бюджет токенов на одну часть
+        concurrency (int): сколько частей обрабатывать одновременно
+    returns:
+        str: атрибуты в формате process_attr
+    """
+    shards = pack_by_tokens(texts, budget)
+    logging.info(f"Attributes: {len(texts)} reviews -> {len(shards)} shards")
+    merger, unparsed = AttributeMerger(), []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, _attr_shard_sync, shard) for shard in shards]
+        for future in as_completed(futures):
+            _merge_attr_shard(merger, unparsed, future.result())
+    return _merged_attr_output(merger, unparsed)
+
+
+async def extract_attributes_sharded_async(texts, budget: int = ATTR_SHARD_TOKENS,
+                                           concurrency: int = ATTR_CONCURRENCY) -> str:
+    """
+    то же, что extract_attributes_sharded, но не блокирует event loop
+    """
+    with stage("attributes_sharded"):
+        shards = pack_by_tokens(texts, budget)
+        logging.info(f"Attributes: {len(texts)} reviews -> {len(shards)} shards")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(shard):
+            async with semaphore:
+                response = await llm_clients["vllm_lora"].chat(build_attr_request('\n\n'.join(shard)))
+            return _completion_text(response)
+
+        merger, unparsed = AttributeMerger(), []
+        tasks = [asyncio.ensure_future(run(shard)) for shard in shards]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                _merge_attr_shard(merger, unparsed, await next_done)
+        finally:
+            # при ошибке одной части остальные не нужны
+            for task in tasks:
+                task.cancel()
+        return _merged_attr_output(merger, unparsed)
+
+
 def grab_json(text: str):
     """
     Возвращает список словарей из ответа модели.
@@ -141,19 +417,108 @@ def grab_json(text: str):
             uniq.append(d)
     return uniq
 
-def process_attr(text):
+
+def parse_attr_items(text: str):
+    """
+    пары атрибут/характеристика из ответа LoRA-модели: сначала ответ целиком как JSON
+    (так отвечает модель с guided_json), иначе - поиск JSON в тексте через grab_json
+    """
     try:
-        res = ''
-        arr = grab_json(text)
-        groups = pd.DataFrame(arr).groupby('attribute')
-        for gr in groups:
-            res += f"{gr[0]}: {'; '.join(gr[1]['characteristic'])};\n"
-    except Exception:
-        res = text
-    return res.strip()
+        items = json.loads(text)
+        if isinstance(items, dict):
+            items = [items]
+        if isinstance(items, list):
+            return items
+    except ValueError:
+        pass
+    fallback("attr_json_repair")
+    return grab_json(text)
+
+
+class AttributeMerger:
+    """
+    инкрементальное слияние пар атрибут -> характеристика из одного или нескольких ответов модели
+
+    - атрибуты и характеристики сравниваются без учёта регистра и лишних пробелов,
+      выводится первое встреченное написание
+    - у каждой пары считается, сколько раз она встретилась; атрибуты и характеристики
+      выводятся по убыванию частоты, при равенстве - в порядке появления
+    """
+
+    def __init__(self):
+        # атрибут (нормализованный) -> [написание, частота, {характеристика: [написание, частота]}]
+        self._attributes = {}
 
+    def __len__(self):
+        return len(self._attributes)
 
-def text_preproc(text: str, token_pattern: str = r'(?:не\ |ни\ |нет\ |\b)[Ё-ё]{4,}', stop_words=None) -> str:
+    def add(self, items) -> int:
+        """
+        добавляет пары из списка словарей {"attribute": ..., "characteristic": ...};
+        characteristic может быть и списком строк. возвращает число принятых пар
+        """
+        added = 0
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            attribute, values = item.get("attribute"), item.get("characteristic")
+            if not isinstance(attribute, str) or not attribute.strip():
+                continue
+            if isinstance(values, str):
+                values = [values]
+            if not isinstance(values, list):
+                continue
+            for value in values:
+                if not isinstance(value, str) or not value.strip():
+                    continue
+                entry = self._attributes.setdefault(normalize_review(attribute), [attribute.strip(), 0, {}])
+                entry[1] += 1
+                entry[2].setdefault(normalize_review(value), [value.strip(), 0])[1] += 1
+                added += 1
+        return added
+
+    def add_response(self, text: str) -> bool:
+        """
+        разбирает ответ модели и добавляет его пары; False - если в ответе не нашлось ни одной пары
+        """
+        try:
+            return self.add(parse_attr_items(text)) > 0
+        except (ValueError, TypeError):
+            return False
+
+    def to_text(self) -> str:
+        lines = []
+        for name, _, values in sorted(self._attributes.values(), key=lambda entry: -entry[1]):
+            characteristics = sorted(values.values(), key=lambda value: -value[1])
+            lines.append(f"{name}: {'; '.join(value for value, _ in characteristics)};")
+        return '\n'.join(lines)
+
+
+def process_attr(text):
+    """
+    ответ LoRA-модели -> строки "атрибут: характеристика; ...;"; если разобрать не удалось - сам ответ
+    """
+    merger = AttributeMerger()
+    if not merger.add_response(text):
+        fallback("attr_unparsed")
+        return text.strip()
+    return merger.to_text()
+
+
+TOKEN_PATTERN = r'(?:не\ |ни\ |нет\ |\b)[Ё-ё]{4,}'
+
+
+def _select_tokens(lemmatized: str, token_pattern: str, stop_words) -> str:
+    """
+    отбирает токены из лемматизированного текста (общая часть text_preproc и text_preproc_batch)
+    """
+    tokens = re.findall(token_pattern, lemmatized)
+    tokens = [t.replace(' ', '_') for t in tokens
+            if t.split()[-1] not in stop_words]
+    return ' '.join(tokens)
+
+
+def text_preproc(text: str, token_pattern: str = TOKEN_PATTERN, stop_words=None) -> str:
     """
     выполняет предобработку текста:
     - лемматизация с использованием Mystem
@@ -172,17 +537,302 @@ def text_preproc(text: str, token_pattern: str = r'(?:не\ |ни\ |нет\ |\b)
     if not stop_words:
         stop_words = set()
     try:
-        text = ''.join(mystem.lemmatize(text))
+        with mystem_lock:
+            text = ''.join(registry.get("mystem").lemmatize(text))
         # text = text
-        tokens = re.findall(token_pattern, text)
-        tokens = [t.replace(' ', '_') for t in tokens
-                if t.split()[-1] not in stop_words]
-        text = ' '.join(tokens)
-        return text
+        return _select_tokens(text, token_pattern, stop_words)
     except:
         return text
 
-def get_representative_texts(lemmatized, originals, mode='strict'):
+
+# Разделитель отзывов внутри одного вызова Mystem. Без перевода строки: pymystem3 режет вход
+# по строкам и на каждую строку делает отдельный обмен с процессом. Точки изолируют отзывы
+# друг от друга при контекстном снятии омонимии.
+LEMMA_SEPARATOR = ' .|||. '
+
+_lemma_cache = OrderedDict()
+_lemma_cache_lock = threading.Lock()
+_lemma_pool = None
+_lemma_pool_lock = threading.Lock()
+_worker_mystem = None
+
+
+def _lemma_cache_get(line: str):
+    with _lemma_cache_lock:
+        value = _lemma_cache.get(line)
+        if value is not None:
+            _lemma_cache.move_to_end(line)
+        return value
+
+
+def _lemma_cache_put(line: str, value: str):
+    with _lemma_cache_lock:
+        _lemma_cache[line] = value
+        _lemma_cache.move_to_end(line)
+        while len(_lemma_cache) > LEMMA_CACHE_SIZE:
+            _lemma_cache.popitem(last=False)
+
+
+def _lemmatize_lines(lines, stemmer=None):
+    """
+    лемматизирует список однострочных текстов за один вызов Mystem на пачку.
+    возвращает ''.join(mystem.lemmatize(line)) для каждой строки
+
+    если после склейки/разрезания число кусков не совпало с числом строк
+    (например, разделитель встретился в самом отзыве), пачка лемматизируется построчно
+    """
+    if stemmer is None:
+        with mystem_lock:
+            return _lemmatize_lines(lines, stemmer=registry.get("mystem"))
+    result = []
+    for i in range(0, len(lines), LEMMA_BATCH_SIZE):
+        chunk = lines[i:i + LEMMA_BATCH_SIZE]
+        joined = ''.join(stemmer.lemmatize(LEMMA_SEPARATOR.join(chunk)))
+        if joined.endswith('\n'):
+            joined = joined[:-1]
+        parts = joined.split(LEMMA_SEPARATOR)
+        if len(parts) != len(chunk):
+            logging.warning("Lemma batch split mismatch, falling back to per-line lemmatization")
+            parts = [''.join(stemmer.lemmatize(line)) for line in chunk]
+        else:
+            parts = [part + '\n' for part in parts]
+        result.extend(parts)
+    return result
+
+
+def _init_lemma_worker():
+    global _worker_mystem
+    _worker_mystem = _load_mystem()
+
+
+def _lemmatize_lines_worker(lines):
+    return _lemmatize_lines(lines, stemmer=_worker_mystem)
+
+
+def _get_lemma_pool():
+    """
+    лениво создаёт пул процессов с собственным Mystem в каждом.
+    в демонических процессах (prefork-воркеры Celery) дочерние процессы запрещены - тогда None
+
+    процессы запускаются через spawn: к этому моменту в процессе уже работают потоки (запись логов,
+    батчер эмбеддингов, torch), и fork мог бы унести в дочерний процесс чужую захваченную блокировку
+    """
+    global _lemma_pool
+    if LEMMA_WORKERS < 2 or multiprocessing.current_process().daemon:
+        return None
+    with _lemma_pool_lock:
+        if _lemma_pool is None:
+            _lemma_pool = ProcessPoolExecutor(
+                max_workers=LEMMA_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_lemma_worker,
+            )
+        return _lemma_pool
+
+
+@stage("lemmatize")
+def text_preproc_batch(texts, token_pattern: str = TOKEN_PATTERN, stop_words=None):
+    """
+    пакетный аналог text_preproc: результат совпадает с [text_preproc(t, ...) for t in texts]
+
+    - однострочные тексты склеиваются через LEMMA_SEPARATOR и лемматизируются пачками
+      по LEMMA_BATCH_SIZE за один обмен с Mystem
+    - большие входы (от LEMMA_POOL_THRESHOLD уникальных строк) шардируются по пулу процессов Mystem
+    - лемматизированные строки кэшируются в LRU на LEMMA_CACHE_SIZE записей: отзывы вида
+      "Отлично!" повторяются тысячами. Кэш по целой строке, а не по слову, т.к. Mystem снимает
+      омонимию по контексту и лемма слова зависит от соседей
+    - многострочные тексты обрабатываются как раньше, через text_preproc
+
+    args:
+        texts (list of str): список исходных текстов
+        token_pattern (str, optional): регулярное выражение для поиска токенов
+        stop_words (set, optional): множество стоп-слов для фильтрации токенов
+
+    returns:
+        list of str: обработанные тексты в исходном порядке
+    """
+    if not stop_words:
+        stop_words = set()
+    texts = list(texts)
+
+    lemmatized = {}
+    pending = []
+    for text in texts:
+        if text in lemmatized or text.splitlines() != [text]:
+            continue
+        cached = _lemma_cache_get(text)
+        if cached is not None:
+            lemmatized[text] = cached
+        else:
+            lemmatized[text] = None
+            pending.append(text)
+
+    if pending:
+        try:
+            pool = _get_lemma_pool() if len(pending) >= LEMMA_POOL_THRESHOLD else None
+            if pool is not None:
+                shard = max(LEMMA_BATCH_SIZE, -(-len(pending) // LEMMA_WORKERS))
+                shards = [pending[i:i + shard] for i in range(0, len(pending), shard)]
+                parts = [part for res in pool.map(_lemmatize_lines_worker, shards) for part in res]
+            else:
+                parts = _lemmatize_lines(pending)
+            for line, part in zip(pending, parts):
+                lemmatized[line] = part
+                _lemma_cache_put(line, part)
+        except Exception as err:
+            fallback("lemmatize_per_text")
+            logging.warning("Batch lemmatization failed, falling back to text_preproc")
+            logging.exception(err)
+
+    result = []
+    for text in texts:
+        lemma = lemmatized.get(text)
+        if lemma is None:
+            result.append(text_preproc(text, token_pattern=token_pattern, stop_words=stop_words))
+            continue
+        try:
+            result.append(_select_tokens(lemma, token_pattern, stop_words))
+        except Exception:
+            result.append(lemma)
+    return result
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    быстрая оценка числа токенов без токенизатора: для русского текста у BPE-токенизаторов
+    Vikhr выходит около 3 символов на токен
+    """
+    return len(text) // 3 + 1
+
+
+def pack_by_tokens(texts, budget: int):
+    """
+    жадно упаковывает тексты в группы, суммарная оценка токенов которых не превышает budget.
+    текст длиннее бюджета попадает в отдельную группу целиком
+    """
+    chunks, current, used = [], [], 0
+    for text in texts:
+        cost = estimate_tokens(text) + 1
+        if current and used + cost > budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(text)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def count_tokens(texts):
+    """
+    число токенов в каждом тексте: токенизатором SELECTION_TOKENIZER, если он задан, иначе оценкой estimate_tokens
+    """
+    if not SELECTION_TOKENIZER:
+        return [estimate_tokens(text) for text in texts]
+    tokenizer = registry.get("tokenizer")
+    return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+
+def fit_budget(texts, budget: int = SELECTION_TOKEN_BUDGET):
+    """
+    первые тексты, суммарно помещающиеся в budget токенов (запасной вариант, когда темы выделить не удалось)
+    """
+    res, used = [], 0
+    for text, tokens in zip(texts, count_tokens(texts)):
+        if used + tokens > budget:
+            continue
+        res.append(text)
+        used += tokens
+    return res
+
+
+def select_by_budget(embeddings, topics, token_counts, budget: int = SELECTION_TOKEN_BUDGET,
+                     weights=None, mmr_lambda: float = SELECTION_MMR_LAMBDA):
+    """
+    жадный отбор документов под бюджет токенов по MMR (maximal marginal relevance)
+
+    - релевантность документа: доля его темы среди всех отзывов (с весами дубликатов)
+      * косинусная близость к центроиду темы; выбросы (-1) считаются с половинной долей
+    - штраф за избыточность: максимальная близость к уже выбранным
+    - на каждом шаге берётся документ с максимумом mmr_lambda * релевантность - (1 - mmr_lambda) * избыточность
+      среди тех, что ещё помещаются в оставшийся бюджет
+
+    args:
+        embeddings (np.ndarray): эмбеддинги документов (n, dim)
+        topics (np.ndarray): номер темы каждого документа
+        token_counts (list of int): число токенов в каждом документе
+        budget (int): бюджет токенов на все выбранные документы
+        weights (list of int, optional): веса документов после схлопывания дубликатов
+        mmr_lambda (float): баланс релевантности и разнообразия
+    returns:
+        list of int: индексы выбранных документов в порядке выбора
+    """
+    n = len(embeddings)
+    topics = np.asarray(topics)
+    weights = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64)
+    costs = np.asarray(token_counts)
+    unit = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    relevance = np.zeros(n)
+    for topic_id in np.unique(topics):
+        members = np.flatnonzero(topics == topic_id)
+        share = weights[members].sum() / weights.sum()
+        if topic_id == -1:
+            share /= 2
+        centroid = np.average(unit[members], axis=0, weights=weights[members])
+        centroid /= max(np.linalg.norm(centroid), 1e-12)
+        relevance[members] = share * (unit[members] @ centroid)
+    relevance /= max(relevance.max(), 1e-12)
+
+    selected = []
+    redundancy = np.zeros(n)
+    available = costs <= budget
+    remaining = budget
+    while available.any():
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        remaining -= costs[best]
+        available[best] = False
+        available &= costs <= remaining
+        redundancy = np.maximum(redundancy, unit @ unit[best])
+    return selected
+
+
+def fit_topics(lemmatized, embeddings):
+    """
+    перебор моделей BERTopic по минимальному размеру темы и выбор самой когерентной
+
+    args:
+        lemmatized (list of str): лемматизированные тексты
+        embeddings (np.ndarray): их эмбеддинги
+    returns:
+        (BERTopic, np.ndarray): модель и номер темы каждого текста (-1 - выброс);
+        (None, None), если ни одной модели с темами не получилось
+    """
+    import gensim.corpora as corpora
+
+    analyzer = registry.get("vectorizer").build_analyzer()
+    tokens = [analyzer(doc) for doc in lemmatized]
+    dictionary = corpora.Dictionary(tokens)
+    corpus = [dictionary.doc2bow(t) for t in tokens]
+
+    topic_models, coherence_values = compute_bertopic_coherence_values(
+        lemmatized, embeddings, dictionary, tokens, corpus,
+        limit=5, start=2, step=1
+    )
+
+    if not coherence_values:
+        return None, None
+
+    max_index = coherence_values.index(max(coherence_values))
+    optimal_model = topic_models[max_index]
+    document_info = optimal_model.get_document_info(lemmatized)
+    return optimal_model, document_info["Topic"].to_numpy()
+
+
+@stage("representative")
+def get_representative_texts(lemmatized, originals, mode='strict', weights=None, budget: int = SELECTION_TOKEN_BUDGET):
     """
     извлекает представительные тексты из оригинальных документов на основе их лемматизированных версий
     и тематического моделирования с использованием BERTopic
@@ -197,6 +847,10 @@ def get_representative_texts(lemmatized, originals, mode='strict'):
         originals (list of str): список оригинальных текстов
         mode (str) 'strict': по 1 документу на каждую тему (ближайший к центроиду)
         'expanded': все документы из BERTopic -> Representative_Docs.
+        'budget': отбор по MMR (покрытие тем + разнообразие), пока отзывы помещаются в budget токенов
+        weights (list of int, optional): веса текстов после схлопывания дубликатов - учитываются
+            в центроидах тем и в порядке тем (крупные по числу исходных отзывов первыми)
+        budget (int): бюджет токенов промпта для режима 'budget'
     returns:
         list of str: список репрезентативных оригинальных отзывов
     """
@@ -207,50 +861,48 @@ def get_representative_texts(lemmatized, originals, mode='strict'):
     if isinstance(originals, pd.Series):
         originals = originals.reset_index(drop=True)
 
-    if len(lemmatized) <= 30:
+    if mode == 'budget':
+        token_counts = count_tokens(list(originals))
+        if sum(token_counts) <= budget:
+            return list(originals)
+    elif len(lemmatized) <= 30:
         return list(originals)
 
     try:
-        joined_text = "\n".join(lemmatized)
-        hash_key = hash(joined_text)
-        if hash_key in embedding_cache:
-            embeddings = embedding_cache[hash_key]
-        else:
-            embeddings = embedding_model.encode(
-                lemmatized, show_progress_bar=False, batch_size=64
-            )
-            embedding_cache[hash_key] = embeddings
-
-        analyzer = vectorizer_model.build_analyzer()
-        tokens = [analyzer(doc) for doc in lemmatized]
-        dictionary = corpora.Dictionary(tokens)
-        corpus = [dictionary.doc2bow(t) for t in tokens]
-
-        topic_models, coherence_values = compute_bertopic_coherence_values(
-            lemmatized, embeddings, dictionary, tokens, corpus,
-            limit=5, start=2, step=1
+        embeddings = encode_with_store(
+            registry.get("embedding_encoder"), lemmatized, registry.get("embedding_store")
         )
 
-        if not coherence_values:
-            return list(originals)
+        if mode == 'budget' and len(lemmatized) <= 30:
+            # тем из такого числа отзывов не выделить - только разнообразие под бюджет
+            selected = select_by_budget(embeddings, np.zeros(len(lemmatized)), token_counts, budget, weights)
+            return [list(originals)[i] for i in selected]
 
-        max_index = coherence_values.index(max(coherence_values))
-        optimal_model = topic_models[max_index]
-        document_info = optimal_model.get_document_info(lemmatized)
-        topics = document_info["Topic"].to_numpy()
+        optimal_model, topics = fit_topics(lemmatized, embeddings)
+        if optimal_model is None:
+            fallback("no_topics")
+            return list(originals)
 
         res = []
+        topic_order = np.unique(topics)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            topic_weight = {t: weights[topics == t].sum() for t in topic_order}
+            topic_order = sorted(topic_order, key=lambda t: -topic_weight[t])
 
         if mode == 'strict':
             # строгий режим: по 1 документу на тему
-            for topic_id in np.unique(topics):
+            for topic_id in topic_order:
                 if topic_id == -1:
                     continue
                 doc_indices = np.where(topics == topic_id)[0]
                 if len(doc_indices) == 0:
                     continue
                 cluster_embeddings = embeddings[doc_indices]
-                centroid = cluster_embeddings.mean(axis=0)
+                if weights is not None:
+                    centroid = np.average(cluster_embeddings, axis=0, weights=weights[doc_indices])
+                else:
+                    centroid = cluster_embeddings.mean(axis=0)
                 dists = np.linalg.norm(cluster_embeddings - centroid, axis=1)
                 best_doc_idx = doc_indices[np.argmin(dists)]
                 if isinstance(originals, pd.Series):
@@ -271,20 +923,103 @@ def get_representative_texts(lemmatized, originals, mode='strict'):
             # сопоставляем лемматизированные с оригинальными
             result_df = pd.DataFrame({'lemmas': lemmatized, 'original': originals})
             result_df['topic_num'] = result_df['lemmas'].map(rep_docs_dict)
-            res = result_df.groupby('topic_num')['original'].head(3).to_list()
+            if weights is not None:
+                result_df['topic_rank'] = result_df['topic_num'].map({t: i for i, t in enumerate(topic_order)})
+                result_df = result_df.sort_values('topic_rank', kind='stable')
+            res = result_df.groupby('topic_num', sort=weights is None)['original'].head(3).to_list()
+
+        elif mode == 'budget':
+            # по бюджету токенов: MMR по эмбеддингам с учётом размеров тем
+            selected = select_by_budget(embeddings, topics, token_counts, budget, weights)
+            res = [list(originals)[i] for i in selected]
 
         else:
-            raise ValueError("mode должен быть 'strict' или 'expanded'")
+            raise ValueError("mode должен быть 'strict', 'expanded' или 'budget'")
 
         return res
 
     except Exception as err:
         logging.warning("Couldn't get topics")
         logging.exception(err)
+        fallback("topics_failed")
+        if mode == 'budget':
+            return fit_budget(list(originals), budget)
         return list(originals)[:30]
 
 
-def compute_bertopic_coherence_values(docs, embeddings, dictionary, tokens, corpus, limit, start=2, step=1):
+def _topic_coherence(topic_model, dictionary, tokens, corpus):
+    """
+    считает c_v когерентность топиков обученной модели BERTopic; None, если у модели нет тем
+    """
+    model_topics = {
+        topic: words for topic, words in topic_model.get_topics().items()
+        if words and topic != -1
+    }
+
+    topic_words = [
+        [word for word, _ in model_topics[topic]]
+        for topic in model_topics
+    ]
+    return _coherence(topic_words, dictionary, tokens, corpus)
+
+
+def _ctfidf_topic_words(labels, counts, words, top_n: int = 10):
+    """
+    слова тем разбиения labels без обучения BERTopic: c-TF-IDF, как у BERTopic (ClassTfidfTransformer
+    по сумме счётчиков документов каждой темы, выбросы -1 - отдельный класс), и top_n слов на тему
+
+    args:
+        labels (np.ndarray): номер темы каждого документа
+        counts (scipy.sparse.csr_matrix): счётчики слов документов (CountVectorizer, один раз на перебор)
+        words (np.ndarray): слова - столбцы counts
+    returns:
+        list of list of str: слова каждой темы, кроме выбросов
+    """
+    from scipy import sparse
+    from bertopic.vectorizers import ClassTfidfTransformer
+
+    classes, inverse = np.unique(labels, return_inverse=True)
+    membership = sparse.csr_matrix(
+        (np.ones(len(labels)), (inverse.ravel(), np.arange(len(labels)))), shape=(len(classes), len(labels))
+    )
+    scores = sparse.csr_matrix(ClassTfidfTransformer().fit_transform(membership @ counts))
+    topic_words = []
+    for row, topic in enumerate(classes):
+        if topic == -1:
+            continue
+        start, end = scores.indptr[row], scores.indptr[row + 1]
+        values, columns = scores.data[start:end], scores.indices[start:end]
+        best = np.argsort(-values, kind="stable")[:top_n]
+        best = best[values[best] > 0]
+        if len(best):
+            topic_words.append([words[i] for i in columns[best]])
+    return topic_words
+
+
+@stage("coherence")
+def _coherence(topic_words, dictionary, tokens, corpus):
+    """
+    c_v когерентность списков слов тем; None, если тем нет
+    """
+    if not topic_words:
+        return None
+
+    from gensim.models.coherencemodel import CoherenceModel
+
+    coherence_model = CoherenceModel(
+        topics=topic_words,
+        texts=tokens,
+        corpus=corpus,
+        dictionary=dictionary,
+        coherence="c_v",
+        processes=4
+    )
+    return coherence_model.get_coherence()
+
+
+@stage("topic_sweep")
+def compute_bertopic_coherence_values(docs, embeddings, dictionary, tokens, corpus, limit, start=2, step=1,
+                                      sweep_mode=TOPIC_SWEEP_MODE):
     """
     вычисляет значения когерентности для моделей BERTopic, обученных с различными размерами минимального топика
 
@@ -294,6 +1029,11 @@ def compute_bertopic_coherence_values(docs, embeddings, dictionary, tokens, corp
     - строится словарь и корпус для оценки когерентности
     - вычисляется когерентность для топиков модели
 
+    в режиме sweep_mode='shared' UMAP обучается один раз на весь перебор, для каждого размера
+    заново выполняется только кластеризация HDBSCAN по уже сниженным эмбеддингам, а BERTopic обучается
+    только для лучшего размера (см. compute_bertopic_coherence_values_shared). sweep_mode='refit' -
+    прежнее поведение, отдельные UMAP и BERTopic на каждый размер
+
     args:
         docs (list of str): список документов для тематического моделирования
         embeddings (np.ndarray | list[list[float]]): матрица sentence-BERT-эмбеддингов тех же документов (`docs`)
@@ -303,71 +1043,146 @@ def compute_bertopic_coherence_values(docs, embeddings, dictionary, tokens, corp
         limit (int): верхняя граница для изменения минимального размера топика
         start (int, optional): начальное значение минимального размера топика. По умолчанию 2
         step (int, optional): шаг изменения минимального размера топика. По умолчанию 3
+        sweep_mode (str, optional): 'shared' или 'refit'. По умолчанию TOPIC_SWEEP_MODE из конфига
 
     returns:
         tuple:
-            - topic_models (list): список обученных моделей BERTopic
+            - topic_models (list): список обученных моделей BERTopic (в режиме 'shared' - одна, лучшая)
             - coherence_values (list): список значений когерентности, соответствующих моделям
     """
+    if sweep_mode == 'shared':
+        return compute_bertopic_coherence_values_shared(
+            docs, embeddings, dictionary, tokens, corpus, limit, start=start, step=step
+        )
+    if sweep_mode != 'refit':
+        raise ValueError("sweep_mode должен быть 'shared' или 'refit'")
+
+    from bertopic import BERTopic
+
+    topic_backend = registry.get("topic_backend")
     coherence_values = []
     topic_models = []
 
     for size in range(start, limit, step):
-        # на GPU модели
-        umap_model = GPU_UMAP(n_components=5, n_neighbors=15, min_dist=0.0, metric="cosine")
-        hdbscan_model = GPU_HDBSCAN(min_cluster_size=size)
+        umap_model = topic_backend.make_reducer(len(docs))
+        hdbscan_model = topic_backend.make_clusterer(size, len(docs))
 
         topic_model = BERTopic(
             min_topic_size=size,
             language="russian",
             calculate_probabilities=False,
             nr_topics=10,
-            vectorizer_model=vectorizer_model,
+            vectorizer_model=registry.get("vectorizer"),
             umap_model=umap_model,
             hdbscan_model=hdbscan_model
         )
 
         topics, _ = topic_model.fit_transform(docs, embeddings)
 
-        model_topics = {
-            topic: words for topic, words in topic_model.get_topics().items()
-            if words and topic != -1
-        }
-
-        topic_words = [
-            [word for word, _ in model_topics[topic]]
-            for topic in model_topics
-        ]
-
-        if not topic_words:
+        coherence = _topic_coherence(topic_model, dictionary, tokens, corpus)
+        if coherence is None:
             continue  # пропускаем модель без тем
 
-        coherence_model = CoherenceModel(
-            topics=topic_words,
-            texts=tokens,
-            corpus=corpus,
-            dictionary=dictionary,
-            coherence="c_v",
-            processes=4
-        )
-        coherence_values.append(coherence_model.get_coherence())
+        coherence_values.append(coherence)
         topic_models.append(topic_model)
 
     return topic_models, coherence_values
 
 
-def kw_counter(texts):
+def compute_bertopic_coherence_values_shared(docs, embeddings, dictionary, tokens, corpus, limit, start=2, step=1):
+    """
+    перебор min_cluster_size с одним снижением размерности на все кандидаты
+
+    - UMAP обучается один раз, сниженные эмбеддинги переиспользуются для каждого размера
+    - для каждого размера только HDBSCAN по 5-мерным точкам (на порядки дешевле UMAP)
+    - одинаковые разбиения (разные размеры часто дают одни и те же кластеры) оцениваются один раз
+    - кандидат оценивается по меткам HDBSCAN: слова тем - c-TF-IDF по матрице счётчиков, посчитанной
+      один раз на перебор (_ctfidf_topic_words), и когерентность по ним. слияние до nr_topics при этом
+      не выполняется - кандидаты сравниваются по темам самой кластеризации
+    - BERTopic целиком (c-TF-IDF, слияние до nr_topics, представление тем) обучается один раз,
+      для лучшего размера: готовые метки через BaseCluster и тождественное снижение размерности
+
+    общую иерархию HDBSCAN не используем: min_samples по умолчанию равен min_cluster_size,
+    поэтому дерево для разных размеров разное
+
+    args как у compute_bertopic_coherence_values
+    returns:
+        tuple: ([модель BERTopic лучшего размера], [когерентность его разбиения]) или ([], []), если тем нет ни у кого
+    """
+    from bertopic import BERTopic
+    from bertopic.cluster import BaseCluster
+    from bertopic.dimensionality import BaseDimensionalityReduction
+    from sklearn.base import clone
+
+    topic_backend = registry.get("topic_backend")
+
+    umap_model = topic_backend.make_reducer(len(docs))
+    with stage("umap"):
+        reduced = umap_model.fit_transform(embeddings)
+
+    # общий CountVectorizer из реестра не переобучаем - BERTopic обучает его сам
+    vectorizer = clone(registry.get("vectorizer"))
+    with stage("ctfidf"):
+        counts = vectorizer.fit_transform(docs).tocsr()
+    words = vectorizer.get_feature_names_out()
+
+    best = None
+    seen = set()
+    for size in range(start, limit, step):
+        with stage("hdbscan"):
+            labels = np.asarray(topic_backend.make_clusterer(size, len(docs)).fit_predict(reduced))
+        signature = labels.tobytes()
+        if signature in seen:
+            continue
+        seen.add(signature)
+
+        with stage("ctfidf"):
+            topic_words = _ctfidf_topic_words(labels, counts, words)
+        coherence = _coherence(topic_words, dictionary, tokens, corpus)
+        if coherence is None:
+            continue  # пропускаем разбиение без тем
+        if best is None or coherence > best[0]:
+            best = (coherence, size, labels)
+
+    if best is None:
+        return [], []
+    coherence, size, labels = best
+    topic_model = BERTopic(
+        min_topic_size=size,
+        language="russian",
+        calculate_probabilities=False,
+        nr_topics=10,
+        vectorizer_model=registry.get("vectorizer"),
+        umap_model=BaseDimensionalityReduction(),
+        hdbscan_model=BaseCluster()
+    )
+    # исходные эмбеддинги нужны BERTopic для эмбеддингов тем при слиянии до nr_topics,
+    # кластеры уже заданы метками
+    with stage("bertopic_fit"):
+        topic_model.fit_transform(docs, embeddings, y=labels)
+
+    return [topic_model], [coherence]
+
+
+def kw_counter(texts, weights=None):
     """
     подсчитывает 10 наиболее часто встречающихся слов в списке текстов
 
     args:
         texts (list of str): список текстов, в которых необходимо подсчитать слова
+        weights (list of int, optional): сколько раз встречался каждый текст (после схлопывания дубликатов)
 
     returns:
         list of tuples: список кортежей, где каждый кортеж содержит слово и его частоту, отсортированные по убыванию
     """
-    words = ' '.join(texts).split()
-    counter = Counter(words)
+    if weights is None:
+        words = ' '.join(texts).split()
+        counter = Counter(words)
+        return counter.most_common(10)
+    counter = Counter()
+    for text, weight in zip(texts, weights):
+        for word in text.split():
+            counter[word] += weight
     return counter.most_common(10)
 
 def load_stop_words():
@@ -379,7 +1194,7 @@ def load_stop_words():
         stop_words_csv = pd.read_csv('stop_words.csv')['word'].to_list()
     except Exception:
         stop_words_csv = []
-    stop_words_nltk = nltk.corpus.stopwords.words("russian")
+    stop_words_nltk = registry.get("stopwords")
     return set(stop_words_csv + stop_words_nltk)
 
 def split_reviews(text: str):
@@ -387,7 +1202,26 @@ def split_reviews(text: str):
     Разбивает входной текст на список отзывов по переводам строки.
     Отфильтровывает пустые строки.
     """
-    reviews = [line.strip() for line in text.splitlines() if line.strip()]
-    if not reviews:
-        raise ValueError("Не удалось выделить ни одного отзыва из входного текста")
-    return reviews
\ No newline at end of file
+    return split_review_lines(text.splitlines())
+
+
+def split_review_lines(lines):
+    """
+    то же по итератору строк (например, читаемых потоком из хранилища payload'ов)
+    """
+    return list(iter_review_lines(lines))
+
+
+def iter_review_lines(lines):
+    """
+    ленивый вариант split_review_lines: отзывы отдаются по одному, не собираясь в список.
+    ValueError - по исчерпании строк, если ни одного отзыва не было
+    """
+    empty = True
+    for line in lines:
+        line = line.strip()
+        if line:
+            empty = False
+            yield line
+    if empty:
+        raise ValueError("Не удалось выделить ни одного отзыва из входного текста")
\ No newline at end of file
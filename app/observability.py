@@ -0,0 +1,100 @@
+import contextvars
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram
+
+STAGE_LATENCY = Histogram(
+    "pipeline_stage_seconds", "Time spent in one pipeline stage", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+PIPELINE_FALLBACKS = Counter(
+    "pipeline_fallbacks_total", "Degraded paths taken instead of the normal pipeline", ["reason"]
+)
+PIPELINE_REVIEWS = Histogram(
+    "pipeline_reviews", "Reviews per request at each phase (input, deduped, representatives)", ["phase"],
+    buckets=(1, 10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000),
+)
+LLM_LATENCY = Histogram(
+    "llm_request_seconds", "Upstream LLM request latency (one attempt)", ["upstream", "outcome"],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120),
+)
+LLM_QUEUE_WAIT = Histogram(
+    "llm_queue_wait_seconds", "Time waiting for a free upstream concurrency slot", ["upstream"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+LLM_PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens", "Prompt tokens per upstream request", ["upstream"],
+    buckets=(64, 128, 256, 512, 1024, 2048, 3072, 4096, 6144, 8192, 16384),
+)
+EMBEDDING_STORE_LOOKUPS = Counter(
+    "embedding_store_lookups_total", "Embedding store lookups", ["result"]
+)
+LLM_RETRIED = Counter(
+    "llm_retries_total", "Upstream LLM attempts that were retried", ["upstream"]
+)
+
+# контекст трассировки в формате W3C traceparent: 00-<trace_id 32 hex>-<span_id 16 hex>-01
+TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_span_id = contextvars.ContextVar("span_id", default=None)
+
+
+def _new_id(n_bytes: int) -> str:
+    return os.urandom(n_bytes).hex()
+
+
+def current_trace_id():
+    return _trace_id.get()
+
+
+def current_traceparent():
+    """
+    заголовок traceparent для передачи дальше (HTTP, сообщение Celery); None вне трассы
+    """
+    trace_id = _trace_id.get()
+    if trace_id is None:
+        return None
+    return f"00-{trace_id}-{_span_id.get() or _new_id(8)}-01"
+
+
+def start_trace(traceparent: str = None):
+    """
+    продолжает трассу из входящего traceparent или начинает новую в текущем контексте.
+    returns:
+        str: trace_id
+    """
+    match = TRACEPARENT_RE.match(traceparent or "")
+    trace_id = match.group(1) if match else _new_id(16)
+    _trace_id.set(trace_id)
+    _span_id.set(match.group(2) if match else None)
+    return trace_id
+
+
+@contextmanager
+def stage(name: str):
+    """
+    замер стадии конвейера: время в pipeline_stage_seconds{stage} (с trace_id в exemplar,
+    чтобы из Grafana перейти от хвоста гистограммы к конкретному запросу) и строка лога со span'ом
+    """
+    parent = _span_id.get()
+    token = _span_id.set(_new_id(8))
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        duration = time.monotonic() - started
+        trace_id = _trace_id.get()
+        if trace_id is not None:
+            STAGE_LATENCY.labels(stage=name).observe(duration, exemplar={"trace_id": trace_id})
+            logging.info(f"span {name} trace={trace_id} span={_span_id.get()} parent={parent} {duration:.3f}s")
+        else:
+            STAGE_LATENCY.labels(stage=name).observe(duration)
+        _span_id.reset(token)
+
+
+def fallback(reason: str):
+    PIPELINE_FALLBACKS.labels(reason=reason).inc()
@@ -0,0 +1,203 @@
+"""
+эмбеддер MiniLM на ONNX Runtime с динамической int8-квантизацией - для CPU-подов без torch на горячем пути
+
+экспорт (один раз, в каталог на общем томе ноды; нужны torch, transformers, onnx):
+
+    python -m app.onnx_embedder --out /var/cache/comments_summary/onnx
+
+проверка точности и скорости относительно torch - bench/onnx_check.py
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+from app.config import (
+    EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_THREADS,
+    EMBEDDING_ONNX_MAX_LENGTH, EMBEDDING_ONNX_BUCKET,
+)
+from app.observability import fallback
+
+EMBEDDING_BACKENDS = ("torch", "onnx")
+MODEL_FILE = "model.int8.onnx"
+TOKENIZER_FILE = "tokenizer.json"
+META_FILE = "meta.json"
+INPUT_NAMES = ("input_ids", "attention_mask", "token_type_ids")
+
+
+def embedding_backend(backend: str = EMBEDDING_BACKEND, model_dir: str = EMBEDDING_ONNX_DIR) -> str:
+    """
+    реализация эмбеддера: 'onnx', только если модель экспортирована в model_dir, иначе 'torch'
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"EMBEDDING_BACKEND должен быть одним из {list(EMBEDDING_BACKENDS)}, а не '{backend}'")
+    if backend == "onnx" and not os.path.exists(os.path.join(model_dir, META_FILE)):
+        logging.warning(f"No exported ONNX embedder in {model_dir}, using torch")
+        fallback("embedding_onnx_missing")
+        return "torch"
+    return backend
+
+
+def embedding_store_model_name(backend: str = EMBEDDING_BACKEND, model_dir: str = EMBEDDING_ONNX_DIR) -> str:
+    """
+    имя модели для ключей EmbeddingStore: int8-векторы немного отличаются от torch,
+    поэтому в хранилище не смешиваются с ними
+    """
+    if embedding_backend(backend, model_dir) != "onnx":
+        return EMBEDDING_MODEL_NAME
+    with open(os.path.join(model_dir, META_FILE), encoding="utf-8") as f:
+        meta = json.load(f)
+    return f"{meta['model_name']}:onnx-{meta['quantization']}"
+
+
+class OnnxEmbedder:
+    """
+    кодировщик с интерфейсом SentenceTransformer.encode (подставляется в EmbeddingBatcher и encode_with_store)
+
+    - токенизация библиотекой tokenizers (без transformers/torch), обрезка до max_length токенов
+    - тексты сортируются по числу токенов и идут пачками по batch_size; пачка дополняется паддингом
+      до длины, кратной bucket - короткие отзывы не платят за длинные, а разных форм входа немного
+    - mean pooling по маске внимания, как у paraphrase-multilingual-MiniLM-L12-v2 (без нормализации)
+    - intra-op потоков threads, inter-op - один; арена памяти выключена, чтобы RSS воркера
+      не оставался на пике самой длинной пачки
+    - сессия ONNX Runtime не переживает fork (пулы потоков), поэтому в реестре fork_safe=False:
+      каждый воркер открывает свою сессию из одного и того же файла модели
+    """
+
+    def __init__(self, model_dir: str = EMBEDDING_ONNX_DIR, threads: int = EMBEDDING_ONNX_THREADS,
+                 max_length: int = EMBEDDING_ONNX_MAX_LENGTH, bucket: int = EMBEDDING_ONNX_BUCKET):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, META_FILE), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.max_length = min(max_length, self.meta["max_length"])
+        self.bucket = max(1, bucket)
+        self.pad_id = self.meta["pad_token_id"]
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, TOKENIZER_FILE))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(self.max_length)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.enable_cpu_mem_arena = False
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, MODEL_FILE), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def get_sentence_embedding_dimension(self):
+        return self.meta["dim"]
+
+    def _forward(self, encodings, lengths):
+        width = min(-(-int(lengths.max()) // self.bucket) * self.bucket, self.max_length)
+        ids = np.full((len(encodings), width), self.pad_id, dtype=np.int64)
+        mask = np.zeros((len(encodings), width), dtype=np.int64)
+        for row, (encoding, length) in enumerate(zip(encodings, lengths)):
+            ids[row, :length] = encoding.ids
+            mask[row, :length] = 1
+        feed = {"input_ids": ids, "attention_mask": mask}
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.zeros_like(ids)
+        hidden = self.session.run(["last_hidden_state"], feed)[0]
+        summed = (hidden * mask[:, :, None]).sum(axis=1)
+        return summed / np.maximum(mask.sum(axis=1, keepdims=True), 1)
+
+    def encode(self, texts, batch_size: int = 64, show_progress_bar: bool = False):
+        """
+        returns:
+            np.ndarray: матрица (len(texts), dim) float32 в порядке texts
+        """
+        texts = list(texts)
+        result = np.empty((len(texts), self.meta["dim"]), dtype=np.float32)
+        if not texts:
+            return result
+        encodings = self.tokenizer.encode_batch(texts)
+        lengths = np.array([len(encoding.ids) for encoding in encodings])
+        order = np.argsort(lengths, kind="stable")
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            result[batch] = self._forward([encodings[i] for i in batch], lengths[batch])
+        return result
+
+
+def export(out_dir: str, model_name: str = EMBEDDING_MODEL_NAME, max_length: int = EMBEDDING_ONNX_MAX_LENGTH,
+           opset: int = 14, per_channel: bool = True, keep_fp32: bool = False):
+    """
+    экспортирует трансформер SentenceTransformer-модели в ONNX (динамические batch и длина),
+    квантизует веса в int8 (quantize_dynamic: MatMul/Gather, активации квантуются на лету)
+    и кладёт рядом tokenizer.json и meta.json
+
+    returns:
+        str: путь к int8-модели
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.config.return_dict = False
+    model.eval()
+
+    sample = tokenizer(["Отличный товар, доставка быстрая", "Брак"], padding=True, return_tensors="pt")
+    input_names = [name for name in INPUT_NAMES if name in sample]
+    output_names = ["last_hidden_state", "pooler_output"]
+    fp32_path = os.path.join(out_dir, "model.fp32.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(sample[name] for name in input_names), fp32_path,
+            input_names=input_names, output_names=output_names,
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in input_names + output_names[:1]},
+            opset_version=opset,
+        )
+
+    int8_path = os.path.join(out_dir, MODEL_FILE)
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8, per_channel=per_channel)
+    if not keep_fp32:
+        os.remove(fp32_path)
+
+    tokenizer.backend_tokenizer.save(os.path.join(out_dir, TOKENIZER_FILE))
+    meta = {
+        "model_name": model_name,
+        "max_length": max_length,
+        "dim": model.config.hidden_size,
+        "pad_token_id": tokenizer.pad_token_id,
+        "pooling": "mean",
+        "quantization": "int8",
+        "per_channel": per_channel,
+        "opset": opset,
+        "exported_at": datetime.datetime.utcnow().isoformat(),
+    }
+    with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    logging.info(f"Exported {model_name} to {int8_path} ({os.path.getsize(int8_path) / 2 ** 20:.0f} MiB)")
+    return int8_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=EMBEDDING_ONNX_DIR, help="каталог для модели")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--max-length", type=int, default=EMBEDDING_ONNX_MAX_LENGTH)
+    parser.add_argument("--opset", type=int, default=14)
+    parser.add_argument("--per-tensor", action="store_true", help="одна шкала на тензор вместо шкалы на канал")
+    parser.add_argument("--keep-fp32", action="store_true", help="оставить неквантизованную модель рядом")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    path = export(args.out, args.model, args.max_length, args.opset, not args.per_tensor, args.keep_fp32)
+    print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
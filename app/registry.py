@@ -0,0 +1,84 @@
+import logging
+import os
+import threading
+import time
+
+
+class ModelRegistry:
+    """
+    реестр тяжёлых компонентов (Mystem, эмбеддер, стоп-слова, бэкенд тем), загружаемых при первом обращении
+
+    - get(name) загружает компонент один раз на процесс (потокобезопасно)
+    - fork_safe=False - компонент нельзя унаследовать через fork (подпроцесс Mystem, CUDA):
+      в дочернем процессе он будет загружен заново
+    - warm_up(names) - явная загрузка заранее: в мастере gunicorn до fork (--preload)
+      или в фоне после старта воркера; ready(names) - всё ли из списка загружено
+    """
+
+    def __init__(self):
+        self._loaders = {}
+        self._instances = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, loader, fork_safe: bool = True):
+        self._loaders[name] = (loader, fork_safe)
+        self._locks[name] = threading.Lock()
+
+    def _cached(self, name: str):
+        item = self._instances.get(name)
+        if item is None:
+            return None
+        instance, pid = item
+        _, fork_safe = self._loaders[name]
+        if not fork_safe and pid != os.getpid():
+            return None
+        return item
+
+    def get(self, name: str):
+        item = self._cached(name)
+        if item is not None:
+            return item[0]
+        if name not in self._loaders:
+            raise KeyError(f"Неизвестный компонент '{name}'")
+        with self._locks[name]:
+            item = self._cached(name)
+            if item is not None:
+                return item[0]
+            loader, _ = self._loaders[name]
+            started = time.monotonic()
+            instance = loader()
+            logging.info(f"Loaded {name} in {time.monotonic() - started:.1f}s")
+            self._instances[name] = (instance, os.getpid())
+            return instance
+
+    def forget(self, name: str):
+        """
+        выгружает компонент: следующий get() загрузит его заново (например, после register() с другим загрузчиком)
+        """
+        with self._locks[name]:
+            self._instances.pop(name, None)
+
+    def loaded(self):
+        return [name for name in self._loaders if self._cached(name) is not None]
+
+    def ready(self, names) -> bool:
+        return all(self._cached(name) is not None for name in names)
+
+    def warm_up(self, names):
+        """
+        загружает перечисленные компоненты; ошибки логируются, чтобы упавший прогрев не ронял процесс
+        (компонент попробует загрузиться ещё раз при первом обращении)
+        """
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as err:
+                logging.error(f"Warm-up of {name} failed: {err}")
+
+
+registry = ModelRegistry()
+
+
+def parse_names(value: str):
+    return [name.strip() for name in value.split(",") if name.strip()]
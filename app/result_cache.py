@@ -0,0 +1,190 @@
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import anyio
+from prometheus_client import Counter
+
+from app.config import RESULT_CACHE_SIZE, RESULT_CACHE_TTL, RESULT_CACHE_DB_MAX_ROWS, RESULT_CACHE_DB_ENABLED
+from app.database import SessionLocal, ResultCacheEntry
+
+RESULT_CACHE_HITS = Counter("result_cache_hits_total", "Result cache hits", ["kind", "tier"])
+RESULT_CACHE_MISSES = Counter("result_cache_misses_total", "Result cache misses", ["kind"])
+
+
+def normalize_review(review: str) -> str:
+    return ' '.join(review.split()).lower()
+
+
+def reviews_digest(reviews, weights=None) -> str:
+    """
+    дайджест набора отзывов, не зависящий от их порядка и лишних пробелов/регистра.
+    weights - число повторов каждого отзыва: дайджест тот же, что у списка с повторами
+    """
+    if weights is None:
+        weights = [1] * len(reviews)
+    digest = hashlib.sha256()
+    for review, weight in sorted(zip((normalize_review(r) for r in reviews), weights)):
+        item = review.encode("utf-8") + b"\0"
+        for _ in range(weight):
+            digest.update(item)
+    return digest.hexdigest()
+
+
+def prompt_version(system_prompt: str) -> str:
+    return hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:12]
+
+
+def request_fingerprint(req_data: dict) -> dict:
+    """
+    параметры запроса к vLLM, влияющие на ответ: модель, параметры сэмплирования и версия системного промпта
+    (пользовательское сообщение с отзывами не входит - его покрывает reviews_digest)
+    """
+    params = {k: v for k, v in req_data.items() if k not in ("messages", "stream")}
+    system = [m["content"] for m in req_data.get("messages", []) if m["role"] == "system"]
+    params["prompt_version"] = prompt_version(''.join(system))
+    return params
+
+
+def result_key(kind: str, reviews, fingerprint: dict, weights=None, **extra) -> str:
+    """
+    ключ кэша результата: вид результата, дайджест отзывов (с повторами weights), параметры запроса к LLM
+    и дополнительные параметры конвейера (например, режим отбора репрезентативных отзывов)
+    """
+    payload = json.dumps(
+        {"kind": kind, "reviews": reviews_digest(reviews, weights), "request": fingerprint, "extra": extra},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    двухуровневый кэш готовых саммари/атрибутов
+
+    - L1: LRU в памяти процесса (RESULT_CACHE_SIZE записей)
+    - L2: таблица result_cache в Postgres, общая для всех воркеров и Celery
+    - у записей TTL (RESULT_CACHE_TTL секунд); в Postgres хранится не больше RESULT_CACHE_DB_MAX_ROWS
+      записей, лишние удаляются начиная с самых старых
+    """
+
+    def __init__(self, size: int = RESULT_CACHE_SIZE, ttl: int = RESULT_CACHE_TTL,
+                 db_max_rows: int = RESULT_CACHE_DB_MAX_ROWS, db_enabled: bool = RESULT_CACHE_DB_ENABLED):
+        self.size = size
+        self.ttl = ttl
+        self.db_max_rows = db_max_rows
+        self.db_enabled = db_enabled
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def _memory_get(self, key: str):
+        with self._lock:
+            item = self._memory.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return value
+
+    def _memory_put(self, key: str, value, expires_at: float):
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.size:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str, kind: str = "result", record: bool = True):
+        """
+        record=False - не учитывать обращение в метриках (например, при опросе в singleflight)
+        """
+        value = self._memory_get(key)
+        if value is not None:
+            if record:
+                RESULT_CACHE_HITS.labels(kind=kind, tier="memory").inc()
+            return value
+        if self.db_enabled:
+            try:
+                session = SessionLocal()
+                try:
+                    entry = session.get(ResultCacheEntry, key)
+                    if entry is not None and entry.expires_at > datetime.datetime.utcnow():
+                        value = json.loads(entry.value)
+                        self._memory_put(key, value, entry.expires_at.replace(tzinfo=datetime.timezone.utc).timestamp())
+                        if record:
+                            RESULT_CACHE_HITS.labels(kind=kind, tier="postgres").inc()
+                        return value
+                finally:
+                    session.close()
+            except Exception as err:
+                logging.warning(f"Result cache lookup failed: {err}")
+        if record:
+            RESULT_CACHE_MISSES.labels(kind=kind).inc()
+        return None
+
+    def put(self, key: str, value):
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, value, expires_at)
+        if not self.db_enabled:
+            return
+        try:
+            session = SessionLocal()
+            try:
+                session.merge(ResultCacheEntry(
+                    key=key,
+                    value=json.dumps(value, ensure_ascii=False),
+                    created_at=datetime.datetime.utcnow(),
+                    expires_at=datetime.datetime.utcfromtimestamp(expires_at),
+                ))
+                session.commit()
+            finally:
+                session.close()
+            self._puts += 1
+            if self._puts % 100 == 0:
+                self.purge()
+        except Exception as err:
+            logging.warning(f"Result cache store failed: {err}")
+
+    def purge(self):
+        """
+        удаляет из Postgres просроченные записи и самые старые сверх db_max_rows
+        """
+        session = SessionLocal()
+        try:
+            session.query(ResultCacheEntry).filter(
+                ResultCacheEntry.expires_at <= datetime.datetime.utcnow()
+            ).delete(synchronize_session=False)
+            cutoff = (
+                session.query(ResultCacheEntry.created_at)
+                .order_by(ResultCacheEntry.created_at.desc())
+                .offset(self.db_max_rows).limit(1).scalar()
+            )
+            if cutoff is not None:
+                session.query(ResultCacheEntry).filter(
+                    ResultCacheEntry.created_at <= cutoff
+                ).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    async def aget(self, key: str, kind: str = "result", record: bool = True):
+        value = self._memory_get(key)
+        if value is not None:
+            if record:
+                RESULT_CACHE_HITS.labels(kind=kind, tier="memory").inc()
+            return value
+        # поход в Postgres - в пуле потоков, чтобы не блокировать event loop
+        return await anyio.to_thread.run_sync(self.get, key, kind, record)
+
+    async def aput(self, key: str, value):
+        await anyio.to_thread.run_sync(self.put, key, value)
+
+
+result_cache = ResultCache()
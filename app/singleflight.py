@@ -0,0 +1,243 @@
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import time
+import uuid
+
+import anyio
+from prometheus_client import Counter
+from sqlalchemy.dialects.postgresql import insert
+
+from app.config import (
+    SINGLEFLIGHT_DB_ENABLED, SINGLEFLIGHT_LEASE_TTL, SINGLEFLIGHT_POLL_INTERVAL, SINGLEFLIGHT_MAX_ATTEMPTS,
+)
+from app.database import SessionLocal, InflightLease
+from app.result_cache import result_cache
+
+SINGLEFLIGHT_COALESCED = Counter(
+    "singleflight_coalesced_total", "Requests served by another request's computation", ["scope"]
+)
+SINGLEFLIGHT_LEADER_FAILURES = Counter(
+    "singleflight_leader_failures_total", "Followers that retried because the leader failed"
+)
+SINGLEFLIGHT_UNCACHED = Counter(
+    "singleflight_uncached_total", "Followers that computed themselves because the leader's result is not cached"
+)
+
+# состояния аренды для ожидающих
+LEASE_RUNNING = "running"
+LEASE_NO_RESULT = "no_result"
+
+
+class SingleFlight:
+    """
+    склейка одинаковых одновременных вычислений по ключу результата (тот же ключ, что у result_cache)
+
+    - в процессе: первый запрос (лидер) считает, остальные ждут его future
+    - между процессами (воркеры gunicorn, Celery): лидер берёт аренду в таблице inflight_leases,
+      остальные опрашивают result_cache, пока аренда жива. результат в кэш кладёт сама функция fn
+    - если лидер упал (future с ошибкой или аренда снята без результата), ожидающие пробуют снова
+      и один из них становится новым лидером; после max_attempts считают сами без склейки
+    - если лидер досчитал, а результат другим процессам не виден (не кэшируется - LLM выключен, пустые атрибуты -
+      или кэш без Postgres), он оставляет в аренде отметку no_result на несколько интервалов опроса -
+      ожидающие сразу считают сами, а не по очереди
+    """
+
+    def __init__(self, cache=result_cache, db_enabled: bool = SINGLEFLIGHT_DB_ENABLED,
+                 lease_ttl: int = SINGLEFLIGHT_LEASE_TTL, poll_interval: float = SINGLEFLIGHT_POLL_INTERVAL,
+                 max_attempts: int = SINGLEFLIGHT_MAX_ATTEMPTS):
+        self.cache = cache
+        self.db_enabled = db_enabled
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self._inflight = {}
+
+    @staticmethod
+    def _owner() -> str:
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _acquire(self, key: str, owner: str) -> bool:
+        now = datetime.datetime.utcnow()
+        stmt = insert(InflightLease).values(
+            key=key, owner=owner, expires_at=now + datetime.timedelta(seconds=self.lease_ttl), no_result=False
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[InflightLease.key],
+            set_={"owner": stmt.excluded.owner, "expires_at": stmt.excluded.expires_at, "no_result": False},
+            where=InflightLease.expires_at < now,
+        ).returning(InflightLease.owner)
+        session = SessionLocal()
+        try:
+            row = session.execute(stmt).first()
+            session.commit()
+            return row is not None and row[0] == owner
+        finally:
+            session.close()
+
+    def _release(self, key: str, owner: str, no_result: bool = False):
+        """
+        снимает аренду; no_result=True - вместо этого оставляет отметку, что результата в кэше не будет
+        """
+        session = SessionLocal()
+        try:
+            query = session.query(InflightLease).filter_by(key=key, owner=owner)
+            if no_result:
+                expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=4 * self.poll_interval + 1)
+                query.update({"no_result": True, "expires_at": expires_at}, synchronize_session=False)
+            else:
+                query.delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def _lease_state(self, key: str):
+        """
+        None - аренды нет или она истекла, LEASE_RUNNING - лидер считает, LEASE_NO_RESULT - досчитал без кэша
+        """
+        session = SessionLocal()
+        try:
+            lease = session.get(InflightLease, key)
+            if lease is None or lease.expires_at <= datetime.datetime.utcnow():
+                return None
+            return LEASE_NO_RESULT if lease.no_result else LEASE_RUNNING
+        finally:
+            session.close()
+
+    async def _lead(self, key: str, fn):
+        """
+        вычисление под межпроцессной арендой; если аренда у другого процесса - ждём его результат
+        """
+        if not self.db_enabled:
+            return await fn()
+        owner = self._owner()
+        deadline = time.monotonic() + self.lease_ttl
+        while True:
+            try:
+                acquired = await anyio.to_thread.run_sync(self._acquire, key, owner)
+            except Exception as err:
+                logging.warning(f"Singleflight lease failed, computing without it: {err}")
+                return await fn()
+            if acquired:
+                no_result = False
+                try:
+                    value = await fn()
+                    no_result = not self.cache.db_enabled or await self.cache.aget(key, record=False) is None
+                    return value
+                finally:
+                    try:
+                        await anyio.to_thread.run_sync(self._release, key, owner, no_result)
+                    except Exception as err:
+                        logging.warning(f"Singleflight lease release failed: {err}")
+
+            while True:
+                state = await anyio.to_thread.run_sync(self._lease_state, key)
+                if state is None:
+                    break
+                value = await self.cache.aget(key, record=False)
+                if value is not None:
+                    SINGLEFLIGHT_COALESCED.labels(scope="cluster").inc()
+                    return value
+                if state == LEASE_NO_RESULT:
+                    SINGLEFLIGHT_UNCACHED.inc()
+                    return await fn()
+                if time.monotonic() > deadline:
+                    return await fn()
+                await asyncio.sleep(self.poll_interval)
+            value = await self.cache.aget(key, record=False)
+            if value is not None:
+                SINGLEFLIGHT_COALESCED.labels(scope="cluster").inc()
+                return value
+            # аренду сняли, а результата нет - лидер в другом процессе упал, пробуем стать лидером
+            SINGLEFLIGHT_LEADER_FAILURES.inc()
+
+    async def do(self, key: str, fn):
+        """
+        возвращает результат fn() (async, без аргументов), склеивая одновременные вызовы с тем же key
+        """
+        for _ in range(self.max_attempts):
+            future = self._inflight.get(key)
+            if future is not None:
+                try:
+                    value = await asyncio.shield(future)
+                    SINGLEFLIGHT_COALESCED.labels(scope="process").inc()
+                    return value
+                except asyncio.CancelledError:
+                    if not future.cancelled():
+                        raise
+                except Exception:
+                    pass
+                SINGLEFLIGHT_LEADER_FAILURES.inc()
+                continue
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            try:
+                value = await self._lead(key, fn)
+            except Exception as err:
+                future.set_exception(err)
+                # ошибка уже отдана лидеру; помечаем её прочитанной, чтобы asyncio не ругался
+                future.exception()
+                raise
+            except BaseException:
+                # лидера отменили (клиент отключился) - ожидающие перезапустят вычисление
+                future.cancel()
+                raise
+            else:
+                future.set_result(value)
+                return value
+            finally:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+        return await fn()
+
+    def do_sync(self, key: str, fn):
+        """
+        синхронный вариант для задач Celery: только межпроцессная аренда
+        """
+        if not self.db_enabled:
+            return fn()
+        owner = self._owner()
+        deadline = time.monotonic() + self.lease_ttl
+        while True:
+            try:
+                acquired = self._acquire(key, owner)
+            except Exception as err:
+                logging.warning(f"Singleflight lease failed, computing without it: {err}")
+                return fn()
+            if acquired:
+                no_result = False
+                try:
+                    value = fn()
+                    no_result = not self.cache.db_enabled or self.cache.get(key, record=False) is None
+                    return value
+                finally:
+                    try:
+                        self._release(key, owner, no_result)
+                    except Exception as err:
+                        logging.warning(f"Singleflight lease release failed: {err}")
+
+            while True:
+                state = self._lease_state(key)
+                if state is None:
+                    break
+                value = self.cache.get(key, record=False)
+                if value is not None:
+                    SINGLEFLIGHT_COALESCED.labels(scope="cluster").inc()
+                    return value
+                if state == LEASE_NO_RESULT:
+                    SINGLEFLIGHT_UNCACHED.inc()
+                    return fn()
+                if time.monotonic() > deadline:
+                    return fn()
+                time.sleep(self.poll_interval)
+            value = self.cache.get(key, record=False)
+            if value is not None:
+                SINGLEFLIGHT_COALESCED.labels(scope="cluster").inc()
+                return value
+            SINGLEFLIGHT_LEADER_FAILURES.inc()
+
+
+singleflight = SingleFlight()
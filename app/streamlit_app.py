@@ -1,6 +1,6 @@
 """
 Streamlit‑GUI для FastAPI‑сервиса:
-  • «Сформировать саммари»  → POST /summarize
+  • «Сформировать саммари»  → POST /summarize (или /summarize/stream в потоковом режиме)
   • «Извлечь атрибуты»      → POST /attributes
 """
 HEADERS = {
@@ -9,6 +9,7 @@ HEADERS = {
 }
 
 import os
+import json
 import requests
 import streamlit as st
 import pandas as pd
@@ -28,6 +29,7 @@ text = st.text_area(
     placeholder="Купил арбуз, он был спелым, сочным…",
 )
 text = text.replace("\r\n", "\n")
+stream_mode = st.checkbox("Показывать саммари по мере генерации", value=True)
 
 
 # вспомогательная обертка post() 
@@ -46,6 +48,28 @@ def post(endpoint: str, payload: dict):
     except requests.exceptions.RequestException as e:
         return None, str(e)
 
+# потоковый post(): читаем Server-Sent Events и отдаём куски текста по мере прихода
+def post_stream(endpoint: str, payload: dict):
+    """генератор кусков текста из SSE-ответа; ошибки поднимаются как RuntimeError"""
+    url = f"{API_URL}/{endpoint}"
+    with requests.post(url, json=payload, headers=HEADERS, stream=True, timeout=(10, 300)) as r:
+        r.raise_for_status()
+        event = None
+        for line in r.iter_lines(decode_unicode=True):
+            if not line:
+                event = None
+                continue
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+                continue
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[len("data:"):])
+            if event == "error":
+                raise RuntimeError(data.get("detail", "ошибка генерации"))
+            if event is None and "delta" in data:
+                yield data["delta"]
+
 # Кнопки действий
 col_sum, col_attr = st.columns(2)
 
@@ -53,6 +77,12 @@ col_sum, col_attr = st.columns(2)
 if col_sum.button("📄 Сформировать саммари", use_container_width=True):
     if not text.strip():
         st.warning("Введите текст перед отправкой запроса.")
+    elif stream_mode:
+        st.subheader("Результат саммари:")
+        try:
+            st.write_stream(post_stream("summarize/stream", {"text": text}))
+        except (requests.exceptions.RequestException, RuntimeError) as e:
+            st.error(str(e))
     else:
         with st.spinner("Генерируем саммари…"):
             data, error = post("summarize", {"text": text})
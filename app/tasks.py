@@ -1,46 +1,124 @@
+import logging
+import time
+
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
 
-from app.models import text_preproc, get_representative_texts, get_summary_vllm, load_stop_words, split_reviews
-from app.database import update_task_status
-from app.config import CELERY_BROKER_URL
+from app.models import get_representative_texts, get_summary_vllm, load_stop_words, split_reviews, iter_review_lines, build_summary_request, llm_enabled, estimate_tokens
+from app.result_cache import result_cache, result_key, request_fingerprint
+from app.singleflight import singleflight
+from app.map_reduce import summarize_map_reduce
+from app.llm_client import open_sync_llm_clients, close_sync_llm_clients
+from app.database import update_task_status, update_task_progress
+from app.registry import registry, parse_names
+from app.blob_store import store_for
+from app.dedup import dedup_reviews, collapse_exact
+from app.observability import start_trace, stage, fallback, STAGE_LATENCY
+from app.config import CELERY_BROKER_URL, CELERY_BROKER_TRANSPORT_OPTIONS, HUGE_SUMMARY_MODE, MAP_REDUCE_CHUNK_TOKENS, WARMUP_MODELS
 
 celery_app = Celery('tasks', broker=CELERY_BROKER_URL)
+celery_app.conf.broker_transport_options = CELERY_BROKER_TRANSPORT_OPTIONS
+
+
+@worker_process_init.connect
+def warm_up_models(**kwargs):
+    # модели грузятся в дочернем процессе, а не в мастере celery: Mystem и CUDA не переживают fork
+    registry.warm_up(parse_names(WARMUP_MODELS))
+
+
+@worker_process_init.connect
+def open_llm_connections(**kwargs):
+    # свой пул соединений к vLLM в каждом процессе воркера, а не унаследованный от мастера
+    open_sync_llm_clients()
+
+
+@worker_process_shutdown.connect
+def close_llm_connections(**kwargs):
+    close_sync_llm_clients()
 
 
 # @celery_app.task
 @celery_app.task(queue='huge_summarize_queue')
-def run_model_in_queue(text: str):
+def run_model_in_queue(text: str = None, blob_ref: str = None):
     """
     Асинхронная задача для инференса если отзывов ОЧЕНЬ много и надо подождать пока ЛЛМ их пережует:
-      1. Разбивает входной текст на список отзывов.
+      1. Разбивает входной текст на список отзывов. Большие тексты приходят не в сообщении,
+         а ссылкой blob_ref на хранилище payload'ов (claim-check): они читаются потоком
+         и удаляются из хранилища, когда задача завершилась (успешно или с ошибкой).
       2. Загружает стоп-слова.
-      3. Для каждого отзыва получает лемматизированный вариант с помощью text_preproc.
-      4. Пытается вычислить репрезентативные отзывы с помощью get_representative_texts.
-         Если возникает ошибка, берутся первые 5 отзывов.
-      5. Вызывается функция get_summary для получения саммари.
-      6. Обновляет статус задачи в базе данных (от "started" до "completed" или "error").
+      3. Схлопывает точные и почти-дубликаты (dedup_reviews) и лемматизирует оставшиеся отзывы,
+         дальше всё считается по ним с весами дубликатов.
+      4. Если отзывы не помещаются в один промпт (и HUGE_SUMMARY_MODE='map_reduce'),
+         строится иерархическое саммари summarize_map_reduce; прогресс пишется в запись задачи.
+      5. Иначе пытается вычислить репрезентативные отзывы с помощью get_representative_texts
+         (если возникает ошибка, берутся первые 15 отзывов) и вызывает get_summary_vllm.
+         Одинаковый набор отзывов считается один раз: результат берётся из result_cache,
+         а одновременные задачи ждут друг друга через аренду singleflight.
+      6. Обновляет статус задачи в таблице tasks (от "started" до "completed" или "error")
+         и сохраняет результат, чтобы его можно было забрать через /task_status.
     """
     task_id = run_model_in_queue.request.id
+    start_trace(getattr(run_model_in_queue.request, "traceparent", None))
+    enqueued_at = getattr(run_model_in_queue.request, "enqueued_at", None)
+    if enqueued_at is not None:
+        STAGE_LATENCY.labels(stage="celery_queue").observe(max(time.time() - float(enqueued_at), 0))
     update_task_status(task_id=task_id, status="started")
     try:
-        reviews = split_reviews(text)
-        stop_words = load_stop_words()
-        
-        # получаем лемматизированную версию каждого отзыва
-        lemmas = [text_preproc(review, stop_words=stop_words) for review in reviews]
-        
-        try:
-            rep_reviews = get_representative_texts(lemmas, reviews)
-        except Exception:
-            rep_reviews = reviews[:15]
-        
-        # получаем суммарное описание с использованием LLM (функция get_summary из models.py)
-        summary = get_summary_vllm(rep_reviews)
-        
+        if blob_ref is not None:
+            with stage("payload_read"):
+                # payload читается потоком и сразу схлопывается: в памяти только уникальные отзывы с числом повторов,
+                # ключ кэша по ним тот же, что по полному списку
+                reviews, weights = collapse_exact(iter_review_lines(store_for(blob_ref).iter_lines(blob_ref)))
+        else:
+            reviews, weights = split_reviews(text), None
+        key = result_key(
+            "huge_summary", reviews, request_fingerprint(build_summary_request("")), weights=weights,
+            mode=HUGE_SUMMARY_MODE,
+        )
+
+        def compute():
+            stop_words = load_stop_words()
+
+            # схлопываем дубликаты и получаем лемматизированную версию каждого оставшегося отзыва
+            unique_reviews, lemmas, unique_weights = dedup_reviews(reviews, stop_words, weights=weights)
+
+            total_tokens = sum(estimate_tokens(r) for r in unique_reviews)
+            if HUGE_SUMMARY_MODE == 'map_reduce' and total_tokens > MAP_REDUCE_CHUNK_TOKENS:
+                def progress(stage, done, total):
+                    update_task_progress(task_id=task_id, progress=f"{stage} {done}/{total}")
+
+                summary = summarize_map_reduce(unique_reviews, lemmas=lemmas, progress=progress, weights=unique_weights)
+            else:
+                try:
+                    rep_reviews = get_representative_texts(lemmas, unique_reviews, weights=unique_weights)
+                except Exception:
+                    fallback("representatives_first15")
+                    rep_reviews = unique_reviews[:15]
+
+                # получаем суммарное описание с использованием LLM (функция get_summary из models.py)
+                with stage("summary_llm"):
+                    summary = get_summary_vllm(rep_reviews)
+
+            if llm_enabled() and summary:
+                result_cache.put(key, summary)
+            return summary
+
+        # если такой же набор отзывов уже считается в другом воркере/API - ждём его результат
+        summary = result_cache.get(key, kind="huge_summary")
+        if summary is None:
+            summary = singleflight.do_sync(key, compute)
+
         result = {"summary": summary}
-        update_task_status(task_id=task_id, status="completed")
+        update_task_status(task_id=task_id, status="completed", result=result)
         return result
 
     except Exception as e:
-        update_task_status(task_id=task_id, status="error")
+        update_task_status(task_id=task_id, status="error", error=str(e))
         raise e
+
+    finally:
+        if blob_ref is not None:
+            try:
+                store_for(blob_ref).delete(blob_ref)
+            except Exception as err:
+                logging.warning(f"Couldn't delete payload {blob_ref}: {err}")
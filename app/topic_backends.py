@@ -0,0 +1,81 @@
+import logging
+
+from app.config import TOPIC_BACKEND, TOPIC_CPU_FAST_THRESHOLD, TOPIC_CPU_MAX_CLUSTERS, EMBEDDING_DEVICE
+
+
+class GPUTopicBackend:
+    """
+    cuML на GPU: UMAP + HDBSCAN (как было изначально)
+    """
+    name = "gpu"
+
+    def make_reducer(self, n_docs: int):
+        from cuml.manifold import UMAP
+        return UMAP(n_components=5, n_neighbors=15, min_dist=0.0, metric="cosine")
+
+    def make_clusterer(self, min_cluster_size: int, n_docs: int):
+        from cuml.cluster import HDBSCAN
+        return HDBSCAN(min_cluster_size=min_cluster_size)
+
+
+class CPUTopicBackend:
+    """
+    CPU без cuML
+
+    - до TOPIC_CPU_FAST_THRESHOLD документов: umap-learn + hdbscan (то же качество, что на GPU)
+    - больше порога: PCA + MiniBatchKMeans, время почти линейно по числу документов.
+      число кластеров - min(n_docs, max_clusters) // min_cluster_size (не меньше 2): как и у HDBSCAN,
+      больший минимальный размер темы даёт меньше тем. без потолка max_clusters на 100k отзывов выходили бы
+      десятки тысяч центров - k-means на них идёт десятки минут. BERTopic потом всё равно сливает темы до nr_topics=10
+    """
+    name = "cpu"
+
+    def __init__(self, fast_threshold: int = TOPIC_CPU_FAST_THRESHOLD, max_clusters: int = TOPIC_CPU_MAX_CLUSTERS):
+        self.fast_threshold = fast_threshold
+        self.max_clusters = max_clusters
+
+    def _fast(self, n_docs: int) -> bool:
+        return n_docs > self.fast_threshold
+
+    def make_reducer(self, n_docs: int):
+        if self._fast(n_docs):
+            from sklearn.decomposition import PCA
+            return PCA(n_components=5, random_state=42)
+        from umap import UMAP
+        return UMAP(n_components=5, n_neighbors=15, min_dist=0.0, metric="cosine", low_memory=True)
+
+    def make_clusterer(self, min_cluster_size: int, n_docs: int):
+        if self._fast(n_docs):
+            from sklearn.cluster import MiniBatchKMeans
+            n_clusters = max(2, min(n_docs, self.max_clusters) // min_cluster_size)
+            return MiniBatchKMeans(n_clusters=n_clusters, batch_size=4096, n_init=3, random_state=42)
+        from hdbscan import HDBSCAN
+        return HDBSCAN(min_cluster_size=min_cluster_size, core_dist_n_jobs=-1)
+
+
+TOPIC_BACKENDS = {
+    "gpu": GPUTopicBackend,
+    "cpu": CPUTopicBackend,
+}
+
+
+def get_topic_backend(name: str = TOPIC_BACKEND):
+    """
+    возвращает бэкенд тематического моделирования по имени из конфига (TOPIC_BACKEND)
+    """
+    try:
+        backend = TOPIC_BACKENDS[name]()
+    except KeyError:
+        raise ValueError(f"TOPIC_BACKEND должен быть одним из {sorted(TOPIC_BACKENDS)}, а не '{name}'")
+    logging.info(f"Topic backend: {backend.name}")
+    return backend
+
+
+def embedding_device(device: str = EMBEDDING_DEVICE) -> str:
+    """
+    устройство для SentenceTransformer: 'auto' выбирает cuda, если она доступна, иначе cpu
+    """
+    if device != "auto":
+        return device
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
@@ -0,0 +1,432 @@
+import datetime
+import hashlib
+import io
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from prometheus_client import Counter
+from sqlalchemy.exc import IntegrityError
+
+from app.config import (
+    DEDUP_ENABLED, REPRESENTATIVE_MODE, SELECTION_TOKEN_BUDGET,
+    TOPIC_STATE_CANDIDATES, TOPIC_ASSIGN_QUANTILE, TOPIC_DRIFT_MIN_NEW, TOPIC_DRIFT_OUTLIER_SHARE,
+    TOPIC_DRIFT_CENTROID_SHIFT, TOPIC_DRIFT_MISSING_SHARE, TOPIC_REFIT_GROWTH, TOPIC_STATE_CACHE_SIZE,
+)
+from app.database import SessionLocal, TopicStateRecord
+from app.dedup import collapse_exact, collapse_near
+from app.embedding_store import encode_with_store
+from app.models import text_preproc_batch, fit_topics, count_tokens, select_by_budget, fit_budget
+from app.registry import registry
+from app.result_cache import normalize_review
+from app.observability import stage, fallback
+
+TOPIC_STATE_UPDATES = Counter(
+    "topic_state_updates_total", "Per-product topic state updates", ["action"]
+)
+
+# темы документов в состоянии: номер строки темы, выброс или почти-дубликат, схлопнутый в другой отзыв
+OUTLIER = -1
+MERGED = -2
+ARRAY_FIELDS = (
+    "hashes", "weights", "topics", "parents", "sums", "fit_centroids", "topic_weights", "thresholds",
+    "cand_rows", "cand_hashes", "cand_embeddings",
+)
+
+
+def review_hashes(reviews) -> np.ndarray:
+    """
+    64-битные хэши нормализованных отзывов (как у дедупликации и ключа result_cache - без учёта пробелов и регистра)
+    """
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(normalize_review(r).encode("utf-8"), digest_size=8).digest(), "little")
+         for r in reviews),
+        dtype=np.uint64, count=len(reviews),
+    )
+
+
+def _unit(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def _encode(lemmas):
+    return _unit(encode_with_store(registry.get("embedding_encoder"), lemmas, registry.get("embedding_store")))
+
+
+class TopicState:
+    """
+    темы товара между запросами
+
+    - отзывы: хэши (отсортированы), веса (число точных повторов), номер темы и индекс оставшегося отзыва
+      (у схлопнутого почти-дубликата - отзыв, в который он схлопнут, у остальных - он сам) - по 28 байт на отзыв
+    - темы: взвешенная сумма единичных эмбеддингов (центроид - её направление), центроид на момент обучения,
+      вес темы и порог близости к центроиду, ниже которого новый отзыв считается выбросом
+    - кандидаты: до TOPIC_STATE_CANDIDATES ближайших к центроиду отзывов каждой темы с эмбеддингами и текстами,
+      упорядочены по теме и убыванию близости - из них выбираются репрезентативные
+    - meta: вес отзывов при обучении, вес и выбросы новых отзывов с тех пор, число пропавших отзывов
+    """
+
+    def __init__(self, product_id: str, arrays: dict, cand_texts, meta: dict, version: int = 0):
+        self.product_id = product_id
+        for field in ARRAY_FIELDS:
+            setattr(self, field, arrays[field])
+        self.cand_texts = list(cand_texts)
+        self.meta = meta
+        self.version = version
+
+    @classmethod
+    def fit(cls, product_id: str, unique, weights, stop_words):
+        """
+        обучение с нуля: лемматизация, схлопывание почти-дубликатов, эмбеддинги и перебор BERTopic (fit_topics).
+        returns: TopicState или None, если темы выделить не удалось
+        """
+        weights = np.asarray(weights, dtype=np.int64)
+        lemmas = text_preproc_batch(unique, stop_words=stop_words)
+        if DEDUP_ENABLED:
+            keep, kept_weights, groups = collapse_near(lemmas, weights, return_groups=True)
+        else:
+            keep, kept_weights, groups = list(range(len(unique))), list(weights), list(range(len(unique)))
+        keep = np.asarray(keep, dtype=np.int64)
+        kept_weights = np.asarray(kept_weights, dtype=np.float64)
+        embeddings = _encode([lemmas[i] for i in keep])
+        _, fitted = fit_topics([lemmas[i] for i in keep], embeddings)
+        if fitted is None:
+            return None
+
+        labels = sorted(set(int(t) for t in fitted) - {OUTLIER})
+        if not labels:
+            return None
+        rows = np.array([labels.index(int(t)) if t != OUTLIER else OUTLIER for t in fitted], dtype=np.int32)
+        topics = np.full(len(unique), MERGED, dtype=np.int32)
+        topics[keep] = rows
+
+        inliers = rows >= 0
+        sums = np.zeros((len(labels), embeddings.shape[1]), dtype=np.float64)
+        np.add.at(sums, rows[inliers], embeddings[inliers] * kept_weights[inliers, None])
+        topic_weights = np.bincount(rows[inliers], weights=kept_weights[inliers], minlength=len(labels))
+        centroids = _unit(sums)
+        similarity = (embeddings * centroids[np.maximum(rows, 0)]).sum(axis=1)
+        thresholds = np.array(
+            [np.quantile(similarity[rows == row], TOPIC_ASSIGN_QUANTILE) for row in range(len(labels))],
+            dtype=np.float32,
+        )
+
+        hashes = review_hashes(unique)
+        order = np.argsort(hashes)
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+        arrays = {
+            "hashes": hashes[order],
+            "weights": weights[order],
+            "topics": topics[order],
+            "parents": position[np.asarray(groups, dtype=np.int64)][order],
+            "sums": sums,
+            "fit_centroids": centroids,
+            "topic_weights": topic_weights,
+            "thresholds": thresholds,
+            "cand_rows": rows[inliers],
+            "cand_hashes": hashes[keep][inliers],
+            "cand_embeddings": embeddings[inliers],
+        }
+        cand_texts = [unique[i] for i in keep[inliers]]
+        meta = {
+            "fitted_weight": int(weights.sum()),
+            "new_weight": 0,
+            "outlier_weight": 0,
+            "missing": 0,
+            "fitted_at": datetime.datetime.utcnow().isoformat(),
+        }
+        state = cls(product_id, arrays, cand_texts, meta)
+        state._rank_candidates()
+        return state
+
+    def copy(self):
+        arrays = {field: getattr(self, field).copy() for field in ARRAY_FIELDS}
+        return TopicState(self.product_id, arrays, self.cand_texts, dict(self.meta), self.version)
+
+    def _rank_candidates(self):
+        """
+        оставляет по TOPIC_STATE_CANDIDATES ближайших к текущему центроиду кандидатов на тему
+        """
+        if not len(self.cand_rows):
+            return
+        score = (self.cand_embeddings * _unit(self.sums)[self.cand_rows]).sum(axis=1)
+        order = np.lexsort((-score, self.cand_rows))
+        rows = self.cand_rows[order]
+        group_start = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+        rank = np.arange(len(rows)) - np.repeat(group_start, np.diff(np.r_[group_start, len(rows)]))
+        order = order[rank < TOPIC_STATE_CANDIDATES]
+        self.cand_rows = self.cand_rows[order]
+        self.cand_hashes = self.cand_hashes[order]
+        self.cand_embeddings = self.cand_embeddings[order]
+        self.cand_texts = [self.cand_texts[i] for i in order]
+
+    def update(self, unique, weights, hashes, stop_words) -> bool:
+        """
+        учитывает текущий набор отзывов товара без переобучения:
+        - у известных отзывов меняется только вес (новые точные повторы) - и вес их темы
+          (у схлопнутого почти-дубликата - темы отзыва, в который он схлопнут)
+        - вес пропавших из входа отзывов вычитается из их тем (вернувшийся отзыв добавит его снова)
+        - новые отзывы лемматизируются и кодируются (только они), относятся к ближайшему центроиду
+          или в выбросы, если близость ниже порога темы; центроиды и кандидаты тем сдвигаются
+        returns: изменилось ли состояние
+        """
+        weights = np.asarray(weights, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        known = self.hashes[pos] == hashes
+        changed = False
+
+        idx = pos[known]
+        current = np.zeros_like(self.weights)
+        current[idx] = weights[known]
+        delta = current - self.weights
+        if delta.any():
+            self.weights = current
+            rows = self.topics[self.parents]
+            np.add.at(self.topic_weights, rows[rows >= 0], delta[rows >= 0])
+            changed = True
+        missing = len(self.hashes) - int(known.sum())
+        if missing != self.meta["missing"]:
+            self.meta["missing"] = missing
+            changed = True
+
+        new = np.flatnonzero(~known)
+        if not len(new):
+            return changed
+        texts = [unique[i] for i in new]
+        new_weights = weights[new]
+        embeddings = _encode(text_preproc_batch(texts, stop_words=stop_words))
+        similarity = embeddings @ _unit(self.sums).T
+        best = similarity.argmax(axis=1)
+        inlier = similarity[np.arange(len(new)), best] >= self.thresholds[best]
+        rows = np.where(inlier, best, OUTLIER).astype(np.int32)
+
+        np.add.at(self.sums, rows[inlier], embeddings[inlier] * new_weights[inlier, None])
+        np.add.at(self.topic_weights, rows[inlier], new_weights[inlier])
+        self.cand_rows = np.concatenate([self.cand_rows, rows[inlier]])
+        self.cand_hashes = np.concatenate([self.cand_hashes, hashes[new][inlier]])
+        self.cand_embeddings = np.concatenate([self.cand_embeddings, embeddings[inlier]])
+        self.cand_texts += [text for text, ok in zip(texts, inlier) if ok]
+        self._rank_candidates()
+
+        all_hashes = np.concatenate([self.hashes, hashes[new]])
+        order = np.argsort(all_hashes)
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+        parents = np.concatenate([self.parents, np.arange(len(self.parents), len(all_hashes))])
+        self.hashes = all_hashes[order]
+        self.weights = np.concatenate([self.weights, new_weights])[order]
+        self.topics = np.concatenate([self.topics, rows])[order]
+        self.parents = position[parents][order]
+        self.meta["new_weight"] += int(new_weights.sum())
+        self.meta["outlier_weight"] += int(new_weights[~inlier].sum())
+        return True
+
+    def drift(self):
+        """
+        причина переобучения или None: много выбросов среди новых отзывов, сдвиг центроида темы,
+        рост числа отзывов с момента обучения или пропажа части отзывов из входа
+        """
+        meta = self.meta
+        if meta["new_weight"] >= TOPIC_DRIFT_MIN_NEW and \
+                meta["outlier_weight"] / meta["new_weight"] > TOPIC_DRIFT_OUTLIER_SHARE:
+            return "outliers"
+        if len(self.sums):
+            shift = 1 - (_unit(self.sums) * self.fit_centroids).sum(axis=1)
+            if shift.max() > TOPIC_DRIFT_CENTROID_SHIFT:
+                return "centroid_shift"
+        if meta["new_weight"] > TOPIC_REFIT_GROWTH * meta["fitted_weight"]:
+            return "growth"
+        if meta["missing"] > TOPIC_DRIFT_MISSING_SHARE * len(self.hashes):
+            return "missing"
+        return None
+
+    def representatives(self, mode: str = REPRESENTATIVE_MODE, present=None, budget: int = SELECTION_TOKEN_BUDGET):
+        """
+        репрезентативные отзывы из кандидатов (только присутствующих во входе - хэши present):
+        'strict' - ближайший к центроиду на тему, 'expanded' - до 3 на тему (крупные темы первыми),
+        'budget' - MMR под бюджет токенов, доли тем - по весам тем
+        """
+        available = np.ones(len(self.cand_rows), dtype=bool) if present is None else np.isin(self.cand_hashes, present)
+        if mode == 'budget':
+            indices = np.flatnonzero(available)
+            if not len(indices):
+                return []
+            rows = self.cand_rows[indices]
+            per_topic = np.bincount(rows, minlength=len(self.topic_weights))
+            weights = self.topic_weights[rows] / np.maximum(per_topic[rows], 1)
+            texts = [self.cand_texts[i] for i in indices]
+            selected = select_by_budget(self.cand_embeddings[indices], rows, count_tokens(texts), budget, weights)
+            return [texts[i] for i in selected]
+        if mode not in ('strict', 'expanded'):
+            raise ValueError("mode должен быть 'strict', 'expanded' или 'budget'")
+        per_topic = 1 if mode == 'strict' else 3
+        res = []
+        for row in np.argsort(-self.topic_weights, kind="stable"):
+            members = np.flatnonzero((self.cand_rows == row) & available)[:per_topic]
+            res.extend(self.cand_texts[i] for i in members)
+        return res
+
+    def dump(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **{field: getattr(self, field) for field in ARRAY_FIELDS})
+        meta = json.dumps({**self.meta, "cand_texts": self.cand_texts}, ensure_ascii=False)
+        return buffer.getvalue(), meta
+
+    @classmethod
+    def load(cls, record: TopicStateRecord):
+        """
+        ValueError - если в записи не хватает массивов (состояние другого формата)
+        """
+        with np.load(io.BytesIO(record.arrays), allow_pickle=False) as data:
+            missing = [field for field in ARRAY_FIELDS if field not in data.files]
+            if missing:
+                raise ValueError(f"Topic state of {record.product_id} has no {', '.join(missing)}")
+            arrays = {field: data[field] for field in ARRAY_FIELDS}
+        meta = json.loads(record.meta)
+        cand_texts = meta.pop("cand_texts")
+        return cls(record.product_id, arrays, cand_texts, meta, record.version)
+
+
+class TopicStateStore:
+    """
+    состояния тем в таблице topic_states и LRU последних cache_size состояний в памяти процесса
+    (при чтении сверяется только версия в БД). запись - с проверкой версии: если состояние успели
+    обновить в другом процессе, своё изменение отбрасывается - не учтённые отзывы придут новыми в следующий раз
+    """
+
+    def __init__(self, cache_size: int = TOPIC_STATE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, state: TopicState):
+        with self._lock:
+            self._cache[state.product_id] = state.copy()
+            self._cache.move_to_end(state.product_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def get(self, product_id: str):
+        """
+        состояние товара или None; состояние другого формата удаляется - товар обучится заново
+        """
+        session = SessionLocal()
+        try:
+            version = session.query(TopicStateRecord.version).filter_by(product_id=product_id).scalar()
+            if version is None:
+                return None
+            with self._lock:
+                cached = self._cache.get(product_id)
+                if cached is not None and cached.version == version:
+                    self._cache.move_to_end(product_id)
+                    return cached.copy()
+            record = session.get(TopicStateRecord, product_id)
+            try:
+                state = TopicState.load(record)
+            except ValueError as err:
+                logging.warning(f"{err}, dropping it")
+                session.query(TopicStateRecord).filter_by(product_id=product_id, version=version).delete()
+                session.commit()
+                TOPIC_STATE_UPDATES.labels(action="dropped").inc()
+                return None
+        finally:
+            session.close()
+        self._remember(state)
+        return state
+
+    def put(self, state: TopicState, fitted: bool = False) -> bool:
+        arrays, meta = state.dump()
+        now = datetime.datetime.utcnow()
+        values = {"arrays": arrays, "meta": meta, "version": state.version + 1, "updated_at": now}
+        if fitted:
+            values["fitted_at"] = now
+        session = SessionLocal()
+        try:
+            if state.version == 0:
+                session.add(TopicStateRecord(product_id=state.product_id, **values))
+                saved = True
+            else:
+                saved = session.query(TopicStateRecord).filter_by(
+                    product_id=state.product_id, version=state.version
+                ).update(values, synchronize_session=False) == 1
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            saved = False
+        finally:
+            session.close()
+        if saved:
+            state.version += 1
+            self._remember(state)
+        else:
+            logging.info(f"Topic state of {state.product_id} was updated concurrently, keeping the other version")
+        return saved
+
+
+topic_states = TopicStateStore()
+
+
+def _refit(product_id: str, unique, weights, stop_words, reason: str, version: int = 0):
+    state = TopicState.fit(product_id, unique, weights, stop_words)
+    if state is None:
+        return None
+    # версия прежнего состояния - чтобы переобученное заменило его в БД
+    state.version = version
+    topic_states.put(state, fitted=True)
+    TOPIC_STATE_UPDATES.labels(action="fit" if reason == "new" else f"refit_{reason}").inc()
+    logging.info(f"Topic state of {product_id}: fitted ({reason}), {len(state.topic_weights)} topics")
+    return state
+
+
+@stage("topic_state")
+def product_representatives(product_id: str, reviews, stop_words, mode: str = REPRESENTATIVE_MODE, weights=None,
+                            budget: int = SELECTION_TOKEN_BUDGET):
+    """
+    репрезентативные отзывы товара по сохранённому состоянию тем
+
+    отзывы, уже учтённые в состоянии, повторно не лемматизируются, не кодируются и не кластеризуются -
+    время обновления пропорционально числу новых отзывов. полное обучение (как get_representative_texts)
+    - при первом запросе товара и когда TopicState.drift() находит дрейф
+
+    args:
+        product_id (str): товар
+        reviews (list of str): все текущие отзывы товара
+        stop_words (list of str): стоп-слова для лемматизации новых отзывов
+        mode (str): 'strict', 'expanded' или 'budget', как у get_representative_texts
+        weights (list of int, optional): число повторов каждого отзыва, если дубликаты уже схлопнуты
+        budget (int): бюджет токенов для режима 'budget'
+    returns:
+        list of str: репрезентативные отзывы
+    """
+    unique, weights = collapse_exact(reviews, weights)
+    # мало отзывов - как get_representative_texts, отдаём все, состояние не заводим
+    if mode == 'budget':
+        if sum(count_tokens(unique)) <= budget:
+            return unique
+    elif len(unique) <= 30:
+        return unique
+
+    hashes = review_hashes(unique)
+    state = topic_states.get(product_id)
+    if state is None:
+        state = _refit(product_id, unique, weights, stop_words, "new")
+    else:
+        changed = state.update(unique, weights, hashes, stop_words)
+        reason = state.drift()
+        if reason is not None:
+            state = _refit(product_id, unique, weights, stop_words, reason, version=state.version)
+        elif changed:
+            topic_states.put(state)
+            TOPIC_STATE_UPDATES.labels(action="update").inc()
+        else:
+            TOPIC_STATE_UPDATES.labels(action="unchanged").inc()
+    if state is None:
+        # темы не выделились: все отзывы в промпт не отдаём - самые частые, сколько влезает в бюджет
+        fallback("no_topics")
+        order = np.argsort(-np.asarray(weights), kind="stable")
+        return fit_budget([unique[i] for i in order], budget)
+    return state.representatives(mode, present=hashes, budget=budget)
@@ -0,0 +1,139 @@
+"""
+синтетический корпус русскоязычных отзывов для бенчмарков и нагрузочных тестов
+
+генерация детерминирована (seed), без сети и без моделей: темы - наборы аспектов товара,
+отзыв собирается из 1-3 фраз про аспекты одной-двух тем; часть отзывов - точные
+или почти точные копии уже сгенерированных (спам, боты, "Отлично!")
+"""
+import json
+import random
+
+TOPICS = {
+    "вкус": [
+        ("вкус", ["насыщенный", "сладкий", "приятный", "пресный", "горьковатый", "слишком кислый"]),
+        ("послевкусие", ["долгое", "неприятное", "мягкое", "химическое"]),
+        ("аромат", ["яркий", "слабый", "натуральный", "резкий"]),
+    ],
+    "упаковка": [
+        ("упаковка", ["надёжная", "порванная", "красивая", "неудобная", "герметичная"]),
+        ("крышка", ["плотно закрывается", "протекает", "сломалась", "удобная"]),
+        ("коробка", ["мятая", "целая", "слишком большая", "аккуратная"]),
+    ],
+    "цена": [
+        ("цена", ["завышена", "адекватная", "ниже чем в магазинах", "кусается"]),
+        ("скидка", ["приятная", "маленькая", "работала по акции"]),
+        ("качество за свои деньги", ["отличное", "среднее", "разочаровало"]),
+    ],
+    "размер": [
+        ("размер", ["соответствует", "маломерит", "большемерит", "как в описании"]),
+        ("вес", ["меньше заявленного", "честный", "тяжёлый"]),
+        ("объём", ["большой", "небольшой", "хватает надолго"]),
+    ],
+    "качество": [
+        ("материал", ["плотный", "тонкий", "приятный на ощупь", "синтетический"]),
+        ("швы", ["ровные", "кривые", "расходятся", "аккуратные"]),
+        ("сборка", ["качественная", "хлипкая", "без люфтов"]),
+    ],
+    "цвет": [
+        ("цвет", ["как на фото", "бледнее", "яркий", "отличается от картинки"]),
+        ("оттенок", ["тёплый", "холодный", "красивый"]),
+        ("краска", ["линяет", "стойкая", "облезла"]),
+    ],
+    "свежесть": [
+        ("срок годности", ["большой", "почти истёк", "нормальный"]),
+        ("свежесть", ["отличная", "сомнительная", "как с грядки"]),
+        ("консистенция", ["плотная", "водянистая", "однородная", "комками"]),
+    ],
+    "запах": [
+        ("запах", ["приятный", "резкий", "химический", "почти не чувствуется"]),
+        ("отдушка", ["ненавязчивая", "слишком сильная"]),
+    ],
+}
+
+OPENINGS = ["", "Купила второй раз. ", "Заказывал для семьи. ", "Брала на пробу. ", "Пришло быстро. ",
+            "Давно пользуюсь. ", "Взяли по совету друзей. "]
+TEMPLATES = [
+    "{aspect} {value}",
+    "{aspect} просто {value}",
+    "по-моему {aspect} {value}",
+    "{aspect} {value}, не ожидала",
+    "честно говоря {aspect} {value}",
+]
+CLOSINGS = ["", " Рекомендую.", " Больше не возьму.", " В целом доволен.", " Буду заказывать ещё.",
+            " Оценка четыре из пяти.", " Спасибо продавцу."]
+SHORT = ["Отлично!", "Всё супер", "Хороший товар", "Рекомендую", "Не понравилось", "Норм"]
+
+
+def _review(rng: random.Random, topics) -> str:
+    topic_names = rng.sample(topics, k=min(len(topics), rng.choice([1, 1, 2])))
+    phrases = []
+    for topic in topic_names:
+        for aspect, values in rng.sample(TOPICS[topic], k=rng.randint(1, min(2, len(TOPICS[topic])))):
+            phrases.append(rng.choice(TEMPLATES).format(aspect=aspect, value=rng.choice(values)))
+    body = ", ".join(phrases)
+    return rng.choice(OPENINGS) + body[0].upper() + body[1:] + "." + rng.choice(CLOSINGS)
+
+
+def _near_copy(rng: random.Random, text: str) -> str:
+    words = text.split()
+    change = rng.choice(["punct", "case", "drop", "tail"])
+    if change == "punct":
+        return text.rstrip(".!") + rng.choice(["!", "!!", "...", " )"])
+    if change == "case":
+        return text.lower()
+    if change == "drop" and len(words) > 4:
+        del words[rng.randrange(1, len(words))]
+        return " ".join(words)
+    return text + rng.choice([" Спасибо!", " Всем советую", " 5 звёзд"])
+
+
+def generate_reviews(n: int, n_topics: int = 6, dup_rate: float = 0.2, near_dup_share: float = 0.5,
+                     short_rate: float = 0.05, seed: int = 42):
+    """
+    список из n синтетических отзывов
+
+    args:
+        n (int): число отзывов
+        n_topics (int): сколько тем из TOPICS используется (не больше len(TOPICS))
+        dup_rate (float): доля отзывов-копий уже сгенерированных
+        near_dup_share (float): доля почти-копий (пунктуация, регистр, слово) среди копий, остальные - точные
+        short_rate (float): доля коротких шаблонных отзывов ("Отлично!")
+        seed (int): зерно генератора
+    """
+    rng = random.Random(seed)
+    topics = list(TOPICS)[:max(1, min(n_topics, len(TOPICS)))]
+    reviews = []
+    for _ in range(n):
+        roll = rng.random()
+        if reviews and roll < dup_rate:
+            source = rng.choice(reviews)
+            reviews.append(_near_copy(rng, source) if rng.random() < near_dup_share else source)
+        elif roll < dup_rate + short_rate:
+            reviews.append(rng.choice(SHORT))
+        else:
+            reviews.append(_review(rng, topics))
+    return reviews
+
+
+def generate_attr_response(n_pairs: int = 12, seed: int = 42) -> str:
+    """
+    ответ модели атрибутов в том виде, в каком его разбирает process_attr: JSON-массив пар attribute/characteristic
+    """
+    rng = random.Random(seed)
+    pairs = []
+    for _ in range(n_pairs):
+        aspect, values = rng.choice(TOPICS[rng.choice(list(TOPICS))])
+        pairs.append({"attribute": aspect, "characteristic": rng.choice(values)})
+    return json.dumps(pairs, ensure_ascii=False)
+
+
+def generate_summary(seed: int = 42) -> str:
+    """
+    саммари в формате ответа модели суммаризации: нумерованный список до 5 пунктов
+    """
+    rng = random.Random(seed)
+    points = []
+    for i, topic in enumerate(rng.sample(list(TOPICS), k=rng.randint(3, 5))):
+        aspect, values = rng.choice(TOPICS[topic])
+        points.append(f"{i + 1}. Покупатели отмечают, что {aspect} {rng.choice(values)}.")
+    return "\n".join(points)
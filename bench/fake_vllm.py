@@ -0,0 +1,144 @@
+"""
+локальная замена vLLM для нагрузочных тестов: OpenAI-совместимый /v1/chat/completions без GPU
+
+    python -m bench.fake_vllm --port 8100 --prefill-ms-per-1k 40 --decode-ms 25 --max-concurrency 16
+
+- время ответа = prefill (база + на каждую 1000 токенов промпта) + decode на каждый выходной токен
+- не больше --max-concurrency запросов генерируются одновременно, остальные ждут в очереди (как в планировщике vLLM)
+- доля --error-rate запросов отвечает 503, --timeout-rate - зависает до таймаута клиента
+- ответ по системному промпту: JSON атрибутов для модели атрибутов, нумерованное саммари для остальных
+- stream=true отдаёт SSE-дельты по токену
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from bench.corpus import generate_attr_response, generate_summary
+
+
+class FakeLLM:
+    def __init__(self, prefill_base_ms: float = 30, prefill_ms_per_1k: float = 40, decode_ms: float = 25,
+                 output_tokens: int = 120, max_concurrency: int = 16, error_rate: float = 0.0,
+                 timeout_rate: float = 0.0, seed: int = 0):
+        self.prefill_base = prefill_base_ms / 1000
+        self.prefill_per_1k = prefill_ms_per_1k / 1000
+        self.decode = decode_ms / 1000
+        self.output_tokens = output_tokens
+        self.max_concurrency = max_concurrency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.rng = random.Random(seed)
+        self.semaphore = None
+        self.running = 0
+        self.waiting = 0
+
+    @staticmethod
+    def prompt_tokens(req_data: dict) -> int:
+        return sum(len(m.get("content") or "") for m in req_data.get("messages", [])) // 3 + 1
+
+    def completion(self, req_data: dict) -> str:
+        system = ''.join(m["content"] for m in req_data.get("messages", []) if m.get("role") == "system")
+        seed = self.rng.randrange(1 << 30)
+        if "атрибут" in system:
+            return generate_attr_response(self.rng.randint(6, 16), seed=seed)
+        return generate_summary(seed=seed)
+
+    def split_tokens(self, text: str):
+        # ~3 символа на токен, как у оценки в сервисе
+        return [text[i:i + 3] for i in range(0, len(text), 3)]
+
+
+def create_app(llm: FakeLLM) -> FastAPI:
+    app = FastAPI()
+
+    @app.on_event("startup")
+    async def startup():
+        llm.semaphore = asyncio.Semaphore(llm.max_concurrency)
+
+    @app.get("/health")
+    async def health():
+        return {"running": llm.running, "waiting": llm.waiting}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        req_data = await request.json()
+        roll = llm.rng.random()
+        if roll < llm.error_rate:
+            return JSONResponse({"error": "fake overload"}, status_code=503)
+        if roll < llm.error_rate + llm.timeout_rate:
+            await asyncio.sleep(3600)
+
+        prompt_tokens = llm.prompt_tokens(req_data)
+        text = llm.completion(req_data)
+        tokens = llm.split_tokens(text)[:req_data.get("max_tokens") or llm.output_tokens]
+        prefill = llm.prefill_base + llm.prefill_per_1k * prompt_tokens / 1000
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+        llm.waiting += 1
+        await llm.semaphore.acquire()
+        llm.waiting -= 1
+        llm.running += 1
+
+        def release():
+            llm.running -= 1
+            llm.semaphore.release()
+
+        if not req_data.get("stream"):
+            try:
+                await asyncio.sleep(prefill + llm.decode * len(tokens))
+            finally:
+                release()
+            return {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()),
+                "model": req_data.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": ''.join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        async def events():
+            try:
+                await asyncio.sleep(prefill)
+                for token in tokens:
+                    await asyncio.sleep(llm.decode)
+                    chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": req_data.get("model"),
+                             "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                release()
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--prefill-base-ms", type=float, default=30)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=40, help="мс prefill на 1000 токенов промпта")
+    parser.add_argument("--decode-ms", type=float, default=25, help="мс на выходной токен")
+    parser.add_argument("--output-tokens", type=int, default=120)
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    llm = FakeLLM(args.prefill_base_ms, args.prefill_ms_per_1k, args.decode_ms, args.output_tokens,
+                  args.max_concurrency, args.error_rate, args.timeout_rate, args.seed)
+    uvicorn.run(create_app(llm), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""
+сквозной нагрузочный тест: сервис + воркер Celery против локальных заглушек vLLM, без GPU и сети
+
+    python -m bench.loadtest --rates 1,2,4,8 --duration 30
+    python -m bench.loadtest --rates 2,4 --mix summarize=1,keywords=1 --decode-ms 40 --vllm-concurrency 8
+
+поднимает:
+- две заглушки vLLM (bench/fake_vllm.py) - vllm и vllm_lora с заданными prefill/decode/лимитом/ошибками
+- FastAPI-приложение (uvicorn, --app-workers процессов) с офлайн-эмбеддером
+- воркер Celery с брокером filesystem:// и SQLite вместо Postgres во временном каталоге
+  (или внешние --database-url / --broker-url, например из docker compose)
+
+трафик - открытая модель: запросы приходят пуассоновским потоком с заданной частотой независимо
+от того, успевает ли сервис, поэтому перегрузка видна как рост латентности и ошибок, а не как падение частоты.
+на каждой ступени частоты считаются пропускная способность, p50/p95/p99 и доля ошибок по эндпоинтам;
+точка насыщения - первая ступень, где успешных ответов меньше 90% от поданных, ошибок больше 1% или p99 выше --slo
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench.corpus import generate_reviews
+
+ENDPOINTS = ("summarize", "attributes", "keywords", "huge")
+DEFAULT_MIX = "summarize=4,attributes=2,keywords=3,huge=1"
+
+
+def percentile(values, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class Stack:
+    """
+    процессы тестового стенда; останавливаются в stop() в обратном порядке
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="loadtest-")
+        self.procs = []
+        self.logs = []
+
+    def env(self):
+        args = self.args
+        env = dict(os.environ)
+        broker_dir = os.path.join(self.workdir, "broker")
+        os.makedirs(broker_dir, exist_ok=True)
+        env.update({
+            "PYTHONPATH": os.pathsep.join(filter(None, [os.getcwd(), env.get("PYTHONPATH")])),
+            "DATABASE_URL": args.database_url or f"sqlite:///{os.path.join(self.workdir, 'loadtest.sqlite')}",
+            "CELERY_BROKER_URL": args.broker_url or "filesystem://",
+            "VLLM_URL": f"http://127.0.0.1:{args.vllm_port}",
+            "VLLM_LORA_URL": f"http://127.0.0.1:{args.vllm_port + 1}",
+            "VLLM_ENABLED": "true",
+            "TOPIC_BACKEND": "cpu",
+            "EMBEDDING_DEVICE": "cpu",
+            "EMBEDDING_STORE_DIR": os.path.join(self.workdir, "embeddings"),
+            "BLOB_STORE": "fs",
+            "BLOB_STORE_DIR": os.path.join(self.workdir, "payloads"),
+            "PRELOAD_MODELS": "",
+            "WARMUP_MODELS": "mystem,stopwords,embedding_model",
+        })
+        if not args.database_url:
+            # без Postgres: кэш результатов только в памяти, склейка запросов только внутри процесса
+            env.update({"RESULT_CACHE_DB_ENABLED": "false", "SINGLEFLIGHT_DB_ENABLED": "false"})
+        if not args.broker_url:
+            env["CELERY_BROKER_TRANSPORT_OPTIONS"] = json.dumps({
+                "data_folder_in": broker_dir, "data_folder_out": broker_dir,
+            })
+        return env
+
+    def spawn(self, name: str, cmd, env):
+        log = open(os.path.join(self.workdir, f"{name}.log"), "w")
+        self.logs.append(log)
+        self.procs.append((name, subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)))
+
+    def start(self):
+        args = self.args
+        env = self.env()
+        subprocess.run(
+            [sys.executable, "-c", "from app.database import Base, engine; Base.metadata.create_all(engine)"],
+            env=env, check=True,
+        )
+        for port, concurrency in ((args.vllm_port, args.vllm_concurrency), (args.vllm_port + 1, args.lora_concurrency)):
+            self.spawn(f"fake_vllm_{port}", [
+                sys.executable, "-m", "bench.fake_vllm", "--port", str(port),
+                "--prefill-base-ms", str(args.prefill_base_ms), "--prefill-ms-per-1k", str(args.prefill_ms_per_1k),
+                "--decode-ms", str(args.decode_ms), "--max-concurrency", str(concurrency),
+                "--error-rate", str(args.error_rate), "--timeout-rate", str(args.timeout_rate),
+            ], env)
+        self.spawn("app", [
+            sys.executable, "-m", "uvicorn", "bench.offline_app:app", "--host", "127.0.0.1",
+            "--port", str(args.app_port), "--workers", str(args.app_workers), "--log-level", "warning",
+        ], env)
+        self.spawn("worker", [
+            sys.executable, "-m", "celery", "-A", "bench.offline_worker", "worker", "--loglevel=warning",
+            "--queues=huge_summarize_queue", f"--concurrency={args.worker_concurrency}",
+        ], env)
+
+    async def wait_ready(self, timeout: float):
+        urls = [f"http://127.0.0.1:{self.args.vllm_port}/health", f"http://127.0.0.1:{self.args.vllm_port + 1}/health",
+                f"http://127.0.0.1:{self.args.app_port}/readyz"]
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient(timeout=2) as client:
+            for url in urls:
+                while True:
+                    for name, proc in self.procs:
+                        if proc.poll() is not None:
+                            raise RuntimeError(f"{name} exited with {proc.returncode}, see {self.workdir}/{name}.log")
+                    try:
+                        if (await client.get(url)).status_code == 200:
+                            break
+                    except httpx.TransportError:
+                        pass
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"{url} not ready after {timeout}s, logs in {self.workdir}")
+                    await asyncio.sleep(0.5)
+
+    def stop(self):
+        for _, proc in reversed(self.procs):
+            proc.terminate()
+        for _, proc in reversed(self.procs):
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        for log in self.logs:
+            log.close()
+        if not self.args.keep_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Traffic:
+    """
+    генератор тел запросов: наборы отзывов берутся из пула --distinct-inputs вариантов,
+    поэтому доля повторов (и попаданий в кэш результатов) управляется размером пула
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.pool = [
+            "\n".join(generate_reviews(args.reviews, dup_rate=args.dup_rate, seed=args.seed + i))
+            for i in range(args.distinct_inputs)
+        ]
+        self.huge = "\n".join(generate_reviews(args.huge_reviews, dup_rate=args.dup_rate, seed=args.seed))
+
+    def text(self) -> str:
+        return self.rng.choice(self.pool)
+
+
+async def call(client: httpx.AsyncClient, endpoint: str, traffic: Traffic, args):
+    """
+    returns:
+        (bool, float): успех и латентность в секундах (для huge - от отправки до готового результата)
+    """
+    started = time.monotonic()
+    if endpoint != "huge":
+        response = await client.post(f"/{endpoint}", json={"text": traffic.text()})
+        return response.status_code == 200, time.monotonic() - started
+
+    response = await client.post("/huge_summarize", json={"text": traffic.huge})
+    if response.status_code != 200:
+        return False, time.monotonic() - started
+    task_id = response.json()["task_id"]
+    while time.monotonic() - started < args.huge_timeout:
+        response = await client.get(f"/task_status/{task_id}", params={"wait": 10})
+        if response.status_code != 200:
+            return False, time.monotonic() - started
+        status = response.json()["status"]
+        if status in ("completed", "error"):
+            return status == "completed", time.monotonic() - started
+    return False, time.monotonic() - started
+
+
+async def run_step(rate: float, mix, traffic: Traffic, args):
+    """
+    одна ступень открытой нагрузки: rate запросов/с в течение args.duration секунд
+    """
+    endpoints, weights = zip(*mix.items())
+    rng = random.Random(args.seed + int(rate * 1000))
+    samples = {name: [] for name in endpoints}
+    sent = {name: 0 for name in endpoints}
+    timeout = httpx.Timeout(args.request_timeout)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=256)
+
+    async def one(endpoint):
+        try:
+            ok, latency = await call(client, endpoint, traffic, args)
+        except httpx.HTTPError:
+            ok, latency = False, None
+        samples[endpoint].append((ok, latency))
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.app_port}", timeout=timeout, limits=limits) as client:
+        tasks = []
+        started = time.monotonic()
+        next_at = started
+        while True:
+            next_at += rng.expovariate(rate)
+            if next_at - started > args.duration:
+                break
+            await asyncio.sleep(max(0, next_at - time.monotonic()))
+            endpoint = rng.choices(endpoints, weights)[0]
+            sent[endpoint] += 1
+            tasks.append(asyncio.create_task(one(endpoint)))
+        # открытая модель: ждём уже отправленные, но не дольше drain
+        _, pending = await asyncio.wait(tasks, timeout=args.drain) if tasks else (None, [])
+        for task in pending:
+            task.cancel()
+        elapsed = time.monotonic() - started
+
+    rows = []
+    for endpoint in endpoints:
+        done = samples[endpoint]
+        latencies = [latency for ok, latency in done if ok]
+        errors = sent[endpoint] - len(latencies)
+        rows.append({
+            "rate": rate, "endpoint": endpoint, "sent": sent[endpoint], "ok": len(latencies),
+            "error_rate": errors / sent[endpoint] if sent[endpoint] else 0.0,
+            "throughput": len(latencies) / elapsed,
+            "p50_s": percentile(latencies, 50), "p95_s": percentile(latencies, 95), "p99_s": percentile(latencies, 99),
+        })
+    total_sent = sum(sent.values())
+    total_ok = sum(r["ok"] for r in rows)
+    all_latencies = [latency for done in samples.values() for ok, latency in done if ok]
+    rows.append({
+        "rate": rate, "endpoint": "all", "sent": total_sent, "ok": total_ok,
+        "error_rate": (total_sent - total_ok) / total_sent if total_sent else 0.0,
+        "throughput": total_ok / elapsed,
+        "p50_s": percentile(all_latencies, 50), "p95_s": percentile(all_latencies, 95),
+        "p99_s": percentile(all_latencies, 99),
+    })
+    return rows
+
+
+def saturated(row, args) -> bool:
+    if row["sent"] == 0:
+        return False
+    return (row["ok"] < 0.9 * row["sent"] or row["error_rate"] > 0.01
+            or (row["p99_s"] is not None and row["p99_s"] > args.slo))
+
+
+def format_row(row) -> str:
+    def ms(value):
+        return f"{value * 1000:9.0f}" if value is not None else f"{'-':>9}"
+    return (f"{row['rate']:6.2f}/s {row['endpoint']:<11} sent {row['sent']:5d} ok {row['ok']:5d} "
+            f"err {row['error_rate'] * 100:5.1f}% thr {row['throughput']:7.2f}/s "
+            f"p50 {ms(row['p50_s'])}ms p95 {ms(row['p95_s'])}ms p99 {ms(row['p99_s'])}ms")
+
+
+def parse_mix(value: str):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise ValueError(f"неизвестный эндпоинт '{name}', ожидается один из {ENDPOINTS}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+async def amain(args):
+    mix = parse_mix(args.mix)
+    traffic = Traffic(args)
+    stack = Stack(args)
+    report = {"config": vars(args), "steps": [], "saturation": {}}
+    try:
+        stack.start()
+        await stack.wait_ready(args.startup_timeout)
+        for rate in [float(r) for r in args.rates.split(",")]:
+            rows = await run_step(rate, mix, traffic, args)
+            for row in rows:
+                print(format_row(row), flush=True)
+                if saturated(row, args) and row["endpoint"] not in report["saturation"]:
+                    report["saturation"][row["endpoint"]] = rate
+            report["steps"].extend(rows)
+    finally:
+        stack.stop()
+
+    for endpoint, rate in report["saturation"].items():
+        print(f"saturation: {endpoint} at {rate}/s")
+    if not report["saturation"]:
+        print("no saturation in the tested range")
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results: {args.output}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", default="1,2,4,8", help="ступени частоты запросов, запросов/с")
+    parser.add_argument("--duration", type=float, default=30, help="длительность ступени, с")
+    parser.add_argument("--drain", type=float, default=60, help="сколько ждать незавершённые запросы после ступени, с")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса эндпоинтов (summarize, attributes, keywords, huge)")
+    parser.add_argument("--reviews", type=int, default=200, help="отзывов в обычном запросе")
+    parser.add_argument("--huge-reviews", type=int, default=5000, help="отзывов в /huge_summarize")
+    parser.add_argument("--dup-rate", type=float, default=0.2)
+    parser.add_argument("--distinct-inputs", type=int, default=50, help="размер пула разных входов (меньше - больше попаданий в кэш)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--slo", type=float, default=10, help="порог p99, с")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--huge-timeout", type=float, default=600)
+    # заглушка vLLM
+    parser.add_argument("--prefill-base-ms", type=float, default=30)
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=40)
+    parser.add_argument("--decode-ms", type=float, default=25)
+    parser.add_argument("--vllm-concurrency", type=int, default=16)
+    parser.add_argument("--lora-concurrency", type=int, default=16)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    # стенд
+    parser.add_argument("--app-port", type=int, default=8300)
+    parser.add_argument("--vllm-port", type=int, default=8100, help="порт vllm; vllm_lora - следующий")
+    parser.add_argument("--app-workers", type=int, default=1)
+    parser.add_argument("--worker-concurrency", type=int, default=1)
+    parser.add_argument("--database-url", default=None, help="по умолчанию SQLite во временном каталоге")
+    parser.add_argument("--broker-url", default=None, help="по умолчанию filesystem:// во временном каталоге")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--keep-workdir", action="store_true", help="не удалять каталог с логами и БД стенда")
+    parser.add_argument("--output", default="bench/results/loadtest.json")
+    args = parser.parse_args(argv)
+    asyncio.run(amain(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+замены компонентов реестра для запуска бенчмарков без сети: эмбеддер на хэшировании слов
+вместо загрузки MiniLM с HF и встроенный список стоп-слов вместо nltk.download
+"""
+import tempfile
+import zlib
+
+import numpy as np
+
+from app.config import EMBEDDING_STORE_MAX_BYTES
+from app.embedding_store import EmbeddingStore
+from app.registry import registry
+
+STOP_WORDS = [
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она", "так", "его",
+    "но", "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее", "мне", "было", "вот", "от",
+    "меня", "еще", "нет", "о", "из", "ему", "теперь", "когда", "даже", "ну", "вдруг", "ли", "если", "уже",
+    "или", "ни", "быть", "был", "него", "до", "вас", "нибудь", "опять", "уж", "вам", "ведь", "там", "потом",
+    "себя", "ничего", "ей", "может", "они", "тут", "где", "есть", "надо", "ней", "для", "мы", "тебя", "их",
+    "чем", "была", "сам", "чтоб", "без", "будто", "чего", "раз", "тоже", "себе", "под", "будет", "ж", "тогда",
+    "кто", "этот", "того", "потому", "этого", "какой", "совсем", "ним", "здесь", "этом", "один", "почти",
+    "мой", "тем", "чтобы", "нее", "сейчас", "были", "куда", "зачем", "всех", "никогда", "можно", "при",
+    "наконец", "два", "об", "другой", "хоть", "после", "над", "больше", "тот", "через", "эти", "нас", "про",
+    "всего", "них", "какая", "много", "разве", "три", "эту", "моя", "впрочем", "хорошо", "свою", "этой",
+    "перед", "иногда", "лучше", "чуть", "том", "нельзя", "такой", "им", "более", "всегда", "конечно", "всю",
+    "между",
+]
+
+
+class HashingEmbedder:
+    """
+    детерминированный эмбеддер без модели: случайная проекция мешка слов (хэш слова -> вектор ±1).
+    по скорости и качеству не похож на MiniLM, но даёт реалистичную нагрузку на UMAP/HDBSCAN/BERTopic
+    """
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def _word_vector(self, word: str):
+        rng = np.random.RandomState(zlib.crc32(word.encode("utf-8")))
+        return rng.choice((-1.0, 1.0), size=self.dim)
+
+    def encode(self, texts, batch_size: int = 64, show_progress_bar: bool = False):
+        cache = {}
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.split():
+                if word not in cache:
+                    cache[word] = self._word_vector(word)
+                vectors[i] += cache[word]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+def use_temp_embedding_store(store_dir: str = None):
+    """
+    хранилище эмбеддингов во временном каталоге, чтобы замеры начинались с пустого кэша и не задевали кэш сервиса
+
+    returns:
+        str: каталог хранилища
+    """
+    store_dir = store_dir or tempfile.mkdtemp(prefix="bench-embeddings-")
+    registry.register(
+        "embedding_store", lambda: EmbeddingStore(store_dir, "bench", EMBEDDING_STORE_MAX_BYTES)
+    )
+    return store_dir
+
+
+def install_offline_components():
+    """
+    подменяет в реестре эмбеддер и стоп-слова; вызывать после импорта app.models
+    и до первого обращения к этим компонентам
+    """
+    registry.register("embedding_model", HashingEmbedder)
+    registry.register("stopwords", lambda: list(STOP_WORDS))
@@ -0,0 +1,13 @@
+"""
+FastAPI-приложение сервиса с офлайн-компонентами (bench/offline.py) - для нагрузочных тестов без сети:
+
+    uvicorn bench.offline_app:app
+"""
+from app import models  # noqa: F401 - регистрирует компоненты, которые подменяются ниже
+from bench.offline import install_offline_components
+
+install_offline_components()
+
+from app.main import app  # noqa: E402,F401
+
+__all__ = ["app"]
@@ -0,0 +1,11 @@
+"""
+воркер Celery сервиса с офлайн-компонентами (bench/offline.py) - для нагрузочных тестов без сети:
+
+    celery -A bench.offline_worker worker --queues=huge_summarize_queue
+"""
+from app.tasks import celery_app  # noqa: F401
+from bench.offline import install_offline_components
+
+install_offline_components()
+
+__all__ = ["celery_app"]
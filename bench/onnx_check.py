@@ -0,0 +1,129 @@
+"""
+точность и скорость int8-эмбеддера ONNX (app/onnx_embedder.py) относительно SentenceTransformer на torch
+
+    python -m bench.onnx_check --model-dir /var/cache/comments_summary/onnx
+    python -m bench.onnx_check --size 5000 --threads 4 --raw
+
+на фиксированном синтетическом корпусе (bench/corpus.py, без дубликатов) оба эмбеддера кодируют
+одни и те же тексты - по умолчанию лемматизированные, как в конвейере (нужен Mystem), с --raw - исходные.
+сравниваются косинусы векторов одного текста (среднее, минимум, 1-й перцентиль) и совпадение
+ближайшего соседа каждого текста; код выхода 1, если что-то ниже порогов. скорость - тексты/с
+после прогрева, torch на CPU с тем же числом потоков
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from app.config import EMBEDDING_ONNX_DIR, EMBEDDING_ONNX_THREADS
+from app.onnx_embedder import OnnxEmbedder
+from bench.corpus import generate_reviews
+from bench.offline import STOP_WORDS
+
+DEFAULT_OUTPUT = "bench/results/onnx_check.json"
+
+
+def _unit(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def nearest_neighbours(embeddings):
+    similarity = _unit(embeddings) @ _unit(embeddings).T
+    np.fill_diagonal(similarity, -np.inf)
+    return similarity.argmax(axis=1)
+
+
+def timed_encode(model, texts, batch_size: int):
+    model.encode(texts[:batch_size], batch_size=batch_size)
+    started = time.perf_counter()
+    vectors = np.asarray(model.encode(texts, batch_size=batch_size), dtype=np.float32)
+    return vectors, time.perf_counter() - started
+
+
+def compare(reference, candidate) -> dict:
+    cosine = (_unit(reference) * _unit(candidate)).sum(axis=1)
+    return {
+        "cosine_mean": float(cosine.mean()),
+        "cosine_min": float(cosine.min()),
+        "cosine_p1": float(np.percentile(cosine, 1)),
+        "nn_agreement": float((nearest_neighbours(reference) == nearest_neighbours(candidate)).mean()),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-dir", default=EMBEDDING_ONNX_DIR)
+    parser.add_argument("--size", type=int, default=2000, help="число текстов")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--raw", action="store_true", help="кодировать исходные тексты без лемматизации")
+    parser.add_argument("--threads", type=int, default=EMBEDDING_ONNX_THREADS)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--min-cosine-mean", type=float, default=0.99)
+    parser.add_argument("--min-cosine", type=float, default=0.95)
+    parser.add_argument("--min-nn-agreement", type=float, default=0.9)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    # без повторов: у одинаковых текстов ближайший сосед неоднозначен
+    texts = list(dict.fromkeys(generate_reviews(args.size, dup_rate=0.0, short_rate=0.0, seed=args.seed)))
+    if not args.raw:
+        from app.models import text_preproc_batch
+        texts = list(dict.fromkeys(text_preproc_batch(texts, stop_words=STOP_WORDS)))
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(args.threads)
+    onnx_model = OnnxEmbedder(args.model_dir, threads=args.threads)
+    torch_model = SentenceTransformer(onnx_model.meta["model_name"], device="cpu")
+
+    reference, torch_seconds = timed_encode(torch_model, texts, args.batch_size)
+    candidate, onnx_seconds = timed_encode(onnx_model, texts, args.batch_size)
+    accuracy = compare(reference, candidate)
+    report = {
+        "meta": {
+            "created_at": datetime.datetime.utcnow().isoformat(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "model": onnx_model.meta,
+            "corpus": {"size": len(texts), "seed": args.seed, "lemmatized": not args.raw},
+            "threads": args.threads,
+            "batch_size": args.batch_size,
+        },
+        "accuracy": accuracy,
+        "speed": {
+            "torch_texts_per_s": len(texts) / torch_seconds,
+            "onnx_texts_per_s": len(texts) / onnx_seconds,
+            "speedup": torch_seconds / onnx_seconds,
+        },
+    }
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print(f"cosine mean {accuracy['cosine_mean']:.4f}  min {accuracy['cosine_min']:.4f}  "
+          f"p1 {accuracy['cosine_p1']:.4f}  nn agreement {accuracy['nn_agreement']:.3f}")
+    print(f"torch {report['speed']['torch_texts_per_s']:.0f} texts/s  onnx {report['speed']['onnx_texts_per_s']:.0f} "
+          f"texts/s  speedup x{report['speed']['speedup']:.1f}  ({args.threads} threads)")
+    print(f"results: {args.output}")
+
+    failed = [
+        name for name, value, threshold in (
+            ("cosine_mean", accuracy["cosine_mean"], args.min_cosine_mean),
+            ("cosine_min", accuracy["cosine_min"], args.min_cosine),
+            ("nn_agreement", accuracy["nn_agreement"], args.min_nn_agreement),
+        ) if value < threshold
+    ]
+    for name in failed:
+        print(f"FAILED {name}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+микробенчмарки стадий конвейера на синтетическом корпусе
+
+    python -m bench.run --sizes 100,1000,10000 --offline
+    python -m bench.run --sizes 100,1000 --offline --save-baseline
+    python -m bench.run --sizes 100,1000 --offline --fail-on-regression
+
+для каждого размера корпуса и каждой стадии замеряется время (min/median по --repeat прогонам)
+и пиковая память Python-аллокаций (tracemalloc, отдельным прогоном). результаты пишутся в JSON,
+и если есть baseline, сравниваются с ним: стадия считается регрессией, если медиана выросла
+больше чем на --tolerance и больше чем на --min-delta секунд
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from app import models
+from app.dedup import collapse_exact, collapse_near
+from app.embedding_store import encode_with_store
+from app.registry import registry
+from bench.corpus import generate_reviews, generate_attr_response
+from bench.offline import install_offline_components, use_temp_embedding_store
+
+DEFAULT_SIZES = "100,1000,10000"
+DEFAULT_OUTPUT = "bench/results/latest.json"
+DEFAULT_BASELINE = "bench/baseline.json"
+# стадии, которые на больших корпусах идут минутами - по умолчанию только до этого размера
+SLOW_STAGE_LIMITS = {"text_preproc": 10000, "coherence_sweep": 20000, "representative": 20000}
+
+
+def fallback_lemmas(reviews, stop_words):
+    """
+    грубая замена лемматизации, если Mystem недоступен (нет бинарника и сети): токены в нижнем регистре
+    """
+    return [models._select_tokens(r.lower(), models.TOKEN_PATTERN, stop_words) for r in reviews]
+
+
+class Context:
+    """
+    входные данные стадий для одного размера корпуса; стадии дописывают сюда свои результаты для следующих
+    """
+
+    def __init__(self, reviews, stop_words):
+        self.reviews = reviews
+        self.stop_words = stop_words
+        self.lemmas = None
+        self.lemmatizer = "mystem"
+        self.weights = None
+        self.embeddings = None
+
+
+def stage_text_preproc(ctx):
+    return [models.text_preproc(r, stop_words=ctx.stop_words) for r in ctx.reviews]
+
+
+def stage_text_preproc_batch(ctx):
+    try:
+        ctx.lemmas = models.text_preproc_batch(ctx.reviews, stop_words=ctx.stop_words)
+    except Exception as err:
+        logging.warning(f"Mystem unavailable, using fallback lemmas: {err}")
+        ctx.lemmatizer = "fallback"
+        ctx.lemmas = fallback_lemmas(ctx.reviews, ctx.stop_words)
+    return ctx.lemmas
+
+
+def stage_dedup(ctx):
+    unique, weights = collapse_exact(ctx.reviews)
+    lemma_of = dict(zip(ctx.reviews, ctx.lemmas))
+    return collapse_near([lemma_of[r] for r in unique], weights)
+
+
+def stage_kw_counter(ctx):
+    return models.kw_counter(ctx.lemmas)
+
+
+def stage_encode(ctx):
+    # пустое хранилище на каждый прогон - замеряется кодирование, а не чтение кэша
+    store_dir = use_temp_embedding_store()
+    try:
+        ctx.embeddings = encode_with_store(
+            registry.get("embedding_model"), ctx.lemmas, registry.get("embedding_store")
+        )
+    finally:
+        registry.forget("embedding_store")
+        shutil.rmtree(store_dir, ignore_errors=True)
+    return ctx.embeddings
+
+
+def stage_coherence_sweep(ctx):
+    import gensim.corpora as corpora
+
+    analyzer = registry.get("vectorizer").build_analyzer()
+    tokens = [analyzer(doc) for doc in ctx.lemmas]
+    dictionary = corpora.Dictionary(tokens)
+    corpus = [dictionary.doc2bow(t) for t in tokens]
+    return models.compute_bertopic_coherence_values(
+        ctx.lemmas, ctx.embeddings, dictionary, tokens, corpus, limit=5, start=2, step=1
+    )
+
+
+def stage_representative(ctx):
+    return models.get_representative_texts(ctx.lemmas, ctx.reviews, mode="expanded")
+
+
+def stage_select_budget(ctx):
+    rng = np.random.RandomState(0)
+    topics = rng.randint(-1, 8, size=len(ctx.reviews))
+    return models.select_by_budget(ctx.embeddings, topics, models.count_tokens(ctx.reviews))
+
+
+def stage_process_attr(ctx):
+    responses = [generate_attr_response(12, seed=i) for i in range(max(1, len(ctx.reviews) // 10))]
+    return [models.process_attr(r) for r in responses]
+
+
+STAGES = {
+    "text_preproc": stage_text_preproc,
+    "text_preproc_batch": stage_text_preproc_batch,
+    "dedup": stage_dedup,
+    "kw_counter": stage_kw_counter,
+    "encode": stage_encode,
+    "coherence_sweep": stage_coherence_sweep,
+    "representative": stage_representative,
+    "select_budget": stage_select_budget,
+    "process_attr": stage_process_attr,
+}
+
+
+def measure(fn, ctx, repeat: int, memory: bool):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(ctx)
+        timings.append(time.perf_counter() - started)
+    result = {"min_s": min(timings), "median_s": statistics.median(timings)}
+    if memory:
+        tracemalloc.start()
+        fn(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_mib"] = peak / 2 ** 20
+    return result
+
+
+def run(sizes, stages, repeat: int, memory: bool, n_topics: int, dup_rate: float, seed: int):
+    results = []
+    lemmatizers = set()
+    for size in sizes:
+        reviews = generate_reviews(size, n_topics=n_topics, dup_rate=dup_rate, seed=seed)
+        ctx = Context(reviews, models.load_stop_words())
+        # стадии-зависимости выполняются всегда, даже если их не замеряют
+        stage_text_preproc_batch(ctx)
+        stage_encode(ctx)
+        lemmatizers.add(ctx.lemmatizer)
+        for name in stages:
+            if size > SLOW_STAGE_LIMITS.get(name, size):
+                continue
+            try:
+                result = measure(STAGES[name], ctx, repeat, memory)
+            except Exception as err:
+                logging.exception(err)
+                result = {"error": str(err)}
+            results.append({"stage": name, "size": size, **result})
+            print(format_row(results[-1]), flush=True)
+    return results, sorted(lemmatizers)
+
+
+def format_row(row, baseline=None) -> str:
+    if "error" in row:
+        return f"{row['stage']:<20} {row['size']:>7}  ERROR {row['error']}"
+    line = f"{row['stage']:<20} {row['size']:>7}  median {row['median_s']:9.4f}s  min {row['min_s']:9.4f}s"
+    if "peak_mib" in row:
+        line += f"  peak {row['peak_mib']:8.1f} MiB"
+    if baseline is not None:
+        line += f"  baseline {baseline['median_s']:9.4f}s ({row['median_s'] / max(baseline['median_s'], 1e-9):.2f}x)"
+    return line
+
+
+def compare(results, baseline, tolerance: float, min_delta: float):
+    """
+    returns:
+        list of (dict, dict): пары (результат, baseline) для стадий, ставших медленнее
+    """
+    index = {(r["stage"], r["size"]): r for r in baseline.get("results", []) if "median_s" in r}
+    regressions = []
+    for row in results:
+        base = index.get((row["stage"], row["size"]))
+        if base is None or "median_s" not in row:
+            continue
+        delta = row["median_s"] - base["median_s"]
+        if delta > min_delta and row["median_s"] > base["median_s"] * (1 + tolerance):
+            regressions.append((row, base))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="размеры корпуса через запятую (100..100000)")
+    parser.add_argument("--stages", default=",".join(STAGES), help="стадии через запятую")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="не замерять пиковую память")
+    parser.add_argument("--topics", type=int, default=6, help="число тем в синтетическом корпусе")
+    parser.add_argument("--dup-rate", type=float, default=0.2, help="доля дубликатов в корпусе")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--offline", action="store_true",
+                        help="эмбеддер на хэшировании и встроенные стоп-слова вместо загрузки с HF/nltk")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="записать результаты и как baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое относительное замедление")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="замедление в секундах, ниже которого шум")
+    parser.add_argument("--fail-on-regression", action="store_true", help="код выхода 1 при регрессиях")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.offline:
+        install_offline_components()
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"неизвестные стадии: {sorted(unknown)}")
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+
+    results, lemmatizers = run(sizes, stages, args.repeat, not args.no_memory, args.topics, args.dup_rate, args.seed)
+    report = {
+        "meta": {
+            "created_at": datetime.datetime.utcnow().isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "offline": args.offline,
+            "lemmatizer": lemmatizers,
+            "corpus": {"topics": args.topics, "dup_rate": args.dup_rate, "seed": args.seed},
+            "repeat": args.repeat,
+            "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+        "results": results,
+    }
+    paths = [args.output] + ([args.baseline] if args.save_baseline else [])
+    for path in paths:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results: {', '.join(paths)}")
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance, args.min_delta)
+    for row, base in regressions:
+        print("REGRESSION " + format_row(row, base))
+    if not regressions:
+        print(f"no regressions against {args.baseline}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""
+общие настройки тестов: SQLite и файловые хранилища во временном каталоге вместо Postgres и общих томов,
+модели заранее не загружаются. переменные окружения задаются до первого импорта app.config
+"""
+import os
+import tempfile
+
+_TMP_DIR = tempfile.mkdtemp(prefix="comments_summary_tests_")
+
+for name, value in {
+    "DATABASE_URL": f"sqlite:///{os.path.join(_TMP_DIR, 'tests.sqlite')}",
+    "BLOB_STORE": "fs",
+    "BLOB_STORE_DIR": os.path.join(_TMP_DIR, "payloads"),
+    "EMBEDDING_STORE_DIR": os.path.join(_TMP_DIR, "embeddings"),
+    "PRELOAD_MODELS": "",
+    "WARMUP_MODELS": "",
+    "RESULT_CACHE_DB_ENABLED": "false",
+    "SINGLEFLIGHT_DB_ENABLED": "false",
+}.items():
+    os.environ.setdefault(name, value)
+
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def database():
+    """
+    чистые таблицы в SQLite на время теста
+    """
+    from app.database import Base, engine
+    Base.metadata.create_all(engine)
+    yield engine
+    Base.metadata.drop_all(engine)
@@ -0,0 +1,71 @@
+"""
+слияние атрибутов из ответов LoRA-модели (AttributeMerger, process_attr): нормализация написания,
+частоты пар, порядок вывода, разбор ответа без guided_json и ответ, который разобрать не удалось
+"""
+import json
+
+from app.models import AttributeMerger, process_attr
+
+
+def test_pairs_are_merged_case_and_space_insensitive():
+    merger = AttributeMerger()
+    added = merger.add([
+        {"attribute": "Доставка", "characteristic": "быстрая"},
+        {"attribute": " доставка ", "characteristic": "Быстрая"},
+        {"attribute": "ДОСТАВКА", "characteristic": "курьером"},
+    ])
+    assert added == 3
+    assert len(merger) == 1
+    # выводится первое встреченное написание
+    assert merger.to_text() == "Доставка: быстрая; курьером;"
+
+
+def test_order_by_frequency_then_first_seen():
+    merger = AttributeMerger()
+    merger.add([
+        {"attribute": "цена", "characteristic": "высокая"},
+        {"attribute": "качество", "characteristic": "хорошее"},
+        {"attribute": "качество", "characteristic": "среднее"},
+        {"attribute": "качество", "characteristic": "среднее"},
+        {"attribute": "упаковка", "characteristic": "целая"},
+    ])
+    merger.add([{"attribute": "цена", "characteristic": "низкая"}])
+    assert merger.to_text().splitlines() == [
+        "качество: среднее; хорошее;",
+        "цена: высокая; низкая;",
+        "упаковка: целая;",
+    ]
+
+
+def test_characteristic_list_and_invalid_items():
+    merger = AttributeMerger()
+    added = merger.add([
+        {"attribute": "размер", "characteristic": ["маломерит", "", "  ", "в размер"]},
+        {"attribute": "", "characteristic": "пусто"},
+        {"attribute": "цвет", "characteristic": 5},
+        "не объект",
+        {"characteristic": "без атрибута"},
+    ])
+    assert added == 2
+    assert merger.to_text() == "размер: маломерит; в размер;"
+
+
+def test_add_response_merges_several_answers():
+    merger = AttributeMerger()
+    assert merger.add_response(json.dumps([{"attribute": "вкус", "characteristic": "сладкий"}], ensure_ascii=False))
+    # ответ без guided_json: объекты внутри текста
+    assert merger.add_response('Вот атрибуты: {"attribute": "Вкус", "characteristic": "сочный"} '
+                               '{"attribute": "запах", "characteristic": "приятный"}')
+    assert not merger.add_response("атрибутов нет")
+    assert not merger.add_response("[]")
+    assert merger.to_text() == "вкус: сладкий; сочный;\nзапах: приятный;"
+
+
+def test_process_attr():
+    answer = json.dumps([
+        {"attribute": "мякоть", "characteristic": "водянистая"},
+        {"attribute": "мякоть", "characteristic": "сочная"},
+        {"attribute": "Мякоть", "characteristic": "сочная"},
+    ], ensure_ascii=False)
+    assert process_attr(answer) == "мякоть: сочная; водянистая;"
+    assert process_attr("  модель ответила текстом  ") == "модель ответила текстом"
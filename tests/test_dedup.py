@@ -0,0 +1,69 @@
+"""
+дедупликация: точные дубликаты с весами, почти-дубликаты через MinHash/LSH и union-find
+(цепочки похожих текстов сливаются в одну группу, остаётся первый текст, вес - сумма группы)
+"""
+import pytest
+
+from app.dedup import collapse_exact, collapse_near, minhash_signatures
+
+BASE = "доставка быстрый курьер вежливый упаковка целый товар соответствовать описание цена низкий"
+
+
+def _variant(drop: int) -> str:
+    words = BASE.split()
+    return " ".join(words[:drop] + words[drop + 1:])
+
+
+def test_collapse_exact_keeps_first_spelling_and_sums_weights():
+    unique, weights = collapse_exact(["Брак", "отлично", " брак ", "БРАК"], [1, 2, 3, 1])
+    assert unique == ["Брак", "отлично"]
+    assert weights == [5, 2]
+
+
+def test_collapse_exact_reads_iterator_once():
+    unique, weights = collapse_exact(text for text in ["а", "б", "а"])
+    assert unique == ["а", "б"]
+    assert weights == [2, 1]
+
+
+def test_near_duplicates_are_merged_into_first():
+    lemmas = [BASE, "совсем другой отзыв про размер маломерить", BASE + " спасибо", _variant(3)]
+    keep, weights, groups = collapse_near(lemmas, [1, 1, 2, 3], threshold=0.5, return_groups=True)
+    assert keep == [0, 1]
+    assert weights == [6, 1]
+    assert groups == [0, 1, 0, 0]
+
+
+def test_minhash_estimates_jaccard():
+    words = [f"слово{i}" for i in range(16)]
+    first, second = " ".join(words[:12]), " ".join(words[4:])
+    # общих биграмм 7 из 15
+    signatures, has_shingles = minhash_signatures([first, second], num_perm=4096)
+    assert has_shingles.all()
+    assert abs((signatures[0] == signatures[1]).mean() - 7 / 15) < 0.03
+
+
+def test_union_find_merges_chains_transitively():
+    # соседние тексты цепочки похожи (Жаккар 9/13), крайние - нет (7/15): группа собирается через средний
+    words = [f"слово{i}" for i in range(16)]
+    chain = [" ".join(words[start:start + 12]) for start in (0, 2, 4)]
+    params = dict(threshold=0.6, num_perm=256, bands=64)
+    assert collapse_near([chain[0], chain[2]], **params)[0] == [0, 1]
+    extra = ["размер маломерить брать больше", "цвет не совпадать с фото"]
+    keep, weights, groups = collapse_near(extra[:1] + chain + extra[1:], return_groups=True, **params)
+    assert keep == [0, 1, 4]
+    assert weights == [1, 3, 1]
+    assert groups == [0, 1, 1, 1, 4]
+
+
+def test_texts_without_shingles_stay_apart():
+    keep, weights = collapse_near(["", "", BASE])
+    assert keep == [0, 1, 2]
+    assert weights == [1, 1, 1]
+
+
+@pytest.mark.parametrize("lemmas", [[], ["один"]])
+def test_small_inputs(lemmas):
+    keep, weights, groups = collapse_near(lemmas, return_groups=True)
+    assert keep == groups == list(range(len(lemmas)))
+    assert weights == [1] * len(lemmas)
@@ -0,0 +1,68 @@
+"""
+EmbeddingBatcher с заглушкой модели: тексты уходят в модель кусками по числу токенов, а не символов,
+и каждому вызывающему возвращаются его векторы в исходном порядке
+"""
+import threading
+
+import numpy as np
+
+from app.embedding_batcher import EmbeddingBatcher
+
+
+class WordTokenizer:
+    """токен - слово: длина в токенах не совпадает с длиной в символах"""
+
+    def __call__(self, texts, add_special_tokens=True, truncation=False, max_length=None):
+        ids = [text.split() for text in texts]
+        if truncation:
+            ids = [row[:max_length] for row in ids]
+        return {"input_ids": ids}
+
+
+class StubModel:
+    """вектор текста - (длина в символах, число слов); запоминает состав каждого вызова encode"""
+
+    max_seq_length = 128
+
+    def __init__(self):
+        self.tokenizer = WordTokenizer()
+        self.calls = []
+
+    def get_sentence_embedding_dimension(self):
+        return 2
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False):
+        self.calls.append(list(texts))
+        return np.array([[len(text), len(text.split())] for text in texts], dtype=np.float32)
+
+
+def _expected(texts):
+    return np.array([[len(text), len(text.split())] for text in texts], dtype=np.float32)
+
+
+def test_forward_batches_follow_token_length():
+    model = StubModel()
+    batcher = EmbeddingBatcher(lambda: model, max_batch=16, max_wait_ms=1, forward_batch=2)
+    # длинные слова - много символов, мало токенов; короткие слова - наоборот
+    texts = ["оченьдлинноеслово", "а б в г д е", "ж з и к л м", "превосходнейший"]
+    np.testing.assert_array_equal(batcher.encode(texts), _expected(texts))
+    assert model.calls == [["оченьдлинноеслово", "превосходнейший"], ["а б в г д е", "ж з и к л м"]]
+
+
+def test_concurrent_callers_get_their_rows():
+    model = StubModel()
+    batcher = EmbeddingBatcher(lambda: model, max_batch=64, max_wait_ms=50, forward_batch=4)
+    requests = [[f"{'слово ' * (i % 5)}отзыв {n}" for i in range(n, n + 7)] for n in range(8)]
+    results = [None] * len(requests)
+
+    def call(i):
+        results[i] = batcher.encode(requests[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for texts, result in zip(requests, results):
+        np.testing.assert_array_equal(result, _expected(texts))
+    assert all(len(call) <= 4 for call in model.calls)
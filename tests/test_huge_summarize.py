@@ -0,0 +1,46 @@
+"""
+отправка /huge_summarize в очередь: если брокер недоступен, задача не должна остаться 'submitted' навсегда
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("celery")
+pytest.importorskip("fastapi")
+
+from app import api  # noqa: E402
+from app.database import get_task  # noqa: E402
+
+
+@pytest.fixture
+def broken_broker(monkeypatch):
+    def apply_async(*args, **kwargs):
+        raise ConnectionError("broker is down")
+    monkeypatch.setattr(api.run_model_in_queue, "apply_async", apply_async)
+
+
+def test_enqueue_failure_marks_text_task_failed(database, broken_broker):
+    with pytest.raises(ConnectionError):
+        asyncio.run(api.submit_huge_summary(text="отзыв", task_id="text-task"))
+    task = get_task("text-task")
+    assert task["status"] == "error"
+    assert "broker is down" in task["error"]
+    # long-poll /status на завершённой задаче отвечает сразу
+    assert task["status"] in api.TASK_FINAL_STATUSES
+
+
+def test_enqueue_failure_marks_blob_task_failed_and_drops_payload(database, broken_broker):
+    blob_ref = api.blob_store.put_text("отзыв\nещё отзыв", "blob-task")
+    with pytest.raises(ConnectionError):
+        asyncio.run(api.submit_huge_summary(blob_ref=blob_ref, task_id="blob-task"))
+    assert get_task("blob-task")["status"] == "error"
+    with pytest.raises(FileNotFoundError):
+        list(api.blob_store.iter_lines(blob_ref))
+
+
+def test_enqueued_task_stays_submitted(database, monkeypatch):
+    class Sent:
+        id = "ok-task"
+    monkeypatch.setattr(api.run_model_in_queue, "apply_async", lambda *args, **kwargs: Sent())
+    assert asyncio.run(api.submit_huge_summary(text="отзыв", task_id="ok-task")) == "ok-task"
+    assert get_task("ok-task")["status"] == "submitted"
@@ -0,0 +1,49 @@
+"""
+смоук-тест импорта точек входа: приложения FastAPI (app.api через app.main) и воркера Celery (app.tasks)
+
+импорт идёт в отдельном процессе с SQLite и файловыми хранилищами во временном каталоге, чтобы не нужны были
+Postgres и RabbitMQ. если не установлена сторонняя зависимость, тест пропускается; сломанный импорт
+внутри app (ImportError/NameError при загрузке модуля) - падение
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MISSING_DEPENDENCY = 77
+
+IMPORT_SCRIPT = f"""
+import importlib, sys
+try:
+    for name in sys.argv[1:]:
+        importlib.import_module(name)
+except ModuleNotFoundError as err:
+    if err.name and err.name.split(".")[0] not in ("app", "bench"):
+        print(err)
+        sys.exit({MISSING_DEPENDENCY})
+    raise
+"""
+
+
+@pytest.mark.parametrize("modules", [["app.tasks"], ["app.api"], ["app.main"]])
+def test_entry_points_import(tmp_path, modules):
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")])),
+        "DATABASE_URL": f"sqlite:///{tmp_path / 'smoke.sqlite'}",
+        "BLOB_STORE": "fs",
+        "BLOB_STORE_DIR": str(tmp_path / "payloads"),
+        "EMBEDDING_STORE_DIR": str(tmp_path / "embeddings"),
+        "PRELOAD_MODELS": "",
+        "WARMUP_MODELS": "",
+        "RESULT_CACHE_DB_ENABLED": "false",
+        "SINGLEFLIGHT_DB_ENABLED": "false",
+    })
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT, *modules], cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    if result.returncode == MISSING_DEPENDENCY:
+        pytest.skip(f"не установлена зависимость: {result.stdout.strip()}")
+    assert result.returncode == 0, result.stderr
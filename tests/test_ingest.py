@@ -0,0 +1,136 @@
+"""
+потоковый разбор загрузок /upload/*: gzip из нескольких членов, CSV с кавычками, повторы review_id,
+лимит строки в байтах; /upload/analyze пишет отзывы во временный payload и удаляет его после разбора
+"""
+import gzip
+import json
+import os
+
+import pytest
+
+from app import ingest
+from app.ingest import InvalidUpload, TooManyReviews, UniqueReviewLimit, UploadParser
+
+
+def _parse(parser, data: bytes, chunk: int = 7):
+    records = []
+    for start in range(0, len(data), chunk):
+        records.extend(parser.feed(data[start:start + chunk]))
+    records.extend(parser.close())
+    return records
+
+
+def _ndjson(*records):
+    return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+
+
+def test_gzip_members_are_concatenated():
+    data = gzip.compress(_ndjson({"text": "первый"}, {"text": "второй"})) + gzip.compress(_ndjson({"text": "третий"}))
+    records = _parse(UploadParser("ndjson"), data)
+    assert [record.text for record in records] == ["первый", "второй", "третий"]
+
+
+def test_truncated_gzip_is_rejected():
+    data = gzip.compress(_ndjson({"text": "отзыв"}))
+    with pytest.raises(InvalidUpload):
+        _parse(UploadParser("ndjson"), data[:-6])
+
+
+def test_csv_quoted_fields():
+    data = (
+        'review_id,text,rating\r\n'
+        '1,"Хороший, но ""дорогой""",5\r\n'
+        '2,"в две\r\nстроки",\r\n'
+        '3,,4\r\n'
+    ).encode("utf-8")
+    parser = UploadParser("csv")
+    records = _parse(parser, data, chunk=5)
+    assert [(record.text, record.rating) for record in records] == [
+        ('Хороший, но "дорогой"', 5.0), ("в две строки", None),
+    ]
+    assert parser.stats()["invalid"] == {"no_text": 1}
+
+
+def test_csv_unclosed_quote_is_rejected():
+    with pytest.raises(InvalidUpload):
+        _parse(UploadParser("csv"), 'text\n"без конца\n'.encode("utf-8"))
+
+
+def test_duplicate_review_ids_are_dropped():
+    data = _ndjson(
+        {"review_id": 1, "text": "первый"},
+        {"review_id": "1", "text": "первый ещё раз"},
+        {"review_id": 2, "text": "второй"},
+        {"text": "без id"},
+        {"text": "без id"},
+    )
+    parser = UploadParser("ndjson")
+    records = _parse(parser, data)
+    assert [record.text for record in records] == ["первый", "второй", "без id", "без id"]
+    assert parser.duplicates == 1
+
+
+def test_seen_ids_are_capped():
+    data = _ndjson(*({"review_id": i % 3, "text": f"отзыв {i}"} for i in range(6)))
+    parser = UploadParser("ndjson", max_seen_ids=2)
+    records = _parse(parser, data)
+    # id 0 и 1 запомнены, id 2 - уже нет
+    assert [record.text for record in records] == ["отзыв 0", "отзыв 1", "отзыв 2", "отзыв 5"]
+    assert parser.duplicates == 2
+
+
+def test_line_limit_counts_utf8_bytes(monkeypatch):
+    monkeypatch.setattr(ingest, "INGEST_MAX_LINE_BYTES", 100)
+    # 60 символов: в ASCII укладываются в лимит, кириллицей - 120 байт
+    list(UploadParser("ndjson").feed(b"a" * 60))
+    with pytest.raises(InvalidUpload):
+        list(UploadParser("ndjson").feed(("я" * 60).encode("utf-8")))
+
+
+def test_unique_review_limit():
+    limit = UniqueReviewLimit(max_reviews=2)
+    for text in ("Отзыв", "  отзыв ", "другой", "ДРУГОЙ"):
+        limit.add(text)
+    with pytest.raises(TooManyReviews):
+        limit.add("третий")
+
+
+@pytest.fixture
+def upload_client(database, monkeypatch):
+    pytest.importorskip("fastapi")
+    pytest.importorskip("celery")
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from app import api
+
+    calls = []
+
+    def analyze_review_list(reviews, with_representatives, with_keywords, weights=None, product_id=None):
+        calls.append((reviews, weights))
+        return {"keywords": [["отзыв", sum(weights)]]}
+
+    monkeypatch.setattr(api, "analyze_review_list", analyze_review_list)
+    app = FastAPI()
+    app.include_router(api.router)
+    with TestClient(app) as client:
+        yield client, calls, api.blob_store.path
+
+
+def test_upload_analyze_reads_reviews_back_from_payload(upload_client):
+    client, calls, payload_dir = upload_client
+    data = gzip.compress(_ndjson({"text": "Хороший"}, {"text": "плохой"}, {"text": "хороший "}))
+    response = client.post("/upload/analyze?outputs=keywords", content=data)
+    assert response.status_code == 200
+    assert response.json()["keywords"] == [["отзыв", 3]]
+    assert calls == [(["Хороший", "плохой"], [2, 1])]
+    assert os.listdir(payload_dir) == []
+
+
+def test_upload_analyze_too_many_reviews(upload_client, monkeypatch):
+    from app import api
+    client, calls, payload_dir = upload_client
+    monkeypatch.setattr(api, "UniqueReviewLimit", lambda: UniqueReviewLimit(max_reviews=1))
+    response = client.post("/upload/analyze?outputs=keywords", content=_ndjson({"text": "один"}, {"text": "два"}))
+    assert response.status_code == 413
+    assert calls == []
+    assert os.listdir(payload_dir) == []
@@ -0,0 +1,71 @@
+"""
+text_preproc_batch должен давать ровно [text_preproc(t) for t in texts]: склейка через LEMMA_SEPARATOR,
+разрезание ответа Mystem и кэш строк не должны ничего менять. нужен бинарник mystem - без него тест пропускается
+"""
+import os
+
+import pytest
+
+pymystem3 = pytest.importorskip("pymystem3")
+from pymystem3.constants import MYSTEM_BIN  # noqa: E402
+
+if not os.path.isfile(os.environ.get("MYSTEM_BIN") or MYSTEM_BIN):
+    pytest.skip("бинарник mystem не установлен", allow_module_level=True)
+
+from app import models  # noqa: E402
+
+TEXTS = [
+    "Отличные мандарины, сладкие!",
+    "Огромные, почти безвкусные",
+    "",
+    "   ",
+    "!!!",
+    "...",
+    "?!,;:-()",
+    "Не понравилось, не советую",
+    "good product, fast delivery",
+    "Товар ok, доставка fast",
+    "123 456",
+    models.LEMMA_SEPARATOR,
+    f"до{models.LEMMA_SEPARATOR}после",
+    "|||",
+    " .|||. .|||. ",
+    "Ёлка и ёжик",
+    "Хорошие мандарины, в меру сладкие, без косточек",
+    "первая строка\nвторая строка",
+    "строка\r\nс переводом",
+    "Отличные мандарины, сладкие!",
+]
+STOP_WORDS = {"очень", "товар"}
+
+
+def _expected(texts, stop_words=STOP_WORDS):
+    return [models.text_preproc(t, stop_words=stop_words) for t in texts]
+
+
+@pytest.fixture(autouse=True)
+def _empty_lemma_cache():
+    with models._lemma_cache_lock:
+        models._lemma_cache.clear()
+    yield
+
+
+def test_batch_equals_per_text():
+    assert models.text_preproc_batch(TEXTS, stop_words=STOP_WORDS) == _expected(TEXTS)
+
+
+def test_batch_equals_per_text_from_cache():
+    models.text_preproc_batch(TEXTS, stop_words=STOP_WORDS)
+    assert models.text_preproc_batch(TEXTS, stop_words=STOP_WORDS) == _expected(TEXTS)
+
+
+def test_batch_equals_per_text_across_chunks(monkeypatch):
+    monkeypatch.setattr(models, "LEMMA_BATCH_SIZE", 3)
+    assert models.text_preproc_batch(TEXTS, stop_words=None) == _expected(TEXTS, stop_words=None)
+
+
+def test_batch_equals_per_text_in_process_pool(monkeypatch):
+    monkeypatch.setattr(models, "LEMMA_POOL_THRESHOLD", 1)
+    monkeypatch.setattr(models, "LEMMA_WORKERS", 2)
+    monkeypatch.setattr(models, "LEMMA_BATCH_SIZE", 4)
+    assert models.text_preproc_batch(TEXTS, stop_words=STOP_WORDS) == _expected(TEXTS)
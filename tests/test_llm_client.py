@@ -0,0 +1,207 @@
+"""
+LLMClient против локального заглушечного апстрима (http.server в потоке): повторы на 5xx и сетевых ошибках,
+отказ после исчерпания повторов, таймаут чтения и лимит одновременных запросов к апстриму
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+from app.llm_client import LLMClient, LLMError
+
+REQUEST = {"model": "test", "messages": [{"role": "user", "content": "отзывы"}]}
+RESPONSE = {"choices": [{"message": {"content": "саммари"}}], "usage": {"prompt_tokens": 3}}
+
+
+class StubUpstream(ThreadingHTTPServer):
+    """
+    отвечает по очереди статусами из statuses (дальше - 200), перед ответом ждёт delay секунд;
+    считает запросы и максимум одновременно обрабатываемых
+    """
+    daemon_threads = True
+
+    def __init__(self, statuses=(), delay: float = 0.0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            status = server.statuses.pop(0) if server.statuses else 200
+        try:
+            time.sleep(server.delay)
+            body = json.dumps(RESPONSE if status == 200 else {"error": "stub"}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@pytest.fixture
+def upstream():
+    servers = []
+
+    def start(statuses=(), delay: float = 0.0):
+        server = StubUpstream(statuses, delay)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _client(url, **kwargs):
+    kwargs.setdefault("backoff", 0.01)
+    kwargs.setdefault("retries", 2)
+    return LLMClient("stub", url, **kwargs)
+
+
+def _run(client, coro_factory):
+    async def main():
+        await client.open()
+        try:
+            return await coro_factory()
+        finally:
+            await client.aclose()
+    return asyncio.run(main())
+
+
+def test_retries_on_5xx(upstream):
+    server = upstream(statuses=[503, 500])
+    client = _client(server.url)
+    assert _run(client, lambda: client.chat(REQUEST)) == RESPONSE
+    assert server.requests == 3
+
+
+def test_retries_on_5xx_sync(upstream):
+    server = upstream(statuses=[502])
+    client = _client(server.url)
+    try:
+        assert client.chat_sync(REQUEST) == RESPONSE
+    finally:
+        client.close_sync()
+    assert server.requests == 2
+
+
+def test_gives_up_after_retry_budget(upstream):
+    server = upstream(statuses=[503] * 10)
+    client = _client(server.url, retries=2)
+    with pytest.raises(LLMError):
+        _run(client, lambda: client.chat(REQUEST))
+    assert server.requests == 3
+
+
+def test_client_error_is_not_retried(upstream):
+    server = upstream(statuses=[400])
+    client = _client(server.url)
+    with pytest.raises(LLMError):
+        client.chat_sync(REQUEST)
+    client.close_sync()
+    assert server.requests == 1
+
+
+def test_retries_on_connect_error_with_jitter(monkeypatch):
+    client = _client(f"http://127.0.0.1:{_free_port()}", retries=3, backoff=0.05)
+    delays = []
+    original = client._delay
+
+    def recorded(attempt):
+        delay = original(attempt)
+        delays.append((attempt, delay))
+        return delay
+
+    monkeypatch.setattr(client, "_delay", recorded)
+    with pytest.raises(LLMError) as err:
+        _run(client, lambda: client.chat(REQUEST))
+    assert isinstance(err.value.__cause__, httpx.ConnectError)
+    # задержка перед каждым повтором, кроме последней попытки, в пределах [0, backoff * 2^attempt]
+    assert [attempt for attempt, _ in delays] == [0, 1, 2]
+    assert all(0 <= delay <= 0.05 * 2 ** attempt for attempt, delay in delays)
+
+
+def test_jitter_spreads_delays():
+    client = _client("http://127.0.0.1:1", backoff=1.0)
+    delays = [client._delay(2) for _ in range(200)]
+    assert all(0 <= delay <= 4.0 for delay in delays)
+    assert len(set(delays)) > 100
+
+
+def test_read_timeout(upstream):
+    server = upstream(delay=1.0)
+    client = _client(server.url, retries=0, read_timeout=0.2)
+    started = time.monotonic()
+    with pytest.raises(LLMError) as err:
+        _run(client, lambda: client.chat(REQUEST))
+    assert isinstance(err.value.__cause__, httpx.ReadTimeout)
+    assert time.monotonic() - started < 0.9
+
+
+def test_concurrency_limit(upstream):
+    server = upstream(delay=0.2)
+    client = _client(server.url, max_concurrency=3, pool_size=10)
+
+    async def burst():
+        return await asyncio.gather(*(client.chat(REQUEST) for _ in range(10)))
+
+    assert _run(client, burst) == [RESPONSE] * 10
+    assert server.requests == 10
+    assert server.max_in_flight == 3
+
+
+def test_concurrency_limit_sync(upstream):
+    server = upstream(delay=0.2)
+    client = _client(server.url, max_concurrency=2, pool_size=10)
+    threads = [threading.Thread(target=client.chat_sync, args=(REQUEST,)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.close_sync()
+    assert server.requests == 6
+    assert server.max_in_flight == 2
+
+
+def test_chat_requires_open_client():
+    client = _client("http://127.0.0.1:1")
+    with pytest.raises(RuntimeError):
+        asyncio.run(client.chat(REQUEST))
@@ -0,0 +1,66 @@
+"""
+ключ result_cache: не зависит от порядка отзывов, пробелов и регистра, повторы учитываются
+(в том числе заданные весами), параметры запроса к LLM и конвейера ключ различают
+"""
+from app.dedup import collapse_exact
+from app.models import iter_review_lines
+from app.result_cache import ResultCache, request_fingerprint, result_key, reviews_digest
+
+REVIEWS = ["Отличный товар", "доставка  долгая", "Брак", "отличный товар"]
+REQUEST = {
+    "model": "vikhr", "temperature": 0.3, "max_tokens": 512, "stream": False,
+    "messages": [{"role": "system", "content": "Сделай саммари"}, {"role": "user", "content": "отзывы"}],
+}
+
+
+def test_digest_ignores_order_whitespace_and_case():
+    assert reviews_digest(REVIEWS) == reviews_digest(["  брак", "ОТЛИЧНЫЙ ТОВАР", "Доставка долгая\t", "Отличный товар"])
+
+
+def test_digest_counts_repeats():
+    assert reviews_digest(REVIEWS) != reviews_digest(REVIEWS[:3])
+    assert reviews_digest(["а", "а", "б"]) != reviews_digest(["а", "б", "б"])
+
+
+def test_weights_equal_repeats():
+    assert reviews_digest(["Отличный товар", "доставка долгая", "брак"], [2, 1, 1]) == reviews_digest(REVIEWS)
+
+
+def test_streamed_collapse_keeps_the_key():
+    # воркер /huge_summarize считает ключ по уникальным отзывам с весами, прочитанным потоком из payload'а
+    lines = iter(["", *REVIEWS, "  ", "брак"])
+    unique, weights = collapse_exact(iter_review_lines(lines))
+    fingerprint = request_fingerprint(REQUEST)
+    assert result_key("summary", unique, fingerprint, weights=weights) == \
+        result_key("summary", REVIEWS + ["брак"], fingerprint)
+
+
+def test_fingerprint_ignores_user_message_and_stream():
+    other = dict(REQUEST, stream=True, messages=[REQUEST["messages"][0], {"role": "user", "content": "другие"}])
+    assert request_fingerprint(other) == request_fingerprint(REQUEST)
+    changed_prompt = dict(REQUEST, messages=[{"role": "system", "content": "Выдели атрибуты"}])
+    assert request_fingerprint(changed_prompt) != request_fingerprint(REQUEST)
+    assert request_fingerprint(dict(REQUEST, temperature=0.7)) != request_fingerprint(REQUEST)
+
+
+def test_key_separates_kind_and_pipeline_params():
+    fingerprint = request_fingerprint(REQUEST)
+    base = result_key("summary", REVIEWS, fingerprint, selection_mode="strict")
+    assert base == result_key("summary", list(reversed(REVIEWS)), fingerprint, selection_mode="strict")
+    assert base != result_key("attributes", REVIEWS, fingerprint, selection_mode="strict")
+    assert base != result_key("summary", REVIEWS, fingerprint, selection_mode="budget")
+    assert base != result_key("summary", REVIEWS, fingerprint)
+
+
+def test_memory_tier_lru_and_ttl():
+    cache = ResultCache(size=2, ttl=60, db_enabled=False)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"
+    cache.put("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+
+    expired = ResultCache(ttl=-1, db_enabled=False)
+    expired.put("a", "A")
+    assert expired.get("a") is None
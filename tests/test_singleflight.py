@@ -0,0 +1,154 @@
+"""
+межпроцессная склейка SingleFlight.do_sync: таблица inflight_leases заменена словарём в памяти,
+"процессы" - экземпляры SingleFlight в потоках с общим кэшем
+"""
+import datetime
+import threading
+import time
+
+import pytest
+
+from app.result_cache import ResultCache
+from app.singleflight import SingleFlight, LEASE_NO_RESULT, LEASE_RUNNING
+
+
+class MemoryLeases(SingleFlight):
+    def __init__(self, leases, cache, **kwargs):
+        super().__init__(cache=cache, db_enabled=True, **kwargs)
+        self.leases = leases
+
+    def _acquire(self, key, owner):
+        with self.leases["lock"]:
+            lease = self.leases.get(key)
+            if lease is not None and lease["expires_at"] > datetime.datetime.utcnow():
+                return False
+            self.leases[key] = {
+                "owner": owner, "no_result": False,
+                "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease_ttl),
+            }
+            return True
+
+    def _release(self, key, owner, no_result=False):
+        with self.leases["lock"]:
+            lease = self.leases.get(key)
+            if lease is None or lease["owner"] != owner:
+                return
+            if no_result:
+                lease["no_result"] = True
+                lease["expires_at"] = datetime.datetime.utcnow() + datetime.timedelta(seconds=4 * self.poll_interval + 1)
+            else:
+                del self.leases[key]
+
+    def _lease_state(self, key):
+        with self.leases["lock"]:
+            lease = self.leases.get(key)
+            if lease is None or lease["expires_at"] <= datetime.datetime.utcnow():
+                return None
+            return LEASE_NO_RESULT if lease["no_result"] else LEASE_RUNNING
+
+
+class SharedCache(ResultCache):
+    """
+    кэш, видимый всем "процессам" (как таблица result_cache)
+    """
+
+    def __init__(self):
+        super().__init__(db_enabled=False)
+        self.db_enabled = True
+
+
+@pytest.fixture
+def cluster():
+    leases = {"lock": threading.Lock()}
+    cache = SharedCache()
+
+    def make():
+        return MemoryLeases(leases, cache, lease_ttl=30, poll_interval=0.02)
+    return make, cache, leases
+
+
+def _run_together(workers):
+    results = [None] * len(workers)
+
+    def run(i, worker):
+        results[i] = worker()
+    threads = [threading.Thread(target=run, args=(i, worker)) for i, worker in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join(timeout=10)
+    return results
+
+
+def test_followers_take_cached_result(cluster):
+    make, cache, _ = cluster
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        cache.put("key", "summary")
+        return "summary"
+
+    results = _run_together([lambda: make().do_sync("key", compute) for _ in range(4)])
+    assert results == ["summary"] * 4
+    assert len(calls) == 1
+
+
+def test_followers_stop_waiting_when_result_is_not_cached(cluster):
+    make, _, leases = cluster
+    calls = []
+
+    def compute():
+        calls.append(time.monotonic())
+        time.sleep(0.2)
+        return "not cached"
+
+    started = time.monotonic()
+    results = _run_together([lambda: make().do_sync("key", compute) for _ in range(4)])
+    assert results == ["not cached"] * 4
+    assert len(calls) == 4
+    # ожидающие считают сразу после лидера и одновременно, а не по очереди через новую аренду
+    assert max(calls) - min(calls) < 0.2 + 0.15
+    assert time.monotonic() - started < 2 * 0.2 + 0.3
+    assert leases["key"]["no_result"]
+
+
+def test_follower_becomes_leader_after_failure(cluster):
+    make, cache, leases = cluster
+    calls = []
+
+    def failing():
+        calls.append("failed")
+        time.sleep(0.1)
+        raise RuntimeError("leader crashed")
+
+    def compute():
+        calls.append("ok")
+        cache.put("key", "summary")
+        return "summary"
+
+    def leader():
+        with pytest.raises(RuntimeError):
+            make().do_sync("key", failing)
+
+    results = _run_together([leader, lambda: make().do_sync("key", compute)])
+    assert results[1] == "summary"
+    assert calls == ["failed", "ok"]
+    assert "key" not in leases
+
+
+def test_new_leader_resets_no_result(cluster):
+    make, cache, leases = cluster
+    make().do_sync("key", lambda: "not cached")
+    assert leases["key"]["no_result"]
+    leases["key"]["expires_at"] = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+
+    def compute():
+        assert leases["key"]["no_result"] is False
+        cache.put("key", "summary")
+        return "summary"
+
+    assert make().do_sync("key", compute) == "summary"
+    assert "key" not in leases
@@ -0,0 +1,146 @@
+"""
+TopicState без моделей: эмбеддинг отзыва 'tK ...' - ось K % 4 (с небольшим шумом), тема - K % 4,
+почти-дубликаты t1 -> t0 и t3 -> t2 схлопнуты. веса тем при новых повторах, пропаже и возврате отзывов,
+новые отзывы, формат сохранённого состояния и запасной отбор под бюджет, когда темы не выделились
+"""
+import io
+
+import numpy as np
+import pytest
+
+from app import topic_state as ts
+from app.database import SessionLocal, TopicStateRecord
+
+N = 40
+MERGED_INTO = {1: 0, 3: 2}
+UNIQUE = [f"t{i} отзыв" for i in range(N)]
+
+
+def _encode(lemmas):
+    rng = np.random.default_rng(len(lemmas))
+    vectors = np.zeros((len(lemmas), 8))
+    for row, lemma in enumerate(lemmas):
+        vectors[row, int(lemma.split()[0][1:]) % 4] = 1
+        if "новый" not in lemma:
+            vectors[row] += 0.01 * rng.standard_normal(8)
+    return ts._unit(vectors)
+
+
+def _collapse_near(lemmas, weights, return_groups=False):
+    groups = [MERGED_INTO.get(i, i) for i in range(len(lemmas))]
+    keep = [i for i in range(len(lemmas)) if groups[i] == i]
+    kept_weights = [sum(w for w, group in zip(weights, groups) if group == i) for i in keep]
+    return keep, kept_weights, groups
+
+
+@pytest.fixture(autouse=True)
+def stub_models(monkeypatch):
+    monkeypatch.setattr(ts, "DEDUP_ENABLED", True)
+    monkeypatch.setattr(ts, "_encode", _encode)
+    monkeypatch.setattr(ts, "text_preproc_batch", lambda texts, stop_words=None: list(texts))
+    monkeypatch.setattr(ts, "collapse_near", _collapse_near)
+    monkeypatch.setattr(ts, "fit_topics", lambda lemmas, embeddings: (
+        None, np.array([int(lemma.split()[0][1:]) % 4 for lemma in lemmas])
+    ))
+
+
+def _expected(weights):
+    # вес схлопнутого почти-дубликата идёт в тему отзыва, в который он схлопнут
+    return np.bincount([MERGED_INTO.get(i, i) % 4 for i in range(N)], weights=weights, minlength=4)
+
+
+def _fit():
+    state = ts.TopicState.fit("p1", UNIQUE, np.ones(N, dtype=np.int64), [])
+    assert state is not None
+    return state
+
+
+def _update(state, unique, weights):
+    return state.update(unique, weights, ts.review_hashes(unique), [])
+
+
+def test_fit_weights():
+    state = _fit()
+    np.testing.assert_allclose(state.topic_weights, _expected(np.ones(N)))
+    assert state.meta["fitted_weight"] == N
+
+
+def test_new_repeats_add_weight_to_parent_topic():
+    state = _fit()
+    weights = np.ones(N, dtype=np.int64)
+    weights[1] = 5
+    weights[6] = 3
+    assert _update(state, UNIQUE, weights)
+    np.testing.assert_allclose(state.topic_weights, _expected(weights))
+    assert not _update(state, UNIQUE, weights)
+
+
+def test_missing_reviews_are_subtracted_and_restored():
+    state = _fit()
+    weights = np.ones(N, dtype=np.int64)
+    present = [i for i in range(N) if i not in (3, 10)]
+    assert _update(state, [UNIQUE[i] for i in present], weights[present])
+    removed = weights.copy()
+    removed[[3, 10]] = 0
+    np.testing.assert_allclose(state.topic_weights, _expected(removed))
+    assert state.meta["missing"] == 2
+
+    assert _update(state, UNIQUE, weights)
+    np.testing.assert_allclose(state.topic_weights, _expected(weights))
+    assert state.meta["missing"] == 0
+
+
+def test_new_review_joins_nearest_topic():
+    state = _fit()
+    unique = UNIQUE + ["t5 новый"]
+    weights = np.r_[np.ones(N, dtype=np.int64), 2]
+    assert _update(state, unique, weights)
+    expected = _expected(np.ones(N))
+    expected[1] += 2
+    np.testing.assert_allclose(state.topic_weights, expected)
+    assert state.meta["new_weight"] == 2 and state.meta["outlier_weight"] == 0
+    assert len(state.hashes) == N + 1 and np.all(np.diff(state.hashes.astype(np.float64)) > 0)
+
+
+def _record(state, arrays=None):
+    blob, meta = state.dump()
+    if arrays is not None:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        blob = buffer.getvalue()
+    return TopicStateRecord(product_id=state.product_id, version=1, arrays=blob, meta=meta)
+
+
+def test_dump_load_roundtrip():
+    state = _fit()
+    loaded = ts.TopicState.load(_record(state))
+    for field in ts.ARRAY_FIELDS:
+        np.testing.assert_array_equal(getattr(loaded, field), getattr(state, field))
+    assert loaded.cand_texts == state.cand_texts
+
+
+def test_state_without_parents_is_dropped(database):
+    state = _fit()
+    arrays = {field: getattr(state, field) for field in ts.ARRAY_FIELDS if field != "parents"}
+    with pytest.raises(ValueError):
+        ts.TopicState.load(_record(state, arrays))
+
+    session = SessionLocal()
+    session.add(_record(state, arrays))
+    session.commit()
+    session.close()
+    assert ts.TopicStateStore().get("p1") is None
+    session = SessionLocal()
+    assert session.get(TopicStateRecord, "p1") is None
+    session.close()
+
+
+def test_no_topics_fallback_fits_budget(database, monkeypatch):
+    monkeypatch.setattr(ts, "fit_topics", lambda lemmas, embeddings: (None, None))
+    monkeypatch.setattr("app.models.count_tokens", lambda texts: [10] * len(texts))
+    monkeypatch.setattr(ts, "count_tokens", lambda texts: [10] * len(texts))
+    weights = [1] * N
+    weights[7] = 9
+    weights[20] = 4
+    selected = ts.product_representatives("p2", UNIQUE, [], mode="strict", weights=weights, budget=50)
+    assert selected == ["t7 отзыв", "t20 отзыв", "t0 отзыв", "t1 отзыв", "t2 отзыв"]
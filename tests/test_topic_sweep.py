@@ -0,0 +1,61 @@
+"""
+кандидаты перебора min_cluster_size оцениваются без обучения BERTopic: слова тем из _ctfidf_topic_words
+должны совпадать с тем, что выдал бы BERTopic на тех же метках
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip("bertopic")
+from sklearn.feature_extraction.text import CountVectorizer  # noqa: E402
+
+from app import models  # noqa: E402
+
+VOCAB = [
+    ["вкусный", "сладкий", "сочный", "мандарин", "кожура"],
+    ["доставка", "курьер", "быстрый", "опоздать", "упаковка"],
+    ["цена", "дорогой", "дешёвый", "скидка", "акция"],
+]
+COMMON = ["товар", "хороший", "отличный", "плохой"]
+
+
+def _corpus(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(-1, len(VOCAB), size=n)
+    docs = [
+        " ".join(list(rng.choice(VOCAB[t] if t >= 0 else sum(VOCAB, []), 4)) + list(rng.choice(COMMON, 2)))
+        for t in labels
+    ]
+    return docs, labels
+
+
+def test_ctfidf_words_match_bertopic():
+    from bertopic import BERTopic
+    from bertopic.cluster import BaseCluster
+    from bertopic.dimensionality import BaseDimensionalityReduction
+
+    docs, labels = _corpus()
+    vectorizer = CountVectorizer()
+    counts = vectorizer.fit_transform(docs).tocsr()
+    words = models._ctfidf_topic_words(labels, counts, vectorizer.get_feature_names_out())
+
+    topic_model = BERTopic(
+        language="russian", calculate_probabilities=False, vectorizer_model=CountVectorizer(),
+        umap_model=BaseDimensionalityReduction(), hdbscan_model=BaseCluster(),
+    )
+    topic_model.fit_transform(docs, np.zeros((len(docs), 4)), y=labels)
+    expected = [
+        [word for word, _ in topic_words if word]
+        for topic, topic_words in topic_model.get_topics().items() if topic != -1
+    ]
+    assert sorted(words) == sorted(expected)
+
+
+def test_ctfidf_words_skip_outliers():
+    docs, _ = _corpus(20)
+    vectorizer = CountVectorizer()
+    counts = vectorizer.fit_transform(docs).tocsr()
+    labels = np.full(len(docs), -1)
+    assert models._ctfidf_topic_words(labels, counts, vectorizer.get_feature_names_out()) == []
+    labels[:5] = 0
+    words = models._ctfidf_topic_words(labels, counts, vectorizer.get_feature_names_out(), top_n=3)
+    assert len(words) == 1 and len(words[0]) == 3